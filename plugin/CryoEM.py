@@ -1,11 +1,24 @@
+import asyncio
 import os
 import tempfile
+import time
 from pathlib import Path
 
 from nanome.util import Logs, enums
 from nanome.api import structure
+from .client_profiler import PROFILE_CLIENT, ProfiledClient
+from .compute import ComputeClient
+from .map_cache import MapCache
+from .map_store import MapStore
+from .memory import InsufficientMemory, MemoryBudget
+from . import memory
 from .menu import MainMenu
-from .models import MapGroup
+from .mesh_io import hash_file
+from . import metrics
+from .models import MapGroup, MapMesh
+from .session_state import SessionCheckpoint
+from .utils import MRC_MODE_BYTES, MRCHeader
+from .ui_updates import UIUpdateQueue
 from .vault_manager import VaultManager
 from .vault_menu import VaultMenu
 
@@ -14,30 +27,86 @@ from nanome.beta.nanome_sdk import NanomePlugin
 import logging
 logging.getLogger('matplotlib').setLevel(logging.WARNING)
 
+# Seconds that workspace changes are collected for before the workspace is checked.
+WORKSPACE_SYNC_DELAY = float(os.environ.get('WORKSPACE_SYNC_DELAY', 0.5))
+
 
 class CryoEM(NanomePlugin):
 
     def __init__(self):
         super().__init__()
         self.temp_dir = tempfile.TemporaryDirectory()
+        self.map_cache = MapCache()
+        self.map_store = MapStore()
+        self.compute = ComputeClient()
+        self.memory_budget = MemoryBudget()
+        self.ui_updates = UIUpdateQueue(self)
+        self.session_id = None
+        self.session_checkpoint = None
+        self._checkpoint_lock = asyncio.Lock()
+        self._workspace_changed = False
+        self._workspace_sync_task = None
+        self._metrics_task = None
         self.menu = MainMenu(self)
         self.groups = []
         self.add_mapgroup()
         self.vault_url = os.environ.get("VAULT_URL")
         self.vault_api_key = os.environ.get("VAULT_API_KEY")
 
+    def set_client(self, plugin_id, session_id, version_table):
+        super().set_client(plugin_id, session_id, version_table)
+        self.session_id = session_id
+        if PROFILE_CLIENT:
+            self.client = ProfiledClient(self.client)
+        # Each session runs in its own process, so its metrics are labelled per process.
+        metrics.registry.labels['session'] = str(session_id)
+        memory.start_tracking()
+
     async def on_stop(self):
+        if self._workspace_sync_task:
+            self._workspace_sync_task.cancel()
+        if isinstance(self.client, ProfiledClient):
+            self.client.log_summary()
+        if self._metrics_task:
+            self._metrics_task.cancel()
+            await self.report_metrics()
         self.temp_dir.cleanup()
+        self.map_store.release_all()
+        if self.session_checkpoint:
+            self.session_checkpoint.close()
+        # Disconnecting cancels this session's queued jobs in the compute service.
+        await self.compute.close()
+        if hasattr(self, 'vault_manager'):
+            await self.vault_manager.close()
 
     async def on_run(self):
+        if metrics.METRICS_PORT and not self._metrics_task:
+            self._metrics_task = asyncio.create_task(self.report_metrics_periodically())
         await self.menu.render(force_enable=True)
         presenter_info = await self.client.request_presenter_info()
         org = f'org-{presenter_info.org_id}'
         user_id = presenter_info.account_id
+        self.session_checkpoint = SessionCheckpoint(f'{org}-{user_id}', self.session_id, self.map_cache)
+        await self.restore_session()
         self.vault_manager = VaultManager(self.vault_api_key, self.vault_url)
         self.vault_menu = VaultMenu(self, self.vault_manager, org, user_id)
         self.vault_menu.create_menu()
 
+    async def report_metrics_periodically(self):
+        while True:
+            await asyncio.sleep(metrics.METRICS_REPORT_INTERVAL)
+            await self.report_metrics()
+
+    async def report_metrics(self):
+        """Send this session's metrics observations to run.py, through the compute service."""
+        observations = metrics.registry.take_unreported()
+        if not observations or not self.compute.available:
+            return
+        try:
+            await self.compute.report_metrics(observations)
+        except ConnectionError:
+            Logs.debug("Compute service not available, metrics dropped")
+
     def add_mapgroup(self):
         group_num = 1
         existing_group_names = [group.group_name for group in self.groups]
@@ -48,6 +117,7 @@ class CryoEM(NanomePlugin):
                 break
             group_num += 1
         self.groups.append(map_group)
+        return map_group
 
     def get_group(self, group_name):
         return next((
@@ -55,10 +125,11 @@ class CryoEM(NanomePlugin):
             if group.group_name == group_name
         ), None)
 
-    async def add_model_to_group(self, filepath):
+    async def add_model_to_group(self, filepath, mapgroup=None, model_comp=None, model=None):
         # Look for a MapGroup to add the model to
-        selected_mapgroup_name = self.menu.get_selected_mapgroup()
-        mapgroup = self.get_group(selected_mapgroup_name)
+        if not mapgroup:
+            selected_mapgroup_name = self.menu.get_selected_mapgroup()
+            mapgroup = self.get_group(selected_mapgroup_name)
         if not mapgroup:
             if not self.groups:
                 self.add_mapgroup()
@@ -66,21 +137,30 @@ class CryoEM(NanomePlugin):
             else:
                 self.client.send_notification(enums.NotificationTypes.error, "Please select a MapGroup.")
                 return
-        model_comp = await self.create_model_complex(filepath)
-        if mapgroup:
-            mapgroup.add_pdb(filepath)
-            model_comp.locked = True
-            model_comp.boxed = False
-            map_complex = mapgroup.map_complex
-            if map_complex:
-                model_comp.position = map_complex.position
-                model_comp.rotation = map_complex.rotation
+        if not model_comp:
+            model_comp = await self.create_model_complex(filepath)
+        async with mapgroup.lock:
+            await self._add_model_complex(mapgroup, filepath, model_comp, model)
+        await self.checkpoint_session()
 
+    async def _add_model_complex(self, mapgroup, filepath, model_comp, model=None):
+        # Caller must hold mapgroup.lock
+        mapgroup.add_pdb(filepath, model)
+        model_comp.locked = True
+        model_comp.boxed = False
+        map_complex = mapgroup.map_complex
+        if map_complex:
+            model_comp.position = map_complex.position
+            model_comp.rotation = map_complex.rotation
         [created_comp] = await self.client.add_to_workspace([model_comp])
-        if mapgroup:
-            mapgroup.add_model_complex(created_comp)
+        mapgroup.add_model_complex(created_comp)
 
     async def create_model_complex(self, model_filepath: str):
+        # Parsing and bonding are slow for large models, so keep them off the event loop.
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._load_model_complex, model_filepath)
+
+    def _load_model_complex(self, model_filepath: str):
         model_path = Path(model_filepath)
         suffix = model_path.suffix
         if suffix == ".pdb":
@@ -97,35 +177,134 @@ class CryoEM(NanomePlugin):
         comp.locked = True
         return comp
 
-    async def add_mapfile_to_group(self, map_gz_filepath, isovalue=None, metadata=None):
-        selected_mapgroup_name = self.menu.get_selected_mapgroup()
-        mapgroup = self.get_group(selected_mapgroup_name)
+    async def add_mapfile_to_group(
+            self, map_gz_filepath, isovalue=None, metadata=None, fitted_model=None, mapgroup=None, map_manager=None,
+            mesh=None, source_hash=None):
+        """Load map into a MapGroup and generate its mesh.
+
+        mapgroup: MapGroup to load into. Defaults to the group selected in the main menu.
+        fitted_model: Optional awaitable resolving to a (filepath, complex, cctbx model) tuple,
+        which is added to the same MapGroup before the mesh is generated.
+        map_manager: Optional map already parsed from map_gz_filepath.
+        Otherwise the map is attached from the map store, shared with other sessions viewing it.
+        mesh: Optional mesh already generated from the full map at isovalue, e.g. from a mesh artifact.
+        source_hash: Optional sha256 of map_gz_filepath, if it was already computed.
+
+        Without a mesh or fitted model, the map statistics and full mesh are looked up in the map cache,
+        and saved to it after meshing.
+        Raises InsufficientMemory, after notifying the user, if the map can't be loaded within the memory budget.
+        """
+        # Only move the main menu selection when loading into the selected group.
+        selected_mapgroup = self.get_group(self.menu.get_selected_mapgroup())
+        select_on_render = not mapgroup
+        if not mapgroup:
+            mapgroup = selected_mapgroup
         if not mapgroup:
             if not self.groups:
                 self.add_mapgroup()
                 mapgroup = self.groups[0]
             else:
-                self.client.send_notification(enums.NotificationTypes.error, "Please select a MapGroup.")
+                await self.client.send_notification(enums.NotificationTypes.error, "Please select a MapGroup.")
                 return
-        if isovalue:
-            Logs.debug(f"Setting isovalue to {isovalue}")
-            mapgroup.isovalue = isovalue
-        mapgroup.metadata = metadata
-        await mapgroup.add_mapfile(map_gz_filepath)
-        if mapgroup.model_complex:
-            # Get latest position of model complex
-            [deep_comp] = await self.client.request_complexes([mapgroup.model_complex.index])
-            if not deep_comp:
-                Logs.warning("model complex was deleted.")
+        try:
+            plan = self.plan_map_memory(map_gz_filepath)
+        except InsufficientMemory as e:
+            Logs.warning(str(e))
+            await self.client.send_notification(enums.NotificationTypes.error, str(e))
+            raise
+        # Loads that don't fit in memory alongside those of other sessions wait for them to finish.
+        async with mapgroup.lock, self.memory_budget.reserve(plan.peak if plan else 0):
+            mapgroup.mesh_stride = plan.stride if plan else 1
+            if isovalue:
+                Logs.debug(f"Setting isovalue to {isovalue}")
+                mapgroup.isovalue = isovalue
+            mapgroup.metadata = metadata
+            shared_map = None
+            if not map_manager:
+                loop = asyncio.get_event_loop()
+                source_hash = source_hash or await loop.run_in_executor(None, hash_file, map_gz_filepath)
+                map_manager = shared_map = await self._attach_shared_map(map_gz_filepath, source_hash)
+            # Released after attaching, so reloading the same map doesn't evict it from the store.
+            self._release_shared_map(mapgroup)
+            mapgroup.shared_map = shared_map
+            await mapgroup.add_mapfile(map_gz_filepath, map_manager)
+            prefetched_model = await fitted_model if fitted_model else None
+            if prefetched_model:
+                model_filepath, model_comp, model = prefetched_model
+                await self._add_model_complex(mapgroup, model_filepath, model_comp, model)
+            elif mapgroup.model_complex:
+                # Get latest position of model complex
+                [deep_comp] = await self.client.request_complexes([mapgroup.model_complex.index])
+                if not deep_comp:
+                    Logs.warning("model complex was deleted.")
+                else:
+                    mapgroup.add_model_complex(deep_comp)
+            if mesh or mapgroup.has_model():
+                # The fitted model can change the map model manager's map, so those meshes aren't cached.
+                await mapgroup.generate_full_mesh(mesh, memory_reserved=True)
             else:
-                mapgroup.add_model_complex(deep_comp)
-        await mapgroup.generate_full_mesh()
-        # Rename Mapgroup after the new map
-        mapgroup.group_name = Path(map_gz_filepath).stem
-        await self.menu.render(selected_mapgroup=mapgroup)
+                await self._generate_cached_mesh(mapgroup, map_gz_filepath, source_hash)
+            # Rename Mapgroup after the new map
+            mapgroup.group_name = Path(map_gz_filepath).stem
+        await self.menu.render(selected_mapgroup=mapgroup if select_on_render else selected_mapgroup)
+        # Checkpoint before returning, while downloaded files still exist.
+        await self.checkpoint_session()
+        return mapgroup
+
+    def plan_map_memory(self, mapfile):
+        """MemoryPlan for loading and meshing mapfile, or None if its header can't be read.
+
+        Raises InsufficientMemory if the map can't be loaded within the memory budget.
+        """
+        header = MRCHeader.read(mapfile)
+        if not header:
+            return None
+        return self.memory_budget.plan(header.dimensions, MRC_MODE_BYTES[header.mode])
+
+    async def _generate_cached_mesh(self, mapgroup: MapGroup, mapfile, source_hash=None):
+        # Caller must hold mapgroup.lock
+        loop = asyncio.get_event_loop()
+        source_hash = source_hash or await loop.run_in_executor(None, hash_file, mapfile)
+        stats = self.map_cache.get_stats(source_hash) or (mapgroup.shared_map and mapgroup.shared_map.stats)
+        if mapgroup.isovalue is None and stats:
+            mapgroup.isovalue = stats['default_isovalue']
+        artifact = None
+        if mapgroup.isovalue is not None:
+            artifact = self.map_cache.get_mesh(source_hash, mapgroup.isovalue)
+        if artifact and not MapMesh.is_mesh_artifact_current(artifact, source_hash):
+            artifact = None
+        if artifact:
+            Logs.message(f"Using cached mesh for {Path(mapfile).name}")
+        stats = await mapgroup.generate_full_mesh(artifact and artifact.to_mesh(), stats)
+        # Downsampled meshes aren't cached, so hosts with more memory mesh the full map.
+        if stats and not artifact and mapgroup.mesh_stride == 1:
+            artifact = MapMesh.create_mesh_artifact(mapgroup.mesh, mapgroup.isovalue, source_hash)
+            await loop.run_in_executor(None, self._put_in_map_cache, artifact, stats)
+
+    def _put_in_map_cache(self, artifact, stats):
+        try:
+            self.map_cache.put_stats(artifact.source_hash, stats)
+            self.map_cache.put_mesh(artifact)
+        except OSError:
+            Logs.warning("Could not write to the map cache", exc_info=True)
+
+    async def _attach_shared_map(self, mapfile, source_hash):
+        """Map from the map store, or None if it couldn't be added to the store."""
+        loop = asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(None, self.map_store.attach, mapfile, source_hash)
+        except OSError:
+            Logs.warning("Could not add map to the map store", exc_info=True)
+            return None
+
+    def _release_shared_map(self, mapgroup: MapGroup):
+        if mapgroup.shared_map:
+            self.map_store.release(mapgroup.shared_map)
+            mapgroup.shared_map = None
 
     async def delete_mapgroup(self, map_group: MapGroup, current_comp_indices=None):
-        if not current_comp_indices:
+        map_group.cancel_mesh_job()
+        if current_comp_indices is None:
             current_comp_list = await self.client.request_complex_list()
             current_comp_indices = [comp.index for comp in current_comp_list]
         map_comp = map_group.map_mesh.complex
@@ -143,13 +322,80 @@ class CryoEM(NanomePlugin):
             self.groups.remove(map_group)
         except ValueError:
             Logs.warning("Tried to delete a map group that doesn't exist.")
+        self._release_shared_map(map_group)
 
-        # Delete map file if it exists.
-        if map_group.mapfile and os.path.exists(map_group.mapfile):
-            os.remove(map_group.mapfile)
+        # Delete map file if it exists, unless it is shared through the map cache.
+        mapfile = map_group.mapfile
+        if mapfile and os.path.exists(mapfile) and not self.map_cache.contains(mapfile):
+            os.remove(mapfile)
         selected_mapgroup_name = self.menu.get_selected_mapgroup()
         mapgroup = self.get_group(selected_mapgroup_name)
         await self.menu.render(selected_mapgroup=mapgroup)
+        await self.checkpoint_session()
+
+    async def checkpoint_session(self):
+        """Save the state and meshes of groups with a map, so they can be restored after a restart."""
+        if not self.session_checkpoint:
+            return
+        groups = [
+            (group.get_state(), group.mapfile, group.model_file, group.mesh)
+            for group in self.groups if group.has_map()
+        ]
+        loop = asyncio.get_event_loop()
+        # Serialized, so an older checkpoint can't overwrite a newer one.
+        async with self._checkpoint_lock:
+            try:
+                await loop.run_in_executor(None, self.session_checkpoint.save, groups)
+            except OSError:
+                Logs.warning("Could not checkpoint session", exc_info=True)
+
+    async def restore_session(self):
+        """Rebuild the groups saved by checkpoint_session, from their saved maps and meshes."""
+        start_time = time.time()
+        comp_list = await self.client.request_complex_list()
+        comp_indices = [comp.index for comp in comp_list]
+        loop = asyncio.get_event_loop()
+        states = await loop.run_in_executor(None, self.session_checkpoint.load, comp_indices)
+        if not states:
+            return
+        # Replace the empty default group
+        self.groups = [group for group in self.groups if group.has_map() or group.model_complex]
+        for state in states:
+            try:
+                await self._restore_mapgroup(state, comp_indices)
+            except Exception:
+                Logs.warning(f"Could not restore {state['group_name']}", exc_info=True)
+        if not self.groups:
+            self.add_mapgroup()
+        elapsed_time = round(time.time() - start_time, 2)
+        Logs.message(
+            f"Restored {len(self.groups)} MapGroups in {elapsed_time} seconds",
+            extra={"elapsed_time": elapsed_time})
+        await self.menu.render()
+
+    async def _restore_mapgroup(self, state, comp_indices):
+        loop = asyncio.get_event_loop()
+        mapgroup = MapGroup(self)
+        source_hash = await loop.run_in_executor(None, hash_file, state['mapfile'])
+        mapgroup.shared_map = await self._attach_shared_map(state['mapfile'], source_hash)
+        map_manager = mapgroup.shared_map or await loop.run_in_executor(
+            None, MapMesh.load_mapfile, state['mapfile'])
+        mesh = await loop.run_in_executor(None, self.session_checkpoint.load_mesh, state['mesh_file'])
+        if state['model_file']:
+            model = await loop.run_in_executor(None, MapGroup.load_model, state['model_file'])
+            mapgroup.add_pdb(state['model_file'], model)
+        # Complexes outlive the plugin, so reuse the model complex and replace the old map complex.
+        model_comp = None
+        if state['model_complex_index'] in comp_indices:
+            [model_comp] = await self.client.request_complexes([state['model_complex_index']])
+        old_map_comp = None
+        if state['map_complex_index'] in comp_indices:
+            [old_map_comp] = await self.client.request_complexes([state['map_complex_index']])
+            await self.client.remove_from_workspace([old_map_comp])
+        async with mapgroup.lock:
+            self.groups.append(mapgroup)
+            await mapgroup.restore_state(
+                state, state['mapfile'], map_manager, mesh, model_comp, old_map_comp)
 
     @staticmethod
     def remove_hydrogens(comp):
@@ -165,16 +411,36 @@ class CryoEM(NanomePlugin):
         return self.client.request_futs
 
     async def on_complex_added_removed(self):
-        # Check each mapgroup and delete any where the complex was deleted.
-        comp_list = await self.client.request_complex_list()
-        comp_indices = [cmp.index for cmp in comp_list]
-        for mapgroup in self.groups:
-            has_model = bool(mapgroup.model_complex) and mapgroup.model_complex.index in comp_indices
-            has_map = mapgroup.map_complex and mapgroup.map_complex.index in comp_indices
-            if not has_model and not has_map:
+        # Bulk loads add complexes in bursts, so changes are checked in batches.
+        self._workspace_changed = True
+        if not self._workspace_sync_task or self._workspace_sync_task.done():
+            self._workspace_sync_task = asyncio.create_task(self.sync_workspace())
+
+    async def sync_workspace(self, delay=WORKSPACE_SYNC_DELAY):
+        """Delete the groups whose complexes were all removed from the workspace.
+
+        Changes made within delay seconds of the first one are checked together,
+        with one complex list request. Groups that haven't added a complex
+        to the workspace yet, like groups still loading, are kept.
+        """
+        while self._workspace_changed:
+            await asyncio.sleep(delay)
+            # Changes made from here on are checked in the next batch.
+            self._workspace_changed = False
+            comp_list = await self.client.request_complex_list()
+            comp_indices = {comp.index for comp in comp_list}
+            group_complexes = {
+                comp.index: mapgroup for mapgroup in self.groups
+                for comp in [mapgroup.map_complex, mapgroup.model_complex]
+                if comp and comp.index != -1
+            }
+            # A group is only deleted once none of its complexes are left.
+            kept_groups = {id(mapgroup) for index, mapgroup in group_complexes.items() if index in comp_indices}
+            removed_groups = {
+                id(mapgroup): mapgroup for mapgroup in group_complexes.values() if id(mapgroup) not in kept_groups
+            }
+            for mapgroup in removed_groups.values():
+                if mapgroup not in self.groups:
+                    continue
                 await self.delete_mapgroup(mapgroup, comp_indices)
-                # Close menu if it's open
-                for menu in self.ui_manager._menus:
-                    if menu.title.startswith(mapgroup.group_name):
-                        menu.enabled = False
-                        self.client.update_menu(menu)
+                self.menu.close_edit_mesh_menu(mapgroup)
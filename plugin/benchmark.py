@@ -0,0 +1,355 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import struct
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+
+import numpy as np
+from nanome.api import structure
+from nanome.util import Logs
+
+from . import metrics
+from .CryoEM import CryoEM
+from .map_cache import MapCache
+from .map_store import MapStore
+from .metrics import MetricsRegistry
+from .models import MapGroup, MapMesh
+from .session_state import SessionCheckpoint
+from .utils import MRC_HEADER_SIZE, get_extension
+
+__all__ = ["compare_results", "run_benchmarks", "write_mrc"]
+
+# Slowdown over the baseline, as a fraction, reported as a regression.
+BENCHMARK_THRESHOLD = float(os.environ.get('BENCHMARK_THRESHOLD', 0.25))
+# Slowdowns of fewer seconds than this are timing noise, whatever the fraction.
+BENCHMARK_MIN_SLOWDOWN = 0.05
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests', 'fixtures')
+
+# name -> (map file, model file). Synthetic cases are generated before they run.
+CASES = {
+    'emd_8216': (os.path.join(FIXTURES_DIR, 'emd_8216.map.gz'), os.path.join(FIXTURES_DIR, '7c4u.pdb')),
+    '1fsv': (None, os.path.join(FIXTURES_DIR, '1fsv.cif')),
+    'blobs_256': (256, 256),
+    'blobs_512': (512, 512),
+}
+# 512³ maps take minutes, and over 2GB of memory, so they only run when asked for.
+DEFAULT_CASES = ['emd_8216', '1fsv', 'blobs_256']
+# Spans inside generate_mesh_from_map_manager, recorded as their own stages.
+MESH_SPANS = ('marching_cubes', 'coordinate_transform', 'simplify')
+COLOR_SCHEMES = {
+    'color_element': MapGroup.color_by_element,
+    'color_bfactor': MapGroup.color_by_bfactor,
+    'color_chain': MapGroup.color_by_chain,
+}
+
+# Blobs per synthetic map, their width in voxels, and atoms per blob in the synthetic model.
+BLOB_COUNT = 48
+BLOB_SIGMA = 3.0
+BLOB_ATOMS = ('N', 'CA', 'C', 'O', 'CB', 'H', 'HA', 'HB1', 'HB2', 'HB3')
+
+Regression = namedtuple('Regression', ['case', 'stage', 'baseline_seconds', 'seconds', 'threshold'])
+
+
+def blob_centers(size, seed=0):
+    """Centers of the synthetic blobs, in voxels, away from the edges of the map."""
+    rng = np.random.default_rng(seed)
+    margin = int(BLOB_SIGMA * 4) + 1
+    return rng.uniform(margin, size - margin, (BLOB_COUNT, 3))
+
+
+def gaussian_blob_map(size, seed=0):
+    """Cubic float32 map of Gaussian blobs, indexed [z, y, x] like MRC sections."""
+    data = np.zeros((size, size, size), dtype=np.float32)
+    radius = int(BLOB_SIGMA * 4)
+    offsets = np.arange(-radius, radius + 1)
+    for center in blob_centers(size, seed):
+        x, y, z = np.round(center).astype(int)
+        # Each blob only reaches a few sigma, so it is added to its own neighbourhood.
+        dz, dy, dx = np.meshgrid(offsets, offsets, offsets, indexing='ij')
+        blob = np.exp(-(dx ** 2 + dy ** 2 + dz ** 2) / (2 * BLOB_SIGMA ** 2)).astype(np.float32)
+        data[z - radius:z + radius + 1, y - radius:y + radius + 1, x - radius:x + radius + 1] += blob
+    return data
+
+
+def write_mrc(path, data, voxel_size=1.0):
+    """Write a float32 array indexed [z, y, x] as an MRC map, with its origin at 0."""
+    nz, ny, nx = data.shape
+    header = struct.pack(
+        '<10i6f3i3f2i', nx, ny, nz, 2, 0, 0, 0, nx, ny, nz,
+        nx * voxel_size, ny * voxel_size, nz * voxel_size, 90.0, 90.0, 90.0,
+        1, 2, 3, float(data.min()), float(data.max()), float(data.mean()), 1, 0)
+    header += bytes(100) + struct.pack('<3f', 0.0, 0.0, 0.0) + b'MAP ' + bytes([0x44, 0x44, 0, 0])
+    header += struct.pack('<fi', float(data.std()), 0)
+    header += bytes(MRC_HEADER_SIZE - len(header))
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write(np.ascontiguousarray(data, dtype='<f4').tobytes())
+
+
+def write_blob_model(path, size, seed=0):
+    """Write a PDB model with a hydrogenated residue at each blob, spread over four chains."""
+    rng = np.random.default_rng(seed + 1)
+    lines = []
+    serial = 1
+    for index, center in enumerate(blob_centers(size, seed)):
+        chain = 'ABCD'[index % 4]
+        bfactor = rng.uniform(10, 90)
+        for name in BLOB_ATOMS:
+            x, y, z = center + rng.normal(0, 1.0, 3)
+            lines.append(
+                f'ATOM  {serial:5d}  {name:<3} ALA {chain}{index + 1:4d}    '
+                f'{x:8.3f}{y:8.3f}{z:8.3f}{1.0:6.2f}{bfactor:6.2f}          {name[0]:>2}')
+            serial += 1
+    lines.append('END')
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def prepare_case(name, temp_dir):
+    """Map and model files of a case, generating them for synthetic cases."""
+    mapfile, modelfile = CASES[name]
+    if not isinstance(mapfile, int):
+        return mapfile, modelfile
+    size = mapfile
+    Logs.message(f"Generating {size}³ map of Gaussian blobs")
+    mapfile = os.path.join(temp_dir, f'{name}.mrc')
+    write_mrc(mapfile, gaussian_blob_map(size))
+    modelfile = os.path.join(temp_dir, f'{name}.pdb')
+    write_blob_model(modelfile, size)
+    return mapfile, modelfile
+
+
+def load_complex(modelfile):
+    if get_extension(modelfile) == 'pdb':
+        return structure.Complex.io.from_pdb(path=modelfile)
+    return structure.Complex.io.from_mmcif(path=modelfile)
+
+
+def timed(fn, *args):
+    """Run fn, returning its result, its duration, and the durations of the spans inside it."""
+    stage_registry = MetricsRegistry(report=False)
+    previous_registry, metrics.registry = metrics.registry, stage_registry
+    try:
+        start_time = time.perf_counter()
+        result = fn(*args)
+        seconds = time.perf_counter() - start_time
+    finally:
+        metrics.registry = previous_registry
+    span_seconds = {}
+    for (name, labels), histogram in stage_registry.histograms.items():
+        if name == 'cryoem_stage_seconds':
+            stage = dict(labels)['stage']
+            span_seconds[stage] = span_seconds.get(stage, 0) + histogram.sum
+    return result, seconds, span_seconds
+
+
+class OfflineClient:
+    """Stands in for the Nanome session client, so sessions can be checkpointed and restored without Nanome."""
+
+    def __init__(self):
+        self._indices = itertools.count(1)
+
+    async def add_to_workspace(self, comps):
+        for comp in comps:
+            comp.index = next(self._indices)
+        return comps
+
+    async def shapes_upload_multiple(self, meshes):
+        return meshes
+
+    async def request_complex_list(self):
+        return []
+
+    def __getattr__(self, name):
+        # Requests whose responses aren't used. Some aren't awaited, so they return a finished future.
+        def request(*args, **kwargs):
+            future = asyncio.get_event_loop().create_future()
+            future.set_result(None)
+            return future
+        return request
+
+
+def offline_plugin(cache_dir):
+    plugin = CryoEM()
+    plugin.client = OfflineClient()
+    plugin.map_cache = MapCache(cache_dir)
+    plugin.map_store = MapStore(os.path.join(cache_dir, 'store'))
+    plugin.session_checkpoint = SessionCheckpoint(
+        'benchmark', 1, plugin.map_cache, os.path.join(cache_dir, 'sessions'))
+    return plugin
+
+
+async def checkpoint_and_restore(mapfile, modelfile, map_manager, mesh, isovalue, temp_dir):
+    """Seconds to checkpoint a session with the case's MapGroup, and to restore it in a restarted plugin."""
+    with tempfile.TemporaryDirectory(dir=temp_dir) as cache_dir:
+        plugin = offline_plugin(cache_dir)
+        [map_group] = plugin.groups
+        map_group.isovalue = isovalue
+        map_group.add_pdb(modelfile)
+        await map_group.add_mapfile(mapfile, map_manager)
+        await map_group.map_mesh.load(map_manager, isovalue, map_group.opacity, mesh=mesh)
+        start_time = time.perf_counter()
+        await plugin.checkpoint_session()
+        checkpoint_seconds = time.perf_counter() - start_time
+        plugin.session_checkpoint.close()
+        plugin.temp_dir.cleanup()
+
+        # The restarted plugin is given the same session
+        restarted = offline_plugin(cache_dir)
+        start_time = time.perf_counter()
+        await restarted.restore_session()
+        restore_seconds = time.perf_counter() - start_time
+        restarted.map_store.release_all()
+        restarted.session_checkpoint.close()
+        restarted.temp_dir.cleanup()
+    return checkpoint_seconds, restore_seconds
+
+
+def run_case(name, temp_dir, repeat=3):
+    """Best of repeat durations of each stage of a case, in seconds."""
+    mapfile, modelfile = prepare_case(name, temp_dir)
+    timings = {}
+
+    def record(stage, seconds):
+        timings[stage] = min(timings.get(stage, seconds), seconds)
+
+    for _ in range(repeat):
+        comp, seconds, _ = timed(load_complex, modelfile)
+        record('load_model', seconds)
+        _, seconds, _ = timed(CryoEM.remove_hydrogens, load_complex(modelfile))
+        record('remove_hydrogens', seconds)
+        if not mapfile:
+            continue
+
+        map_manager, seconds, _ = timed(MapMesh.load_mapfile, mapfile)
+        record('load', seconds)
+        stats, seconds, _ = timed(MapMesh.compute_map_stats, map_manager)
+        record('stats', seconds)
+        mesh, seconds, span_seconds = timed(
+            MapMesh.generate_mesh_from_map_manager, map_manager, stats['default_isovalue'])
+        record('mesh', seconds)
+        for stage in MESH_SPANS:
+            record(stage, span_seconds[stage])
+        _, seconds, _ = timed(
+            MapMesh.limit_view, mesh.vertices, mesh.normals, mesh.triangles, list(comp.residues))
+        record('limit_view', seconds)
+
+        map_mesh = MapMesh(None)
+        map_mesh.mesh = mesh
+        for stage, color_by in COLOR_SCHEMES.items():
+            _, seconds, _ = timed(color_by, map_mesh, comp)
+            record(stage, seconds)
+
+        map_group = MapGroup(None)
+        map_group.map_mesh.map_manager = map_manager
+        histogram_file, seconds, _ = timed(map_group.generate_histogram, temp_dir)
+        os.remove(histogram_file)
+        record('histogram', seconds)
+
+        checkpoint_seconds, restore_seconds = asyncio.run(checkpoint_and_restore(
+            mapfile, modelfile, map_manager, mesh, stats['default_isovalue'], temp_dir))
+        record('checkpoint', checkpoint_seconds)
+        record('restore', restore_seconds)
+    return {stage: round(seconds, 4) for stage, seconds in timings.items()}
+
+
+def run_benchmarks(cases=DEFAULT_CASES, repeat=3):
+    """Benchmark results of cases, with the machine they ran on."""
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for name in cases:
+            Logs.message(f"Benchmarking {name}")
+            results[name] = run_case(name, temp_dir, repeat)
+    return {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def compare_results(results, baseline, threshold=BENCHMARK_THRESHOLD, stage_thresholds=None,
+                    min_slowdown=BENCHMARK_MIN_SLOWDOWN):
+    """Stages slower than in baseline by more than their threshold, as a list of Regression.
+
+    stage_thresholds: Optional stage -> threshold, overriding threshold for noisy or critical stages.
+    Cases and stages missing from either side are skipped.
+    """
+    stage_thresholds = stage_thresholds or {}
+    regressions = []
+    for case, timings in results['results'].items():
+        baseline_timings = baseline['results'].get(case, {})
+        for stage, seconds in timings.items():
+            baseline_seconds = baseline_timings.get(stage)
+            if baseline_seconds is None:
+                continue
+            stage_threshold = stage_thresholds.get(stage, threshold)
+            slowdown = seconds - baseline_seconds
+            if slowdown > min_slowdown and slowdown > baseline_seconds * stage_threshold:
+                regressions.append(Regression(case, stage, baseline_seconds, seconds, stage_threshold))
+    return regressions
+
+
+def parse_stage_thresholds(values):
+    stage_thresholds = {}
+    for value in values:
+        stage, _, threshold = value.partition('=')
+        stage_thresholds[stage] = float(threshold)
+    return stage_thresholds
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time the stages of loading, meshing and coloring maps, and compare them to a baseline.')
+    parser.add_argument(
+        'cases', nargs='*', help=f"Cases to run, from {', '.join(CASES)}. Default: {' '.join(DEFAULT_CASES)}")
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each case, the fastest run is kept')
+    parser.add_argument('--output', help='Write the results to this JSON file, e.g. to use as a baseline')
+    parser.add_argument('--baseline', help='JSON results to compare to. Exits with 1 on regressions')
+    parser.add_argument(
+        '--threshold', type=float, default=BENCHMARK_THRESHOLD,
+        help='Slowdown over the baseline reported as a regression, as a fraction')
+    parser.add_argument(
+        '--stage-threshold', action='append', default=[], metavar='STAGE=FRACTION',
+        help='Threshold of one stage, e.g. histogram=0.5. Can be repeated')
+    args = parser.parse_args()
+    unknown_cases = set(args.cases) - set(CASES)
+    if unknown_cases:
+        parser.error(f"Unknown cases: {', '.join(sorted(unknown_cases))}")
+    try:
+        stage_thresholds = parse_stage_thresholds(args.stage_threshold)
+    except ValueError:
+        parser.error('--stage-threshold must be STAGE=FRACTION')
+
+    results = run_benchmarks(args.cases or DEFAULT_CASES, args.repeat)
+    for case, timings in results['results'].items():
+        Logs.message(f"{case}: " + ', '.join(f'{stage} {seconds}s' for stage, seconds in timings.items()))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        Logs.message(f"Wrote results to {args.output}")
+    if not args.baseline:
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare_results(results, baseline, args.threshold, stage_thresholds)
+    for regression in regressions:
+        Logs.error(
+            f"{regression.case} {regression.stage}: {regression.seconds}s, "
+            f"{regression.baseline_seconds}s in baseline (threshold {regression.threshold:.0%})")
+    if regressions:
+        sys.exit(1)
+    Logs.message(f"No regressions against {args.baseline}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import functools
+import os
+import time
+from collections import Counter
+from nanome.util import Logs
+
+from .metrics import registry
+
+__all__ = ["ProfiledClient"]
+
+# Profile the plugin's requests to Nanome.
+PROFILE_CLIENT = os.environ.get('PROFILE_CLIENT', 'false').lower() in ('1', 'true', 'yes')
+# A call starting within this many seconds of the previous call to the same method
+# finishing, with none in flight, was made serially and could have been batched.
+SERIAL_CALL_WINDOW = 0.05
+
+# Requests that wait for a response from Nanome -> function returning the payload size of a call.
+PROFILED_METHODS = {
+    'request_complexes': lambda id_list: len(id_list),
+    'request_complex_list': lambda: 0,
+    'add_to_workspace': lambda complex_list: len(complex_list),
+    'update_structures_deep': lambda structures: len(structures),
+    'shapes_upload_multiple': lambda shape_list: sum(len(getattr(shape, 'vertices', ())) // 3 for shape in shape_list),
+    'request_presenter_info': lambda: 0,
+}
+# Methods whose calls can be combined into one, because they take a list.
+BATCHABLE_METHODS = {'request_complexes', 'add_to_workspace', 'update_structures_deep', 'shapes_upload_multiple'}
+
+
+class ProfiledClient:
+    """Wraps the session client, and records the latency and payload size of requests to Nanome.
+
+    Latencies go to cryoem_rpc_seconds{method=...}, and payload sizes to cryoem_rpc_payload:
+    complexes sent or requested, or vertices for shapes_upload_multiple. Calls to batchable methods
+    made back to back are recorded in cryoem_rpc_serial_gap_seconds. Other attributes are passed
+    through to the client.
+    """
+
+    def __init__(self, client):
+        object.__setattr__(self, '_client', client)
+        object.__setattr__(self, 'calls', Counter())
+        object.__setattr__(self, 'serial_calls', Counter())
+        # method -> calls in flight, and end time of the last call
+        object.__setattr__(self, '_in_flight', Counter())
+        object.__setattr__(self, '_last_end', {})
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name not in PROFILED_METHODS:
+            return attr
+        return functools.partial(self._profile, name, attr)
+
+    def __setattr__(self, name, value):
+        # e.g. the SDK setting the client's reader and writer
+        setattr(self._client, name, value)
+
+    async def _profile(self, method_name, method, *args, **kwargs):
+        try:
+            payload = PROFILED_METHODS[method_name](*args, **kwargs)
+        except TypeError:
+            payload = 0
+        self._check_serial(method_name)
+        self.calls[method_name] += 1
+        self._in_flight[method_name] += 1
+        start_time = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            end_time = time.perf_counter()
+            self._in_flight[method_name] -= 1
+            self._last_end[method_name] = end_time
+            registry.observe('cryoem_rpc_seconds', end_time - start_time, method=method_name)
+            registry.observe('cryoem_rpc_payload', payload, method=method_name)
+
+    def _check_serial(self, method_name):
+        last_end = self._last_end.get(method_name)
+        if method_name not in BATCHABLE_METHODS or last_end is None or self._in_flight[method_name]:
+            return
+        gap = time.perf_counter() - last_end
+        if gap < SERIAL_CALL_WINDOW:
+            self.serial_calls[method_name] += 1
+            registry.observe('cryoem_rpc_serial_gap_seconds', gap, method=method_name)
+            Logs.debug(f"{method_name} called serially, could be batched", extra={'gap': round(gap, 4)})
+
+    def log_summary(self):
+        """Log the calls made per method, and how many could have been batched with the previous one."""
+        if not self.calls:
+            return
+        summary = ', '.join(
+            f'{name}: {count}' + (f' ({self.serial_calls[name]} serial)' if self.serial_calls[name] else '')
+            for name, count in self.calls.most_common())
+        Logs.message(f"Requests to Nanome: {summary}", extra=dict(self.calls))
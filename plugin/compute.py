@@ -0,0 +1,363 @@
+import asyncio
+import enum
+import itertools
+import os
+import pickle
+import socket
+import struct
+import tempfile
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from nanome.util import Logs
+from .metrics import registry
+
+__all__ = ["ComputeClient", "ComputeError", "ComputeService", "JobPriority"]
+
+COMPUTE_SOCKET = os.environ.get(
+    'COMPUTE_SOCKET', os.path.join(tempfile.gettempdir(), f'cryoem-{os.getuid()}', 'compute.sock'))
+COMPUTE_WORKERS = int(os.environ.get('COMPUTE_WORKERS', os.cpu_count() or 1))
+FRAME_HEADER = struct.Struct('!I')
+# pid, uid, gid of SO_PEERCRED
+PEER_CREDENTIALS = struct.Struct('3i')
+
+
+class JobPriority(enum.IntEnum):
+    """Lower values run first."""
+    INTERACTIVE = 0
+    BULK = 1
+
+
+def mesh_job(mapfile, source_hash, isovalue, stride=1):
+    """Full map mesh at isovalue, as (vertices, normals, triangles) arrays."""
+    from .map_store import MapStore
+    from .models import MapMesh
+    store = MapStore()
+    shared_map = store.attach(mapfile, source_hash)
+    try:
+        mesh = MapMesh.generate_mesh_from_map_manager(shared_map, isovalue, stride=stride)
+    finally:
+        store.release(shared_map)
+    return mesh.vertices, mesh.normals, mesh.triangles
+
+
+# Full map meshing, including its simplify stage, is the only job long enough to be worth sending here.
+# Cropping and coloring work on the session's mesh and model, which would cost about as much to send.
+JOBS = {
+    'mesh': mesh_job,
+}
+
+
+def run_job(name, args):
+    """Run a job in a worker process. Returns its result, and the worker's metrics observations."""
+    return JOBS[name](*args), registry.take_unreported()
+
+
+async def read_frame(reader: asyncio.StreamReader):
+    header = await reader.readexactly(FRAME_HEADER.size)
+    [length] = FRAME_HEADER.unpack(header)
+    return pickle.loads(await reader.readexactly(length))
+
+
+def write_frame(writer: asyncio.StreamWriter, message):
+    data = pickle.dumps(message)
+    writer.write(FRAME_HEADER.pack(len(data)) + data)
+
+
+def make_private_dir(path):
+    """Create the socket's directory, and check that only this user can access it.
+
+    Frames are pickled, so anyone able to connect could run code in the service or its sessions.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    stat = os.stat(path)
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+        raise PermissionError(f"{path} must only be accessible by its owner to hold the compute socket")
+
+
+def peer_uid(writer: asyncio.StreamWriter):
+    """User id of the process at the other end of a Unix socket, or None where the platform doesn't tell."""
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    sock = writer.get_extra_info('socket')
+    credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, PEER_CREDENTIALS.size)
+    _, uid, _ = PEER_CREDENTIALS.unpack(credentials)
+    return uid
+
+
+def is_trusted_peer(writer: asyncio.StreamWriter):
+    """Whether the other end of a connection runs as this user."""
+    uid = peer_uid(writer)
+    return uid is None or uid == os.getuid()
+
+
+class Job:
+
+    def __init__(self, session, job_id, name, args, priority):
+        self.session = session
+        self.job_id = job_id
+        self.name = name
+        self.args = args
+        self.priority = JobPriority(priority)
+        self.cancelled = False
+
+
+class ComputeService:
+    """Process pool shared by every session process on this host, started by run.py.
+
+    Sessions submit jobs over a Unix socket with a ComputeClient. Queued jobs run
+    by priority, and round robin between sessions within a priority, so one session's
+    bulk loads don't hold up the rest. A session's queued jobs are dropped when it
+    cancels them or disconnects, while running jobs finish and their results are discarded.
+
+    The socket is in a directory private to the plugin's user, and connections from
+    processes of other users are closed.
+    """
+
+    def __init__(self, socket_path=COMPUTE_SOCKET, max_workers=COMPUTE_WORKERS):
+        self.socket_path = socket_path
+        self.max_workers = max_workers
+        self.executor = None
+        self.server = None
+        # priority -> session -> deque of queued jobs
+        self.queues = {priority: OrderedDict() for priority in JobPriority}
+        self.running = set()
+        self.sessions = set()
+        self._session_tasks = set()
+        self._dispatch_task = None
+        self._jobs_available = None
+
+    async def start(self):
+        make_private_dir(os.path.dirname(self.socket_path))
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        self._jobs_available = asyncio.Event()
+        self._dispatch_task = asyncio.create_task(self._dispatch())
+        self.server = await asyncio.start_unix_server(self._handle_session, path=self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        Logs.message(f"Compute service running {self.max_workers} workers on {self.socket_path}")
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            # Closing the connections ends their session handlers.
+            for session in list(self.sessions):
+                session.close()
+            await asyncio.gather(*self._session_tasks)
+            await self.server.wait_closed()
+        if self._dispatch_task:
+            self._dispatch_task.cancel()
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def queue_depth(self):
+        """Number of queued jobs by priority name, plus running jobs and connected sessions."""
+        depth = {
+            priority.name: sum(len(jobs) for jobs in queue.values())
+            for priority, queue in self.queues.items()
+        }
+        depth['running'] = len(self.running)
+        depth['sessions'] = len(self.sessions)
+        return depth
+
+    def submit(self, job: Job):
+        self.queues[job.priority].setdefault(job.session, deque()).append(job)
+        Logs.debug(f"Queued {job.name} job", extra=self.queue_depth())
+        self._jobs_available.set()
+
+    def cancel(self, session, job_id=None):
+        """Drop queued jobs of session, all of them if job_id is None."""
+        for queue in self.queues.values():
+            jobs = queue.get(session)
+            if not jobs:
+                continue
+            for job in [job for job in jobs if job_id is None or job.job_id == job_id]:
+                job.cancelled = True
+                jobs.remove(job)
+            if not jobs:
+                del queue[session]
+        for job in self.running:
+            if job.session == session and (job_id is None or job.job_id == job_id):
+                job.cancelled = True
+
+    def next_job(self):
+        for queue in self.queues.values():
+            if not queue:
+                continue
+            # Take from the first session in line, and move it to the back.
+            session, jobs = next(iter(queue.items()))
+            job = jobs.popleft()
+            del queue[session]
+            if jobs:
+                queue[session] = jobs
+            return job
+        return None
+
+    async def _dispatch(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await self._jobs_available.wait()
+            self._jobs_available.clear()
+            while len(self.running) < self.max_workers:
+                job = self.next_job()
+                if not job:
+                    break
+                self.running.add(job)
+                future = loop.run_in_executor(self.executor, run_job, job.name, job.args)
+                future.add_done_callback(lambda fut, job=job: self._job_done(job, fut))
+
+    def _job_done(self, job: Job, future: asyncio.Future):
+        self.running.discard(job)
+        self._jobs_available.set()
+        if future.cancelled():
+            return
+        result = None
+        if not future.exception():
+            result, observations = future.result()
+            registry.merge(observations)
+        writer = job.session
+        if job.cancelled or writer.is_closing():
+            return
+        if future.exception():
+            Logs.warning(f"{job.name} job failed", exc_info=future.exception())
+            write_frame(writer, {'id': job.job_id, 'error': repr(future.exception())})
+        else:
+            write_frame(writer, {'id': job.job_id, 'result': result})
+
+    async def _handle_session(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if not is_trusted_peer(writer):
+            Logs.warning(f"Closed compute connection from user {peer_uid(writer)}")
+            writer.close()
+            return
+        # The session's writer identifies its jobs.
+        session = writer
+        self.sessions.add(session)
+        self._session_tasks.add(asyncio.current_task())
+        # Session labels of the metrics reported on this connection, whose series end with it.
+        metrics_sessions = set()
+        try:
+            while True:
+                message = await read_frame(reader)
+                if message['type'] == 'submit':
+                    self.submit(Job(session, message['id'], message['job'], message['args'], message['priority']))
+                elif message['type'] == 'cancel':
+                    self.cancel(session, message['id'])
+                elif message['type'] == 'stats':
+                    write_frame(writer, {'id': message['id'], 'result': self.queue_depth()})
+                elif message['type'] == 'metrics':
+                    registry.merge(message['observations'])
+                    metrics_sessions.update(
+                        labels['session'] for _, _, labels in message['observations'] if 'session' in labels)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            self._session_tasks.discard(asyncio.current_task())
+            self.cancel(session)
+            for session_label in metrics_sessions:
+                registry.remove_series(session=session_label)
+            writer.close()
+
+
+class ComputeError(Exception):
+    """A job failed in the compute service."""
+
+
+class ComputeClient:
+    """Session side connection to the ComputeService.
+
+    Connects on first use. Callers should fall back to computing locally
+    when the service is not available.
+    """
+
+    def __init__(self, socket_path=COMPUTE_SOCKET):
+        self.socket_path = socket_path
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        self._connect_lock = None
+        self._futures = {}
+        self._job_ids = itertools.count()
+
+    @property
+    def available(self):
+        return self._writer is not None or os.path.exists(self.socket_path)
+
+    async def run(self, job, *args, priority=JobPriority.BULK):
+        """Run a job from JOBS in the compute service, and return its result.
+
+        Cancelling the call cancels the job.
+        Raises ConnectionError if the service can't be reached, and ComputeError if the job fails.
+        """
+        return await self._request({'type': 'submit', 'job': job, 'args': args, 'priority': int(priority)})
+
+    async def queue_depth(self):
+        return await self._request({'type': 'stats'})
+
+    async def report_metrics(self, observations):
+        """Send metrics observations to the service, which serves them on the metrics endpoint."""
+        await self._connect()
+        write_frame(self._writer, {'type': 'metrics', 'observations': observations})
+        await self._writer.drain()
+
+    async def close(self):
+        writer, read_task = self._writer, self._read_task
+        self._reader = self._writer = self._read_task = None
+        if writer:
+            writer.close()
+        if read_task:
+            await read_task
+
+    async def _request(self, message):
+        await self._connect()
+        job_id = next(self._job_ids)
+        future = asyncio.get_event_loop().create_future()
+        self._futures[job_id] = future
+        write_frame(self._writer, dict(message, id=job_id))
+        try:
+            await self._writer.drain()
+            return await future
+        except asyncio.CancelledError:
+            if self._writer and not self._writer.is_closing():
+                write_frame(self._writer, {'type': 'cancel', 'id': job_id})
+            raise
+        finally:
+            self._futures.pop(job_id, None)
+
+    async def _connect(self):
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self._writer:
+                return
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.socket_path)
+            except OSError as e:
+                raise ConnectionError(f"Compute service not available: {e}") from e
+            if not is_trusted_peer(writer):
+                writer.close()
+                raise ConnectionError(f"Compute socket {self.socket_path} is served by another user")
+            self._reader, self._writer = reader, writer
+            self._read_task = asyncio.create_task(self._read_responses())
+
+    async def _read_responses(self):
+        reader = self._reader
+        try:
+            while True:
+                message = await read_frame(reader)
+                future = self._futures.get(message['id'])
+                if not future or future.done():
+                    continue
+                if 'error' in message:
+                    future.set_exception(ComputeError(message['error']))
+                else:
+                    future.set_result(message['result'])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        # The service went away, fail pending requests and reconnect on the next one.
+        self._reader = self._writer = self._read_task = None
+        for future in self._futures.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Compute service disconnected"))
@@ -0,0 +1,216 @@
+import argparse
+import io
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+from nanome.util import Logs
+
+__all__ = ["EMDBCatalog", "EMDBEntry", "parse_header"]
+
+EMDB_CATALOG_PATH = os.environ.get(
+    'EMDB_CATALOG_PATH', os.path.join(tempfile.gettempdir(), 'emdb_catalog.sqlite3'))
+# Number of headers written per transaction when bulk indexing.
+INDEX_BATCH_SIZE = 500
+
+EMDBEntry = namedtuple(
+    'EMDBEntry', ['emdb_id', 'title', 'resolution', 'map_size_kb', 'symmetry', 'pdb_ids'])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    emdb_id TEXT PRIMARY KEY,
+    title TEXT,
+    resolution REAL,
+    map_size_kb INTEGER,
+    symmetry TEXT,
+    pdb_ids TEXT,
+    source_mtime REAL
+);
+CREATE INDEX IF NOT EXISTS idx_entries_resolution ON entries (resolution);
+CREATE INDEX IF NOT EXISTS idx_entries_map_size ON entries (map_size_kb);
+"""
+
+SYMMETRY_TAGS = ('point_group', 'space_group', 'helical_parameters')
+
+
+def parse_header(source):
+    """Stream an EMDB header XML file or file object into an EMDBEntry.
+
+    Only the fields stored in the catalog are kept, and elements are cleared as they
+    are parsed, so large headers don't have to be held in memory.
+    """
+    fields = {'emdb_id': None, 'title': None, 'resolution': None, 'map_size_kb': None, 'symmetry': None}
+    pdb_ids = []
+    path = []
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            path.append(elem.tag)
+            if elem.tag == 'emd':
+                fields['emdb_id'] = elem.attrib.get('emdb_id', '').upper().replace('EMD-', '') or None
+            elif elem.tag == 'map' and fields['map_size_kb'] is None:
+                fields['map_size_kb'] = _to_number(int, elem.attrib.get('size_kbytes'))
+            continue
+        text = (elem.text or '').strip()
+        parent = path[-2] if len(path) > 1 else None
+        if elem.tag == 'title' and parent == 'admin':
+            fields['title'] = text
+        elif elem.tag == 'resolution' and 'final_reconstruction' in path and fields['resolution'] is None:
+            fields['resolution'] = _to_number(float, text)
+        elif elem.tag in SYMMETRY_TAGS and text and fields['symmetry'] is None:
+            fields['symmetry'] = text
+        elif elem.tag == 'pdb_id' and parent == 'pdb_reference':
+            pdb_ids.append(text)
+        path.pop()
+        elem.clear()
+    return EMDBEntry(pdb_ids=pdb_ids, **fields)
+
+
+def _to_number(cast, value):
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class EMDBCatalog:
+    """Local SQLite index of EMDB header metadata.
+
+    Entries are added as headers are downloaded, or in bulk from a mirror of the
+    EMDB `structures` directory with `python -m plugin.emdb_catalog <dir>`.
+    """
+
+    def __init__(self, db_path=EMDB_CATALOG_PATH):
+        self.db_path = db_path
+        # Each session process opens its own connection to the shared file.
+        # Headers are added from executor threads, so access is serialized with a lock.
+        self.conn = sqlite3.connect(db_path, timeout=10, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def add_entry(self, entry: EMDBEntry, source_mtime=None):
+        with self.lock, self.conn:
+            self._insert([entry], [source_mtime])
+
+    def add_header(self, header_content: bytes):
+        """Parse header XML content, and add it to the catalog."""
+        entry = parse_header(io.BytesIO(header_content))
+        self.add_entry(entry, time.time())
+        return entry
+
+    def index_directory(self, header_dir):
+        """Index every EMDB header XML under header_dir.
+
+        Headers that haven't changed since they were last indexed are skipped,
+        so the catalog can be refreshed incrementally. Returns the number of headers parsed.
+        """
+        with self.lock:
+            known_mtimes = dict(self.conn.execute('SELECT emdb_id, source_mtime FROM entries'))
+        entries, mtimes = [], []
+        indexed = 0
+        for header_path in self.find_headers(header_dir):
+            mtime = os.path.getmtime(header_path)
+            emdb_id = self.emdb_id_from_filename(header_path)
+            if emdb_id in known_mtimes and (known_mtimes[emdb_id] or 0) >= mtime:
+                continue
+            try:
+                entry = parse_header(header_path)
+            except ET.ParseError:
+                Logs.warning(f"Could not parse EMDB header {header_path}")
+                continue
+            entries.append(entry)
+            mtimes.append(mtime)
+            if len(entries) >= INDEX_BATCH_SIZE:
+                indexed += self._commit_batch(entries, mtimes)
+        indexed += self._commit_batch(entries, mtimes)
+        return indexed
+
+    def get(self, emdb_id):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT emdb_id, title, resolution, map_size_kb, symmetry, pdb_ids '
+                'FROM entries WHERE emdb_id = ?', (emdb_id,)).fetchone()
+        return self._row_to_entry(row) if row else None
+
+    def search(self, text='', max_resolution=None, max_map_size_kb=None, limit=50):
+        """Find entries by ID, title or fitted PDB ID, best resolution first."""
+        clauses, params = [], []
+        text = text.strip()
+        if text:
+            clauses.append('(emdb_id LIKE ? OR title LIKE ? OR pdb_ids LIKE ?)')
+            emdb_id = text.upper().replace('EMD-', '')
+            params.extend([f'{emdb_id}%', f'%{text}%', f'%{text}%'])
+        if max_resolution is not None:
+            clauses.append('resolution <= ?')
+            params.append(max_resolution)
+        if max_map_size_kb is not None:
+            clauses.append('map_size_kb <= ?')
+            params.append(max_map_size_kb)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        query = (
+            'SELECT emdb_id, title, resolution, map_size_kb, symmetry, pdb_ids FROM entries '
+            f'{where} ORDER BY resolution IS NULL, resolution LIMIT ?')
+        params.append(limit)
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return [self._row_to_entry(row) for row in rows]
+
+    @staticmethod
+    def find_headers(header_dir):
+        for dirpath, _, filenames in os.walk(header_dir):
+            for filename in filenames:
+                if filename.startswith('emd-') and filename.endswith('.xml'):
+                    yield os.path.join(dirpath, filename)
+
+    @staticmethod
+    def emdb_id_from_filename(header_path):
+        # Headers are named like emd-8216.xml or emd-8216-v30.xml
+        return os.path.basename(header_path)[len('emd-'):].split('.')[0].split('-')[0]
+
+    def _commit_batch(self, entries, mtimes):
+        count = len(entries)
+        if count:
+            with self.lock, self.conn:
+                self._insert(entries, mtimes)
+            entries.clear()
+            mtimes.clear()
+        return count
+
+    def _insert(self, entries, mtimes):
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [
+                (e.emdb_id, e.title, e.resolution, e.map_size_kb, e.symmetry, ','.join(e.pdb_ids), mtime)
+                for e, mtime in zip(entries, mtimes)
+            ])
+
+    @staticmethod
+    def _row_to_entry(row):
+        emdb_id, title, resolution, map_size_kb, symmetry, pdb_ids = row
+        return EMDBEntry(emdb_id, title, resolution, map_size_kb, symmetry, pdb_ids.split(',') if pdb_ids else [])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or refresh the local EMDB catalog from header XML files.')
+    parser.add_argument('header_dir', help='Directory containing EMDB header XML files, e.g. a mirror of EMDB structures/')
+    parser.add_argument('--db', default=EMDB_CATALOG_PATH, help='Path to the catalog database')
+    args = parser.parse_args()
+    start_time = time.time()
+    catalog = EMDBCatalog(args.db)
+    indexed = catalog.index_directory(args.header_dir)
+    Logs.message(f"Indexed {indexed} headers in {round(time.time() - start_time, 2)} seconds. {len(catalog)} entries total.")
+    catalog.close()
+
+
+if __name__ == '__main__':
+    main()
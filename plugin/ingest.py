@@ -0,0 +1,136 @@
+import asyncio
+import os
+import requests
+from nanome.util import Logs, enums
+
+__all__ = ["EMDBIngestQueue", "IngestItem"]
+
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get('MAX_CONCURRENT_DOWNLOADS', 4))
+# Meshing runs in worker threads and processes, one per core. Memory is bounded by the plugin's memory budget.
+MAX_CONCURRENT_MESHING = int(os.environ.get('MAX_CONCURRENT_MESHING', os.cpu_count() or 1))
+
+
+class IngestItem:
+    """Tracks the state of a single EMDB entry in the ingest queue."""
+
+    QUEUED = 'queued'
+    DOWNLOADING = 'downloading'
+    WAITING = 'waiting to mesh'
+    MESHING = 'meshing'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, emdb_id, mapgroup=None):
+        self.emdb_id = emdb_id
+        self.mapgroup = mapgroup
+        self.status = self.QUEUED
+        self.progress = 0.0
+        self.error = None
+        self.task = None
+
+    @property
+    def finished(self):
+        return self.status in (self.DONE, self.FAILED)
+
+    @property
+    def status_text(self):
+        if self.status == self.DOWNLOADING:
+            return f'EMD-{self.emdb_id}: {self.status} ({int(self.progress * 100)}%)'
+        if self.status == self.FAILED:
+            return f'EMD-{self.emdb_id}: {self.status} ({self.error})'
+        return f'EMD-{self.emdb_id}: {self.status}'
+
+
+class EMDBIngestQueue:
+    """Loads a batch of EMDB entries, each into its own MapGroup.
+
+    Downloads run in parallel up to `max_downloads`, while mesh generation
+    is throttled to `max_meshing` concurrent jobs. Map parsing and meshing run
+    off the event loop, so up to `max_meshing` maps are meshed in parallel.
+    The fitted model prefetch option does not apply to batch loads.
+    """
+
+    def __init__(self, emdb_menu, plugin, on_update=None,
+                 max_downloads=MAX_CONCURRENT_DOWNLOADS, max_meshing=MAX_CONCURRENT_MESHING):
+        self.emdb_menu = emdb_menu
+        self._plugin = plugin
+        self.on_update = on_update
+        self.items = []
+        self.download_semaphore = asyncio.Semaphore(max_downloads)
+        self.mesh_semaphore = asyncio.Semaphore(max_meshing)
+
+    def submit(self, emdb_ids):
+        """Create a MapGroup for each ID, and schedule it for loading."""
+        new_items = []
+        for emdb_id in emdb_ids:
+            mapgroup = self._plugin.add_mapgroup()
+            mapgroup.group_name = f'EMD-{emdb_id}'
+            item = IngestItem(emdb_id, mapgroup)
+            item.task = asyncio.create_task(self.ingest(item))
+            new_items.append(item)
+        self.items.extend(new_items)
+        self.notify()
+        return new_items
+
+    async def join(self):
+        """Wait for every queued item to finish."""
+        tasks = [item.task for item in self.items if item.task]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def clear_finished(self):
+        self.items = [item for item in self.items if not item.finished]
+
+    async def ingest(self, item: IngestItem):
+        try:
+            async with self.download_semaphore:
+                map_file, metadata_parser = await self.download(item)
+            item.status = IngestItem.WAITING
+            self.notify()
+            async with self.mesh_semaphore:
+                item.status = IngestItem.MESHING
+                self.notify()
+                await self._plugin.add_mapfile_to_group(
+                    map_file, metadata_parser.isovalue, metadata_parser, mapgroup=item.mapgroup)
+        except Exception as e:
+            item.status = IngestItem.FAILED
+            item.error = self.get_error_message(e)
+            Logs.warning(f"Failed to load EMD-{item.emdb_id}: {item.error}")
+            self.remove_mapgroup(item)
+            asyncio.create_task(self._plugin.client.send_notification(
+                enums.NotificationTypes.error, f"EMD-{item.emdb_id}: {item.error}"))
+        else:
+            item.status = IngestItem.DONE
+        self.notify()
+
+    async def download(self, item: IngestItem):
+        item.status = IngestItem.DOWNLOADING
+        self.notify()
+        self.emdb_menu.validate_catalog_map_filesize(item.emdb_id)
+        loop = asyncio.get_event_loop()
+        metadata_parser = await loop.run_in_executor(
+            None, self.emdb_menu.download_metadata_from_emdbid, item.emdb_id)
+        self.emdb_menu.validate_map_filesize(metadata_parser)
+
+        def on_progress(fraction):
+            item.progress = fraction
+            self.notify()
+        map_file = await self.emdb_menu.download_mapgz_from_emdbid(
+            item.emdb_id, metadata_parser, progress_callback=on_progress)
+        return map_file, metadata_parser
+
+    def remove_mapgroup(self, item: IngestItem):
+        """Drop the empty MapGroup of a failed item from the main menu."""
+        if item.mapgroup in self._plugin.groups and not item.mapgroup.has_map():
+            self._plugin.groups.remove(item.mapgroup)
+            asyncio.create_task(self._plugin.menu.render())
+        item.mapgroup = None
+
+    def notify(self):
+        if self.on_update:
+            self.on_update(self.items)
+
+    @staticmethod
+    def get_error_message(exc):
+        if isinstance(exc, requests.exceptions.HTTPError):
+            return "EMDB ID not found"
+        return str(exc) or exc.__class__.__name__
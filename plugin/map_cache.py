@@ -0,0 +1,158 @@
+import json
+import os
+import shutil
+import tempfile
+from nanome.util import Logs
+
+from .mesh_io import MESH_ARTIFACT_SUFFIX, MeshArtifact
+
+__all__ = ["MapCache", "write_atomic"]
+
+MAP_CACHE_DIR = os.environ.get('MAP_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'cryoem_cache'))
+MAP_CACHE_MAX_MB = float(os.environ.get('MAP_CACHE_MAX_MB', 20000))
+# Subdirectories evicted least recently used first. Files are kept while a session checkpoint uses them.
+EVICTED_SUBDIRS = ('maps', 'meshes', 'stats')
+
+
+class MapCache:
+    """Directory of downloaded EMDB maps, map statistics and full map meshes,
+    and of map and model files kept for session restore.
+
+    Shared by every session process, and filled ahead of time by `python -m plugin.premesh`.
+    Statistics and meshes are keyed by the sha256 of the map file, and meshes also by isovalue.
+    Files are written to a temporary name and renamed, so readers never see partial files.
+    When maps, statistics and meshes grow over max_mb, the least recently used are evicted.
+    Files kept for session restore are removed by their SessionCheckpoint instead.
+    """
+
+    def __init__(self, cache_dir=MAP_CACHE_DIR, max_mb=MAP_CACHE_MAX_MB):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_mb * 1e6
+        for subdir in ('files', 'maps', 'meshes', 'stats'):
+            os.makedirs(os.path.join(cache_dir, subdir), exist_ok=True)
+
+    def emdb_map_path(self, emdb_id):
+        return os.path.join(self.cache_dir, 'maps', f'emd_{emdb_id}.map.gz')
+
+    def get_emdb_map(self, emdb_id):
+        """Get the path of a cached EMDB map, or None."""
+        path = self.emdb_map_path(emdb_id)
+        return path if self.touch(path) else None
+
+    def contains(self, path):
+        """Whether path is inside the cache directory."""
+        cache_dir = os.path.realpath(self.cache_dir)
+        return os.path.commonpath([cache_dir, os.path.realpath(path)]) == cache_dir
+
+    def mesh_path(self, source_hash, isovalue):
+        return os.path.join(self.cache_dir, 'meshes', f'{source_hash}_{isovalue:.6g}{MESH_ARTIFACT_SUFFIX}')
+
+    def stats_path(self, source_hash):
+        return os.path.join(self.cache_dir, 'stats', f'{source_hash}.json')
+
+    def file_path(self, source_hash, filename):
+        return os.path.join(self.cache_dir, 'files', source_hash, filename)
+
+    def put_file(self, path, source_hash):
+        """Keep a map or model file in the cache, under its original name. Returns the cached path."""
+        cached_path = self.file_path(source_hash, os.path.basename(path))
+        if os.path.exists(cached_path):
+            return cached_path
+        os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(cached_path), suffix='.tmp')
+        os.close(fd)
+        try:
+            shutil.copyfile(path, temp_path)
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, cached_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return cached_path
+
+    def remove_file(self, cached_path):
+        """Remove a file kept by put_file."""
+        try:
+            os.remove(cached_path)
+            os.rmdir(os.path.dirname(cached_path))
+        except OSError:
+            # Already removed, or the directory still has other files with the same hash
+            pass
+
+    def get_mesh(self, source_hash, isovalue):
+        """Get the cached MeshArtifact of a map at isovalue, or None."""
+        path = self.mesh_path(source_hash, isovalue)
+        if not self.touch(path):
+            return None
+        try:
+            return MeshArtifact.load(path)
+        except ValueError:
+            Logs.warning(f"Invalid cached mesh {path}")
+            return None
+
+    def put_mesh(self, artifact: MeshArtifact):
+        path = self.mesh_path(artifact.source_hash, artifact.isovalue)
+        write_atomic(path, artifact.to_bytes())
+        self.evict()
+
+    def get_stats(self, source_hash):
+        path = self.stats_path(source_hash)
+        if not self.touch(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def put_stats(self, source_hash, stats):
+        write_atomic(self.stats_path(source_hash), json.dumps(stats).encode())
+        self.evict()
+
+    @staticmethod
+    def touch(path):
+        """Mark a cached file as used, for eviction. Returns whether it exists."""
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        except PermissionError:
+            # Written by another user's plugin process, it still counts as cached.
+            return os.path.exists(path)
+        return True
+
+    def evict(self):
+        """Remove the least recently used maps, statistics and meshes until they fit in max_bytes."""
+        entries = []
+        for subdir in EVICTED_SUBDIRS:
+            with os.scandir(os.path.join(self.cache_dir, subdir)) as it:
+                for entry in it:
+                    if entry.is_file() and not entry.name.endswith('.tmp'):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_bytes:
+            return
+        for _, size, path in sorted(entries):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Evicted by another session
+                pass
+            except OSError:
+                Logs.warning(f"Could not evict {path} from the map cache")
+                continue
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+
+def write_atomic(path, data: bytes):
+    """Write data to a temporary file and rename it to path, so readers never see a partial file."""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # mkstemp files are private, cached files are shared with other users' plugin processes.
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
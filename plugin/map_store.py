@@ -0,0 +1,248 @@
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+import threading
+import numpy as np
+from cctbx import crystal, uctbx
+from collections import Counter
+from contextlib import contextmanager
+from iotbx.map_manager import map_manager
+from nanome.util import Logs
+from scitbx.array_family import flex
+
+from .map_cache import MAP_CACHE_DIR, write_atomic
+from .models import MapMesh
+
+__all__ = ["MapStore", "SharedMap"]
+
+MAP_STORE_DIR = os.environ.get('MAP_STORE_DIR', os.path.join(MAP_CACHE_DIR, 'store'))
+VOXELS_FILENAME = 'voxels.npy'
+METADATA_FILENAME = 'map.json'
+
+
+class VoxelData:
+    """Read-only voxel array, with the flex array methods the plugin uses on map data."""
+
+    def __init__(self, array: np.ndarray, origin):
+        self.array = array
+        self.origin = origin
+
+    def as_numpy_array(self):
+        return self.array
+
+    def as_1d(self):
+        return self.array.ravel()
+
+    def size(self):
+        return self.array.size
+
+    def last(self):
+        return tuple(o + n for o, n in zip(self.origin, self.array.shape))
+
+
+class SharedMap:
+    """Map voxels and grid geometry, memory mapped from the map store.
+
+    Stands in for a cctbx map_manager when meshing and placing the full map, so sessions
+    viewing the same map share one copy of its voxels. Groups that need cctbx, e.g. to
+    extract the map around a model, get a temporary map_manager from cctbx_map_manager.
+    """
+
+    def __init__(self, source_hash, voxels: np.ndarray, metadata):
+        self.source_hash = source_hash
+        self.origin = tuple(metadata['origin'])
+        self.unit_cell_grid = tuple(metadata['unit_cell_grid'])
+        self.stats = metadata['stats']
+        self.data = VoxelData(voxels, self.origin)
+        self._orthogonalization = np.array(metadata['orthogonalization_matrix']).reshape(3, 3)
+        # Maps stored before the unit cell was saved are rebuilt from the orthogonalization matrix.
+        self._unit_cell_parameters = metadata.get('unit_cell_parameters')
+        self._space_group = metadata.get('space_group', 'P 1')
+
+    def map_data(self):
+        return self.data
+
+    def grid_units_to_cart(self, grid_units):
+        """Convert grid units to Cartesian coordinates, like map_manager.grid_units_to_cart."""
+        fractional = np.asarray(grid_units, dtype=np.float64) / self.unit_cell_grid
+        return tuple(self._orthogonalization @ fractional)
+
+    def cctbx_map_manager(self) -> map_manager:
+        """A new cctbx map_manager with a float64 copy of the voxels.
+
+        The map model manager shifts and replaces its map in place, so each caller gets its own.
+        Blocking, run it in an executor.
+        """
+        voxels = self.data.as_numpy_array()
+        map_data = flex.double(np.ascontiguousarray(voxels, dtype=np.float64))
+        map_data.reshape(flex.grid(self.origin, self.data.last()))
+        if self._unit_cell_parameters:
+            unit_cell = uctbx.unit_cell(self._unit_cell_parameters)
+        else:
+            unit_cell = uctbx.unit_cell(orthogonalization_matrix=self._orthogonalization.flatten().tolist())
+        manager = map_manager(
+            map_data=map_data,
+            unit_cell_grid=self.unit_cell_grid,
+            unit_cell_crystal_symmetry=crystal.symmetry(unit_cell, self._space_group),
+            wrapping=False)
+        # Set by the map file reader on maps loaded with MapMesh.load_mapfile
+        manager.origin = list(self.origin)
+        return manager
+
+
+class MapStore:
+    """Reference counted store of parsed maps, shared by the session processes on this host.
+
+    Each map is saved once as a float32 .npy file keyed by the map's sha256, and attached
+    sessions memory map it read-only. Sessions hold a reference file per process, and a map
+    is evicted when its last reference is released, or its holders have exited.
+    """
+
+    def __init__(self, store_dir=MAP_STORE_DIR):
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+        # source hash -> [SharedMap, reference count] for this process
+        self._attached = {}
+        # source hash -> number of threads adding or opening the map
+        self._pending = Counter()
+        self._attached_lock = threading.Lock()
+
+    def attach(self, mapfile, source_hash) -> SharedMap:
+        """Get the shared map of mapfile, adding it to the store if needed.
+
+        Blocking, run it in an executor.
+        """
+        entry_dir = self.entry_dir(source_hash)
+        with self._attached_lock:
+            if source_hash in self._attached:
+                self._attached[source_hash][1] += 1
+                return self._attached[source_hash][0]
+            # The reference file is per process, so it is kept while any thread is attaching.
+            self._pending[source_hash] += 1
+            with self._locked():
+                os.makedirs(os.path.join(entry_dir, 'refs'), exist_ok=True)
+                # Hold a reference while the map is added, so it can't be evicted.
+                open(self.ref_path(source_hash), 'w').close()
+        shared_map = None
+        try:
+            if not os.path.exists(os.path.join(entry_dir, METADATA_FILENAME)):
+                self._add(mapfile, entry_dir)
+            shared_map = self._open(source_hash)
+        finally:
+            with self._attached_lock:
+                self._pending[source_hash] -= 1
+                if shared_map is not None:
+                    # Another thread may have attached the same map meanwhile.
+                    attached = self._attached.setdefault(source_hash, [shared_map, 0])
+                    attached[1] += 1
+                    shared_map = attached[0]
+                elif not self._pending[source_hash] and source_hash not in self._attached:
+                    self._remove_ref(source_hash)
+                if not self._pending[source_hash]:
+                    del self._pending[source_hash]
+        return shared_map
+
+    def release(self, shared_map: SharedMap):
+        """Release a reference from attach. The map is evicted when no session holds it."""
+        with self._attached_lock:
+            attached = self._attached.get(shared_map.source_hash)
+            if not attached:
+                return
+            attached[1] -= 1
+            if attached[1] > 0:
+                return
+            del self._attached[shared_map.source_hash]
+            if not self._pending[shared_map.source_hash]:
+                self._remove_ref(shared_map.source_hash)
+
+    def release_all(self):
+        with self._attached_lock:
+            for source_hash in list(self._attached):
+                del self._attached[source_hash]
+                self._remove_ref(source_hash)
+
+    def entry_dir(self, source_hash):
+        return os.path.join(self.store_dir, source_hash)
+
+    def ref_path(self, source_hash):
+        return os.path.join(self.entry_dir(source_hash), 'refs', str(os.getpid()))
+
+    def evict_unused(self):
+        """Remove maps with no references from running processes."""
+        with self._locked():
+            for source_hash in os.listdir(self.store_dir):
+                if os.path.isdir(self.entry_dir(source_hash)):
+                    self._evict_if_unused(source_hash)
+
+    def _add(self, mapfile, entry_dir):
+        Logs.message(f"Adding {os.path.basename(mapfile)} to the map store")
+        map_manager = MapMesh.load_mapfile(mapfile)
+        voxels = map_manager.map_data().as_numpy_array().astype(np.float32)
+        metadata = {
+            'origin': list(map_manager.origin),
+            'unit_cell_grid': list(map_manager.unit_cell_grid),
+            'orthogonalization_matrix': list(map_manager.unit_cell().orthogonalization_matrix()),
+            'unit_cell_parameters': list(map_manager.unit_cell().parameters()),
+            'space_group': str(map_manager.unit_cell_crystal_symmetry().space_group_info()),
+            'stats': MapMesh.compute_map_stats(map_manager),
+        }
+        fd, temp_path = tempfile.mkstemp(dir=entry_dir, suffix='.npy')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, voxels)
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, os.path.join(entry_dir, VOXELS_FILENAME))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        # Written last, so a map is only used once its voxels are complete.
+        write_atomic(os.path.join(entry_dir, METADATA_FILENAME), json.dumps(metadata).encode())
+
+    def _open(self, source_hash):
+        entry_dir = self.entry_dir(source_hash)
+        with open(os.path.join(entry_dir, METADATA_FILENAME)) as f:
+            metadata = json.load(f)
+        voxels = np.load(os.path.join(entry_dir, VOXELS_FILENAME), mmap_mode='r')
+        return SharedMap(source_hash, voxels, metadata)
+
+    def _remove_ref(self, source_hash):
+        with self._locked():
+            try:
+                os.remove(self.ref_path(source_hash))
+            except FileNotFoundError:
+                pass
+            self._evict_if_unused(source_hash)
+
+    def _evict_if_unused(self, source_hash):
+        # Caller must hold the store lock
+        refs_dir = os.path.join(self.entry_dir(source_hash), 'refs')
+        live_refs = 0
+        for ref in os.listdir(refs_dir) if os.path.isdir(refs_dir) else []:
+            if self._is_running(int(ref)):
+                live_refs += 1
+            else:
+                os.remove(os.path.join(refs_dir, ref))
+        if not live_refs:
+            # Processes that still have the voxels mapped keep reading them after removal.
+            shutil.rmtree(self.entry_dir(source_hash), ignore_errors=True)
+
+    @staticmethod
+    def _is_running(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    @contextmanager
+    def _locked(self):
+        with open(os.path.join(self.store_dir, '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,233 @@
+import asyncio
+import fcntl
+import itertools
+import math
+import os
+import threading
+import tracemalloc
+from contextlib import asynccontextmanager, contextmanager
+from nanome.util import Logs
+
+from .map_cache import MAP_CACHE_DIR
+
+__all__ = ["InsufficientMemory", "MemoryBudget", "MemoryPlan", "estimate_model_map_memory", "estimate_peak_memory"]
+
+# Memory available to the plugin, in MB. Defaults to the container limit, or the host's memory.
+MEMORY_LIMIT_MB = int(os.environ.get('MEMORY_LIMIT_MB', 0))
+# Share of the memory limit that map loads can reserve, the rest is left for the sessions themselves.
+MEMORY_BUDGET_FRACTION = float(os.environ.get('MEMORY_BUDGET_FRACTION', 0.7))
+MEMORY_RESERVATIONS_DIR = os.environ.get('MEMORY_RESERVATIONS_DIR', os.path.join(MAP_CACHE_DIR, 'memory'))
+# Sample the memory use of every pipeline stage into the metrics. Slows the plugin down.
+MEMORY_TRACKING = os.environ.get('MEMORY_TRACKING', '').lower() in ('1', 'true', 'yes')
+RSS_SAMPLE_INTERVAL = 0.05
+
+# Marching cubes vertices per voxel meshed. Dense maps reach 0.2, most maps are well below.
+MESH_VERTEX_FRACTION = float(os.environ.get('MESH_VERTEX_FRACTION', 0.1))
+# Marching cubes and simplification memory per vertex: grid and cartesian float64 vertices,
+# uint64 triangles, and the copies made by pyfqmr.
+MESH_BYTES_PER_VERTEX = 200
+# Strides tried when the full resolution mesh doesn't fit.
+MAX_MESH_STRIDE = 8
+
+CGROUP_MEMORY_LIMITS = ['/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes']
+
+
+class InsufficientMemory(Exception):
+    """The map can't be loaded within the memory budget, even downsampled."""
+
+
+def memory_limit():
+    """Bytes of memory available to the plugin."""
+    if MEMORY_LIMIT_MB:
+        return MEMORY_LIMIT_MB * 10 ** 6
+    limit = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    for path in CGROUP_MEMORY_LIMITS:
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        # 'max', or a huge number, when the container is unlimited
+        if value.isdigit():
+            limit = min(limit, int(value))
+    return limit
+
+
+def current_rss():
+    """Resident memory of this process in bytes."""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def estimate_peak_memory(dimensions, mode_bytes=4, stride=1):
+    """Estimated peak bytes of each stage of loading and meshing a map.
+
+    dimensions: Grid size of the map, e.g. from its MRCHeader.
+    mode_bytes: Bytes per voxel in the map file.
+    stride: Meshing every stride-th voxel along each axis.
+    Stages run one after the other, so the load's peak is the largest stage.
+    """
+    voxels = math.prod(dimensions)
+    meshed_voxels = math.prod(math.ceil(n / stride) for n in dimensions)
+    mesh_bytes = meshed_voxels * MESH_VERTEX_FRACTION * MESH_BYTES_PER_VERTEX
+    return {
+        # Decompressed file, cctbx map, its numpy copy, and float32 voxels for the map store.
+        'parse': voxels * (mode_bytes + 8 + 8 + 4),
+        # cctbx map, numpy copy, and float64 deviations
+        'stats': voxels * 24,
+        # Stored voxels, plus their downsampled copy
+        'mesh': voxels * 4 + (meshed_voxels * 4 if stride > 1 else 0) + int(mesh_bytes),
+        # float32 copies of the voxels, and histogram temporaries
+        'histogram': voxels * 16,
+    }
+
+
+def estimate_model_map_memory(voxels):
+    """Estimated peak bytes of the map model manager of a map with voxels voxels.
+
+    The map's float64 cctbx copy, the map generated from the model, and its numpy copy for meshing.
+    """
+    return voxels * 24
+
+
+class MemoryPlan:
+
+    def __init__(self, stride, estimate):
+        self.stride = stride
+        self.estimate = estimate
+
+    @property
+    def peak(self):
+        return max(self.estimate.values())
+
+
+class MemoryBudget:
+    """Memory reserved by the map loads in progress, across the sessions on this host.
+
+    A load reserves its projected peak memory. Loads that don't fit wait for others to finish,
+    and maps whose mesh can't fit at full resolution are meshed downsampled. Reservations are
+    files named after the process holding them, so those of exited sessions are ignored.
+    """
+
+    def __init__(self, capacity=None, reservations_dir=MEMORY_RESERVATIONS_DIR, poll_interval=0.5):
+        self.capacity = capacity or int(memory_limit() * MEMORY_BUDGET_FRACTION)
+        self.reservations_dir = reservations_dir
+        self.poll_interval = poll_interval
+        os.makedirs(reservations_dir, exist_ok=True)
+        self._reservation_ids = itertools.count()
+
+    def plan(self, dimensions, mode_bytes=4) -> MemoryPlan:
+        """Smallest mesh stride whose projected peak fits in the budget.
+
+        Raises InsufficientMemory if loading the map alone doesn't fit.
+        """
+        for stride in range(1, MAX_MESH_STRIDE + 1):
+            plan = MemoryPlan(stride, estimate_peak_memory(dimensions, mode_bytes, stride))
+            if plan.peak <= self.capacity:
+                return plan
+            if plan.peak != plan.estimate['mesh']:
+                break
+        dims = 'x'.join(str(n) for n in dimensions)
+        raise InsufficientMemory(f"Map of {dims} voxels needs more than {self.capacity // 10 ** 6}MB of memory")
+
+    def reserved(self):
+        """Bytes reserved by running processes."""
+        with self._locked():
+            return sum(self._live_reservations().values())
+
+    @asynccontextmanager
+    async def reserve(self, nbytes):
+        """Hold nbytes of the budget, waiting until other loads free enough of it."""
+        if nbytes > self.capacity:
+            raise InsufficientMemory(f"{nbytes // 10 ** 6}MB is over the {self.capacity // 10 ** 6}MB memory budget")
+        path = self._try_reserve(nbytes)
+        if not path:
+            Logs.message(f"Waiting for {nbytes // 10 ** 6}MB of memory to load map")
+        while not path:
+            await asyncio.sleep(self.poll_interval)
+            path = self._try_reserve(nbytes)
+        try:
+            yield
+        finally:
+            os.remove(path)
+
+    def _try_reserve(self, nbytes):
+        with self._locked():
+            if sum(self._live_reservations().values()) + nbytes > self.capacity:
+                return None
+            path = os.path.join(self.reservations_dir, f'{os.getpid()}-{next(self._reservation_ids)}')
+            with open(path, 'w') as f:
+                f.write(str(nbytes))
+            return path
+
+    def _live_reservations(self):
+        # Caller must hold the lock
+        reservations = {}
+        for name in os.listdir(self.reservations_dir):
+            path = os.path.join(self.reservations_dir, name)
+            if name.startswith('.'):
+                continue
+            pid = int(name.split('-')[0])
+            if not self._is_running(pid):
+                os.remove(path)
+                continue
+            with open(path) as f:
+                reservations[name] = int(f.read() or 0)
+        return reservations
+
+    @staticmethod
+    def _is_running(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    @contextmanager
+    def _locked(self):
+        with open(os.path.join(self.reservations_dir, '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def start_tracking():
+    """Trace Python allocations, if MEMORY_TRACKING is enabled."""
+    if MEMORY_TRACKING and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+class StageMemory:
+    """Peak RSS of the process during a stage, sampled in a thread, and the peak of traced allocations.
+
+    Stages running at the same time share the process, so their peaks overlap.
+    """
+
+    def __init__(self):
+        self.peak_rss = 0
+        self.traced_peak = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.peak_rss = current_rss()
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            self._traced_start = tracemalloc.get_traced_memory()[0]
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self.peak_rss = max(self.peak_rss, current_rss())
+        if tracemalloc.is_tracing():
+            self.traced_peak = tracemalloc.get_traced_memory()[1] - self._traced_start
+
+    def _sample(self):
+        while not self._stopped.wait(RSS_SAMPLE_INTERVAL):
+            self.peak_rss = max(self.peak_rss, current_rss())
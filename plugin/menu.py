@@ -4,14 +4,20 @@ import math
 import nanome
 import os
 import requests
+import sqlite3
 import time
 import urllib
 from functools import partial
 from nanome.api import ui
 from nanome.util import enums, Logs
 
-from .models import MapGroup
-from .utils import EMDBMetadataParser
+from .compute import JobPriority
+from .emdb_catalog import EMDBCatalog, EMDB_CATALOG_PATH
+from .ingest import EMDBIngestQueue
+from .memory import InsufficientMemory
+from .metrics import span
+from .models import EXTRACTION_TYPE, MapGroup
+from .utils import EMDB_HEADER_URL, EMDB_MAP_URL, EMDBMetadataParser, parse_emdb_ids
 
 import logging
 logger = logging.getLogger(__name__)
@@ -26,6 +32,12 @@ VISIBLE_ICON = os.path.join(ASSETS_PATH, 'visible.png')
 INVISIBLE_ICON = os.path.join(ASSETS_PATH, 'invisible.png')
 
 MAX_MAP_SIZE_MB = int(os.environ.get('MAX_MAP_SIZE_MB', 350))
+# Preview the full map mesh while the isovalue slider moves, and redraw when it is released.
+LIVE_PREVIEW = os.environ.get('LIVE_PREVIEW', 'true').lower() in ('1', 'true', 'yes')
+# Minimum seconds between previews
+PREVIEW_INTERVAL = 0.1
+# Seconds the isovalue slider can rest without a release event, before the full map is redrawn anyway
+PREVIEW_RELEASE_TIMEOUT = 2
 
 __all__ = ['MainMenu', 'EditMeshMenu']
 
@@ -37,7 +49,6 @@ class LoadFromEmdbMenu:
         self._menu = ui_manager.create_new_menu(LOAD_FROM_EMDB_MENU_PATH)
         self._menu.index = 120  # arbitrary
         self._plugin = plugin_instance
-        self.client = plugin_instance.client
 
         root: ui.LayoutNode = self._menu.root
 
@@ -61,12 +72,42 @@ class LoadFromEmdbMenu:
         self.btn_browse_emdb: ui.Button = root.find_node('ln_btn_browse_emdb').get_content()
         ui_manager.register_btn_pressed_callback(self.btn_browse_emdb, self.on_browse_emdb)
 
+        # When enabled, the first fitted model is downloaded alongside the map.
+        self.btn_prefetch_model: ui.Button = root.find_node('btn_prefetch_model').get_content()
+        self.btn_prefetch_model.toggle_on_press = True
+        self.btn_prefetch_model.selected = False
+        ui_manager.register_btn_pressed_callback(self.btn_prefetch_model, self.toggle_prefetch_model)
+
+        # Batch loading of multiple EMDB IDs
+        self.ln_ingest_queue: ui.LayoutNode = root.find_node('ln_ingest_queue')
+        self.lst_ingest_queue: ui.UIList = root.find_node('lst_ingest_queue').get_content()
+        self.ingest_queue = EMDBIngestQueue(self, plugin_instance, on_update=self.render_ingest_queue)
+
+        # Search of the local EMDB catalog
+        self.ln_catalog_search: ui.LayoutNode = root.find_node('ln_catalog_search')
+        self.ti_catalog_query: ui.TextInput = root.find_node('ti_catalog_query').get_content()
+        self.ti_catalog_max_resolution: ui.TextInput = root.find_node('ti_catalog_max_resolution').get_content()
+        self.btn_catalog_search: ui.Button = root.find_node('btn_catalog_search').get_content()
+        self.lst_catalog_results: ui.UIList = root.find_node('lst_catalog_results').get_content()
+        ui_manager.register_btn_pressed_callback(self.btn_catalog_search, self.on_catalog_search)
+        ui_manager.register_text_submit_callback(self.ti_catalog_query, self.on_catalog_search)
+        try:
+            self.catalog = EMDBCatalog(EMDB_CATALOG_PATH)
+        except sqlite3.Error:
+            Logs.warning(f"Could not open EMDB catalog at {EMDB_CATALOG_PATH}", exc_info=True)
+            self.catalog = None
+            self.btn_catalog_search.unusable = True
+
     def render(self):
         self._menu.enabled = True
-        self.client.update_menu(self._menu)
+        self._plugin.client.update_menu(self._menu)
 
     def on_browse_emdb(self, btn):
-        """Open the EMDB website in the user's browser"""
+        """Show the local catalog search, or open the EMDB website if the catalog is empty."""
+        if self.catalog and len(self.catalog):
+            self.ln_catalog_search.enabled = not self.ln_catalog_search.enabled
+            self._plugin.client.update_menu(self._menu)
+            return
         base_search_url = "www.ebi.ac.uk/emdb/search"
         # query only low molecular weight maps, because download speeds are really bad.
         query = urllib.parse.quote('* AND overall_molecular_weight:{0 TO 50000]')
@@ -77,6 +118,13 @@ class LoadFromEmdbMenu:
         url = f"{base_search_url}/{query}?{query_params}"
         self._plugin.client.open_url(url)
 
+    @property
+    def prefetch_model(self):
+        return self.btn_prefetch_model.selected
+
+    def toggle_prefetch_model(self, btn):
+        self._plugin.client.update_content(btn)
+
     async def on_rcsb_submit(self, btn):
         pdb_id = self.ti_rcsb_query.input_text
         Logs.debug(f"RCSB query: {pdb_id}")
@@ -97,27 +145,48 @@ class LoadFromEmdbMenu:
         self._plugin.client.update_content(self.btn_embl_submit, btn)
 
     async def on_emdb_submit(self, btn):
-        embid_id = self.ti_embl_query.input_text
-        Logs.debug(f"EMDB query: {embid_id}")
+        query = self.ti_embl_query.input_text
+        Logs.debug(f"EMDB query: {query}")
+        try:
+            emdb_ids = parse_emdb_ids(query)
+        except ValueError as e:
+            emdb_ids = []
+            msg = str(e)
+        else:
+            msg = "Please enter an EMDB ID"
+        if len(emdb_ids) != 1:
+            if emdb_ids:
+                self.submit_batch(emdb_ids)
+            else:
+                self.send_error(msg)
+            btn.unusable = False
+            self._plugin.client.update_content(btn)
+            return
+        embid_id = emdb_ids[0]
 
         # Disable RCSB button
         self.btn_rcsb_submit.unusable = True
         self.btn_rcsb_submit.text.value.unusable = "Load"
         self._plugin.client.update_content(self.btn_rcsb_submit)
+        fitted_model = None
         try:
+            self.validate_catalog_map_filesize(embid_id)
             metadata_parser = self.download_metadata_from_emdbid(embid_id)
-            # Validate file size is within limit.
-            max_map_size_kb = MAX_MAP_SIZE_MB * 1000
-            if metadata_parser.map_filesize > max_map_size_kb:
-                raise Exception
+            self.validate_map_filesize(metadata_parser)
         except requests.exceptions.HTTPError:
-            msg = "EMDB ID not found"
-            Logs.warning(msg)
-            self._plugin.client.send_notification(enums.NotificationTypes.error, msg)
+            self.send_error("EMDB ID not found")
+        except InsufficientMemory as e:
+            self.send_error(str(e))
         except Exception:
-            msg = "Map file must be smaller than 500MB"
-            self._plugin.client.send_notification(enums.NotificationTypes.error, msg)
+            self.send_error(f"Map file must be smaller than {MAX_MAP_SIZE_MB}MB")
         else:
+            # Start loading the fitted model while the map downloads.
+            # Skipped if the group already has a model, to avoid orphaning it in the workspace.
+            mapgroup = self._plugin.get_group(self._plugin.menu.get_selected_mapgroup())
+            has_model = bool(mapgroup and mapgroup.model_complex)
+            if self.prefetch_model and metadata_parser.pdb_list and not has_model:
+                fitted_model = asyncio.create_task(
+                    self.prefetch_fitted_model(metadata_parser.pdb_list[0]))
             # Download map data
             map_file = await self.download_mapgz_from_emdbid(embid_id, metadata_parser)
             isovalue = metadata_parser.isovalue
@@ -127,89 +196,232 @@ class LoadFromEmdbMenu:
             btn.unusable = True
             self._plugin.client.update_content(btn)
 
-            await self._plugin.add_mapfile_to_group(map_file, isovalue, metadata_parser)
-
-            # Populate rcsb text input with pdb from metadata
-            if metadata_parser.pdb_list:
+            try:
+                await self._plugin.add_mapfile_to_group(
+                    map_file, isovalue, metadata_parser, fitted_model=fitted_model)
+            except InsufficientMemory:
+                # The user was notified by add_mapfile_to_group.
+                return
+
+            # Populate rcsb text input with pdb from metadata,
+            # unless the fitted model was already loaded.
+            model_loaded = fitted_model and fitted_model.done() and fitted_model.result()
+            if metadata_parser.pdb_list and not model_loaded:
                 pdb_id = metadata_parser.pdb_list[0]
             else:
                 pdb_id = ""
             self.ti_rcsb_query.input_text = pdb_id
             self._plugin.client.update_content(self.ti_rcsb_query)
-        # Reenable rcsb load button
-        self.btn_rcsb_submit.unusable = False
-        self.btn_rcsb_submit.text.value.unusable = "Downloading..."
-        btn.text.value.unusable = "Downloading..."
-        btn.unusable = False
-        self._plugin.client.update_content(self.btn_rcsb_submit, btn)
+        finally:
+            if fitted_model and not fitted_model.done():
+                fitted_model.cancel()
+            # Reenable rcsb load button
+            self.btn_rcsb_submit.unusable = False
+            self.btn_rcsb_submit.text.value.unusable = "Downloading..."
+            btn.text.value.unusable = "Downloading..."
+            btn.unusable = False
+            self._plugin.client.update_content(self.btn_rcsb_submit, btn)
+
+    def on_catalog_search(self, *args):
+        if not self.catalog:
+            self.send_error("EMDB catalog unavailable")
+            return
+        try:
+            max_resolution = float(self.ti_catalog_max_resolution.input_text)
+        except ValueError:
+            max_resolution = None
+        # Only show maps that can be loaded.
+        results = self.catalog.search(
+            self.ti_catalog_query.input_text,
+            max_resolution=max_resolution,
+            max_map_size_kb=MAX_MAP_SIZE_MB * 1000)
+        self.render_catalog_results(results)
+
+    def render_catalog_results(self, entries):
+        self.lst_catalog_results.items.clear()
+        for entry in entries:
+            ln = ui.LayoutNode()
+            btn = ln.add_new_button(self.format_catalog_entry(entry))
+            btn.text.size = 0.3
+            btn.text.ellipsis = True
+            self._plugin.ui_manager.register_btn_pressed_callback(
+                btn, partial(self.select_catalog_entry, entry))
+            self.lst_catalog_results.items.append(ln)
+        self._plugin.client.update_content(self.lst_catalog_results)
+
+    def select_catalog_entry(self, entry, btn=None):
+        self.ti_embl_query.input_text = entry.emdb_id
+        self._plugin.client.update_content(self.ti_embl_query)
+
+    @staticmethod
+    def format_catalog_entry(entry):
+        resolution = f'{entry.resolution}Å' if entry.resolution is not None else '?'
+        size_mb = round((entry.map_size_kb or 0) / 1000, 1)
+        return f'EMD-{entry.emdb_id} | {resolution} | {size_mb}MB | {entry.title or ""}'
+
+    def validate_catalog_map_filesize(self, emdb_id):
+        """Raise ValueError before downloading anything, if the catalog knows the map is too large."""
+        entry = self.catalog.get(emdb_id) if self.catalog else None
+        if entry and entry.map_size_kb and entry.map_size_kb > MAX_MAP_SIZE_MB * 1000:
+            raise ValueError(f"Map file must be smaller than {MAX_MAP_SIZE_MB}MB")
+
+    def send_error(self, msg):
+        Logs.warning(msg)
+        asyncio.create_task(self._plugin.client.send_notification(enums.NotificationTypes.error, msg))
+
+    def submit_batch(self, emdb_ids):
+        """Queue multiple EMDB IDs, each loaded into its own MapGroup.
+
+        Batch loads skip the fitted model prefetch, to avoid adding many models at once.
+        """
+        Logs.message(f"Queueing {len(emdb_ids)} EMDB entries")
+        self.ingest_queue.clear_finished()
+        self.ingest_queue.submit(emdb_ids)
+        asyncio.create_task(self._plugin.menu.render())
+
+    def render_ingest_queue(self, items):
+        was_enabled = self.ln_ingest_queue.enabled
+        self.ln_ingest_queue.enabled = bool(items)
+        self.lst_ingest_queue.items.clear()
+        for item in items:
+            ln = ui.LayoutNode()
+            lbl = ln.add_new_label(item.status_text)
+            lbl.text_max_size = 0.3
+            self.lst_ingest_queue.items.append(ln)
+        if was_enabled != self.ln_ingest_queue.enabled:
+            self._plugin.ui_updates.update_menu(self._menu)
+        else:
+            self._plugin.ui_updates.update_content(self.lst_ingest_queue)
+
+    def validate_map_filesize(self, metadata_parser: EMDBMetadataParser):
+        """Raise InsufficientMemory if the map in the EMDB header can't be loaded within the memory budget.
+
+        If the header doesn't have the map's dimensions, raise ValueError if the map is over MAX_MAP_SIZE_MB.
+        """
+        dimensions = metadata_parser.map_dimensions
+        if dimensions:
+            self._plugin.memory_budget.plan(dimensions)
+            return
+        max_map_size_kb = MAX_MAP_SIZE_MB * 1000
+        if metadata_parser.map_filesize > max_map_size_kb:
+            raise ValueError(f"Map file must be smaller than {MAX_MAP_SIZE_MB}MB")
 
     @property
     def temp_dir(self):
         return self._plugin.temp_dir.name
 
     def download_pdb_from_rcsb(self, pdb_id):
+        file_path = self.fetch_pdb_from_rcsb(pdb_id)
+        if not file_path:
+            self.send_error(f"{pdb_id} not found in RCSB")
+        return file_path
+
+    def fetch_pdb_from_rcsb(self, pdb_id):
+        """Download a PDB file from RCSB, without notifying. Safe to call from a worker thread."""
         url = f"https://files.rcsb.org/download/{pdb_id}.pdb"
         response = requests.get(url)
         if response.status_code != 200:
             Logs.warning(f"PDB for {pdb_id} not found")
-            self._plugin.client.send_notification(
-                nanome.util.enums.NotificationTypes.error,
-                f"{pdb_id} not found in RCSB")
             return
         file_path = f'{self.temp_dir}/{pdb_id}.pdb'
         with open(file_path, 'wb') as f:
             f.write(response.content)
         return file_path
 
+    async def prefetch_fitted_model(self, pdb_id):
+        """Download, parse and bond a model from RCSB.
+
+        Returns a (filepath, complex, cctbx model) tuple, or None if the model could not be loaded.
+        """
+        Logs.debug(f"Prefetching fitted model {pdb_id}")
+        loop = asyncio.get_event_loop()
+        try:
+            pdb_path = await loop.run_in_executor(None, self.fetch_pdb_from_rcsb, pdb_id)
+            if not pdb_path:
+                self.send_error(f"{pdb_id} not found in RCSB")
+                return
+            model_comp = await self._plugin.create_model_complex(pdb_path)
+            model = await loop.run_in_executor(None, MapGroup.load_model, pdb_path)
+        except Exception:
+            Logs.warning(f"Failed to prefetch fitted model {pdb_id}", exc_info=True)
+            return
+        return pdb_path, model_comp, model
+
     def download_metadata_from_emdbid(self, emdbid):
         Logs.debug("Downloading metadata for EMDBID:", emdbid)
-        url = f"https://ftp.ebi.ac.uk/pub/databases/emdb/structures/EMD-{emdbid}/header/emd-{emdbid}.xml"
+        url = EMDB_HEADER_URL.format(emdb_id=emdbid)
         response = requests.get(url)
         response.raise_for_status()
+        if self.catalog:
+            try:
+                self.catalog.add_header(response.content)
+            except Exception:
+                Logs.warning(f"Could not add EMD-{emdbid} to catalog", exc_info=True)
         return EMDBMetadataParser(response.content)
 
-    async def download_mapgz_from_emdbid(self, emdbid, metadata_parser: EMDBMetadataParser):
+    async def download_mapgz_from_emdbid(self, emdbid, metadata_parser: EMDBMetadataParser, progress_callback=None):
+        """Download map from EMDB.
+
+        By default progress is shown on the menu loading bar. If progress_callback is provided,
+        it is called with the downloaded fraction instead.
+        Maps already in the map cache, e.g. from `python -m plugin.premesh`, are not downloaded again.
+        """
+        cached_path = self._plugin.map_cache.get_emdb_map(emdbid)
+        if cached_path:
+            Logs.message("Using cached map for EMDB:", emdbid)
+            if progress_callback:
+                progress_callback(1.0)
+            return cached_path
         Logs.message("Downloading map data from EMDB:", emdbid)
-        url = f"https://ftp.ebi.ac.uk/pub/databases/emdb/structures/EMD-{emdbid}/map/emd_{emdbid}.map.gz"
+        url = EMDB_MAP_URL.format(emdb_id=emdbid)
         # Write the map to a .map file
         file_path = f'{self.temp_dir}/{emdbid}.map.gz'
         # Set up loading bar
-        self.lb_embl_download.enabled = True
-        self._plugin.client.update_node(self.lb_embl_download)
         loading_bar = self.lb_embl_download.get_content()
-
-        async with aiohttp.ClientSession() as session:
-            # Get content size from head request
-            response = await session.head(url)
-            file_size = int(response.headers['Content-Length']) / 1000
-
-            chunk_size = 8192
-            async with session.get(url) as response:
-                with open(file_path, 'wb') as file:
-                    start_time = time.time()
-                    data_check = start_time
-                    downloaded_chunks = 0
-                    while True:
-                        chunk = await response.content.read(chunk_size)
-                        if not chunk:
-                            break
-                        downloaded_chunks += len(chunk)
-                        file.write(chunk)
-                        now = time.time()
-                        # Update UI with download progress
-                        ui_update_interval = 3
-                        if now - data_check > ui_update_interval:
-                            kb_downloaded = downloaded_chunks / 1000
-                            Logs.debug(f"{int(now - start_time)} seconds: {kb_downloaded} / {file_size} kbs")
-                            loading_bar.percentage = kb_downloaded / file_size
-                            self.btn_embl_submit.text.value.unusable = \
-                                f"Downloading... ({int(kb_downloaded/1000)}/{int(file_size/1000)} MB)"
-                            self.btn_embl_submit.unusable = True
-                            self._plugin.client.update_content(loading_bar, self.btn_embl_submit)
-                            data_check = now
+        if not progress_callback:
+            self.lb_embl_download.enabled = True
+            self._plugin.ui_updates.update_node(self.lb_embl_download)
+
+        with span('download') as download_span:
+            async with aiohttp.ClientSession() as session:
+                # Get content size from head request
+                response = await session.head(url)
+                file_size = int(response.headers['Content-Length']) / 1000
+
+                chunk_size = 8192
+                async with session.get(url) as response:
+                    with open(file_path, 'wb') as file:
+                        start_time = time.time()
+                        data_check = start_time
+                        downloaded_chunks = 0
+                        while True:
+                            chunk = await response.content.read(chunk_size)
+                            if not chunk:
+                                break
+                            downloaded_chunks += len(chunk)
+                            file.write(chunk)
+                            now = time.time()
+                            # Update UI with download progress
+                            ui_update_interval = 3
+                            if now - data_check > ui_update_interval:
+                                kb_downloaded = downloaded_chunks / 1000
+                                Logs.debug(f"{int(now - start_time)} seconds: {kb_downloaded} / {file_size} kbs")
+                                data_check = now
+                                if progress_callback:
+                                    progress_callback(kb_downloaded / file_size)
+                                    continue
+                                loading_bar.percentage = kb_downloaded / file_size
+                                self.btn_embl_submit.text.value.unusable = \
+                                    f"Downloading... ({int(kb_downloaded/1000)}/{int(file_size/1000)} MB)"
+                                self.btn_embl_submit.unusable = True
+                                self._plugin.ui_updates.update_content(loading_bar, self.btn_embl_submit)
+            download_span.counts['bytes'] = downloaded_chunks
+        if progress_callback:
+            progress_callback(1.0)
+            return file_path
         loading_bar.percentage = 0
         self.lb_embl_download.enabled = False
-        self._plugin.client.update_node(self.lb_embl_download)
+        self._plugin.ui_updates.update_node(self.lb_embl_download)
         return file_path
 
 
@@ -225,6 +437,8 @@ class MainMenu:
 
         root: ui.LayoutNode = self._menu.root
         self.lst_groups: ui.UIList = root.find_node('lst_groups').get_content()
+        # id(MapGroup) -> MapGroupRow, in list order
+        self._group_rows = {}
 
         self.btn_add_group: ui.Button = root.find_node('ln_btn_add_group').get_content()
         ui_manager.register_btn_pressed_callback(self.btn_add_group, self.add_mapgroup)
@@ -235,6 +449,10 @@ class MainMenu:
         self.btn_load_from_vault: ui.Button = root.find_node('ln_btn_load_from_vault').get_content()
         ui_manager.register_btn_pressed_callback(self.btn_load_from_vault, self.open_vault_menu)
 
+        # Menus are created once, and reused every time they are opened.
+        self.emdb_menu = LoadFromEmdbMenu(plugin_instance)
+        self.edit_mesh_menu = EditMeshMenu(None, plugin_instance)
+
     async def render(self, force_enable=False, selected_mapgroup=None):
         if force_enable:
             self._menu.enabled = True
@@ -244,15 +462,14 @@ class MainMenu:
         if groups and not selected_mapgroup:
             selected_mapgroup = groups[0]
         self.render_map_groups(groups, selected_mapgroup)
-        self._plugin.client.update_menu(self._menu)
+        if force_enable:
+            self._plugin.client.update_menu(self._menu)
 
     def open_emdb_menu(self, btn):
-        self.emdb_menu = LoadFromEmdbMenu(self._plugin)
         self.emdb_menu.render()
-        pass
 
-    def open_vault_menu(self, btn):
-        self._plugin.vault_menu.show_menu()
+    async def open_vault_menu(self, btn):
+        await self._plugin.vault_menu.show_menu()
 
     @property
     def temp_dir(self):
@@ -264,52 +481,39 @@ class MainMenu:
         asyncio.create_task(self.render())
 
     def render_map_groups(self, mapgroups, selected_mapgroup=None):
-        self.lst_groups.items.clear()
-        for map_group in mapgroups:
-            ln: ui.LayoutNode = self.pfb_group_item.clone()
-            lbl: ui.Label = ln.find_node('Label').get_content()
+        """Update the group list, reusing the rows of groups that were already listed.
 
-            btn_add_to_map: ui.Button = ln.find_node('ln_btn_add_to_map').get_content()
-            btn_add_to_map.toggle_on_press = True
-            self._plugin.ui_manager.register_btn_pressed_callback(
-                btn_add_to_map, self.select_mapgroup)
-            btn_add_to_map.selected = map_group == selected_mapgroup
-            lbl.text_value = map_group.group_name
-
-            ln_group_details = ln.find_node('ln_group_details')
-            edit_mesh_btn: ui.Button = ln_group_details.get_content()
-            self._plugin.ui_manager.register_btn_pressed_callback(
-                edit_mesh_btn,
-                partial(self.open_edit_mesh_menu, map_group))
-
-            btn_delete: ui.Button = ln.find_node('Button Delete').get_content()
-            self._plugin.ui_manager.register_btn_pressed_callback(
-                btn_delete,
-                partial(self.delete_group, map_group))
-
-            btn_toggle: ui.Button = ln.find_node('Button Toggle').get_content()
-            btn_toggle.icon.value.set_all(
-                VISIBLE_ICON if map_group.visible else INVISIBLE_ICON)
-            self._plugin.ui_manager.register_btn_pressed_callback(
-                btn_toggle,
-                partial(self.toggle_group, map_group))
-
-            self.lst_groups.items.append(ln)
-        self._plugin.client.update_content(self.lst_groups)
+        The whole list is only sent when rows are added, removed or reordered.
+        Otherwise just the labels and buttons that changed are sent.
+        """
+        rows = {}
+        changed_contents = []
+        for map_group in mapgroups:
+            # Rows hold their MapGroup, so its id isn't reused while it is listed.
+            row = self._group_rows.get(id(map_group)) or MapGroupRow(self, map_group)
+            changed_contents.extend(row.update(map_group == selected_mapgroup))
+            rows[id(map_group)] = row
+        self._group_rows = rows
+        items = [row.ln for row in rows.values()]
+        if [id(item) for item in self.lst_groups.items] != [id(item) for item in items]:
+            self.lst_groups.items[:] = items
+            self._plugin.ui_updates.update_content(self.lst_groups)
+        elif changed_contents:
+            self._plugin.ui_updates.update_content(*changed_contents)
 
     def select_mapgroup(self, selected_btn: ui.Button):
         Logs.message('Selecting map group')
-        for item in self.lst_groups.items:
-            btn: ui.Button = item.find_node('ln_btn_add_to_map').get_content()
-            btn.selected = btn._content_id == selected_btn._content_id
-        self._plugin.client.update_content(self.lst_groups)
+        changed_contents = []
+        for row in self._group_rows.values():
+            selected = row.btn_select._content_id == selected_btn._content_id
+            changed_contents.extend(row.update(selected))
+        if changed_contents:
+            self._plugin.ui_updates.update_content(*changed_contents)
 
     def get_selected_mapgroup(self):
-        for item in self.lst_groups.items:
-            btn: ui.Button = item.find_node('ln_btn_add_to_map').get_content()
-            if btn.selected:
-                label = item.find_node('Label').get_content()
-                return label.text_value
+        for row in self._group_rows.values():
+            if row.btn_select.selected:
+                return row.map_group.group_name
 
     async def open_edit_mesh_menu(self, map_group, btn=None):
         if not map_group.has_map():
@@ -318,8 +522,15 @@ class MainMenu:
             Logs.warning('Tried to open menu before adding map.')
             return
         Logs.message('Loading group details menu')
-        edit_mesh_menu = EditMeshMenu(map_group, self._plugin)
-        edit_mesh_menu.render(map_group)
+        self.edit_mesh_menu.render(map_group)
+
+    def close_edit_mesh_menu(self, map_group):
+        """Close the edit mesh menu if it is showing map_group."""
+        menu = self.edit_mesh_menu
+        if menu.map_group is map_group and menu._menu.enabled:
+            menu.stop_preview()
+            menu._menu.enabled = False
+            self._plugin.client.update_menu(menu._menu)
 
     async def delete_group(self, map_group, btn):
         Logs.message(f'Deleting group {map_group.group_name}')
@@ -328,13 +539,63 @@ class MainMenu:
     def toggle_group(self, map_group, btn: ui.Button):
         Logs.message('Toggling group')
         map_group.visible = not map_group.visible
-        btn.icon.value.set_all(
-            VISIBLE_ICON if map_group.visible else INVISIBLE_ICON)
-        self._plugin.client.update_content(btn)
+        row = self._group_rows.get(id(map_group))
+        if row:
+            self._plugin.client.update_content(*row.update(row.btn_select.selected))
         self._plugin.client.update_structures_shallow([map_group.map_mesh.complex, map_group.model_complex])
 
 
+class MapGroupRow:
+    """Row of a MapGroup in the main menu's group list, created once per listed group."""
+
+    def __init__(self, main_menu: MainMenu, map_group):
+        self.map_group = map_group
+        ui_manager = main_menu._plugin.ui_manager
+        self.ln: ui.LayoutNode = main_menu.pfb_group_item.clone()
+        self.lbl: ui.Label = self.ln.find_node('Label').get_content()
+
+        self.btn_select: ui.Button = self.ln.find_node('ln_btn_add_to_map').get_content()
+        self.btn_select.toggle_on_press = True
+        ui_manager.register_btn_pressed_callback(self.btn_select, main_menu.select_mapgroup)
+
+        edit_mesh_btn: ui.Button = self.ln.find_node('ln_group_details').get_content()
+        ui_manager.register_btn_pressed_callback(
+            edit_mesh_btn, partial(main_menu.open_edit_mesh_menu, map_group))
+
+        btn_delete: ui.Button = self.ln.find_node('Button Delete').get_content()
+        ui_manager.register_btn_pressed_callback(
+            btn_delete, partial(main_menu.delete_group, map_group))
+
+        self.btn_toggle: ui.Button = self.ln.find_node('Button Toggle').get_content()
+        ui_manager.register_btn_pressed_callback(
+            self.btn_toggle, partial(main_menu.toggle_group, map_group))
+        # (group name, selected, visible) last shown in the row
+        self.rendered = None
+
+    def update(self, selected):
+        """Show the MapGroup's current state. Returns the contents that changed."""
+        name, visible = self.map_group.group_name, self.map_group.visible
+        rendered_name, rendered_selected, rendered_visible = self.rendered or (None, None, None)
+        # The button toggles itself when pressed, so it's compared to its own state.
+        changed = []
+        if name != rendered_name:
+            self.lbl.text_value = name
+            changed.append(self.lbl)
+        if selected != self.btn_select.selected or selected != rendered_selected:
+            self.btn_select.selected = selected
+            changed.append(self.btn_select)
+        if visible != rendered_visible:
+            self.btn_toggle.icon.value.set_all(VISIBLE_ICON if visible else INVISIBLE_ICON)
+            changed.append(self.btn_toggle)
+        self.rendered = (name, selected, visible)
+        return changed
+
+
 class EditMeshMenu:
+    """Settings of one MapGroup's mesh.
+
+    The main menu keeps a single instance, which is bound to a MapGroup each time it is rendered.
+    """
 
     # used to scale the isovalue slider when values are too small for slider to work with
     isovalue_scaling_factor = 100
@@ -354,7 +615,9 @@ class EditMeshMenu:
         self.btn_redraw_map.disable_on_press = True
         ui_manager.register_btn_pressed_callback(self.btn_redraw_map, self.redraw_new_isovalue)
         self.sld_isovalue: ui.Slider = root.find_node('sld_isovalue').get_content()
-        ui_manager.register_slider_change_callback(self.sld_isovalue, self.update_isovalue_lbl)
+        ui_manager.register_slider_change_callback(self.sld_isovalue, self.on_isovalue_changed)
+        ui_manager.register_slider_released_callback(self.sld_isovalue, self.on_isovalue_released)
+        self._preview_task = None
 
         self.sld_opacity: ui.Slider = root.find_node('sld_opacity').get_content()
         ui_manager.register_slider_change_callback(self.sld_opacity, self.update_opacity_lbl)
@@ -367,6 +630,9 @@ class EditMeshMenu:
         self.ln_isovalue_line: ui.LayoutNode = root.find_node('ln_isovalue_line')
 
         self.ln_img_histogram: ui.LayoutNode = root.find_node('img_histogram')
+        # ln_img_histogram switches between its label and this image, instead of new contents for every render.
+        self.lbl_histogram: ui.Label = self.ln_img_histogram.get_content()
+        self.img_histogram = ui.Image()
         self.dd_color_scheme: ui.Dropdown = root.find_node('dd_color_scheme').get_content()
         ui_manager.register_dropdown_item_clicked_callback(self.dd_color_scheme, self.set_color_scheme)
 
@@ -386,6 +652,9 @@ class EditMeshMenu:
             self.btn_box_around_selection, self.box_map_around_selection)
 
     def render(self, map_group: MapGroup):
+        """Show the menu for map_group, in a single update_menu unless the histogram needs generating."""
+        self.bind(map_group)
+        self._menu.enabled = True
         isovalue = map_group.isovalue or 0
         self._menu.title = f'{map_group.group_name} Map (Primary Contour: {round(isovalue, 3)})'
         # Populate file list
@@ -413,41 +682,65 @@ class EditMeshMenu:
                 item.selected = True
             else:
                 item.selected = False
-        if map_group.metadata:
-            resolution = map_group.metadata.resolution
-            self.lbl_resolution.text_value = f'{resolution} A' if resolution else ''
+        resolution = map_group.metadata.resolution if map_group.metadata else None
+        self.lbl_resolution.text_value = f'{resolution} A' if resolution else ''
         self.set_isovalue_ui(self.map_group)
         self.set_opacity_ui(self.map_group.opacity)
 
-        if map_group.has_map():
-            self.set_isovalue_slider_min_max(map_group)
-        if map_group.has_map() and not map_group.png_tempfile:
-            self.ln_img_histogram.add_new_label('Loading Contour Histogram...')
-
+        generate_histogram = map_group.has_map() and not map_group.png_tempfile
+        self.set_histogram_image(map_group)
         color_scheme_text = f"Color Scheme ({self.color_scheme.name})"
         self.dd_color_scheme.permanent_title = color_scheme_text
         self._plugin.client.update_menu(self._menu)
-        if map_group.has_map() and not map_group.png_tempfile:
+        if generate_histogram:
             # Generate histogram and add to menu.
             map_group.generate_histogram(self.temp_dir)
-            self.set_isovalue_slider_min_max(map_group)
-            self._plugin.client.update_content(self.sld_isovalue)
+            self.set_isovalue_ui(map_group)
+            self.set_histogram_image(map_group)
+            self._plugin.client.update_content(self.sld_isovalue, self.lbl_isovalue)
+            self._plugin.client.update_node(self.ln_img_histogram, self.ln_isovalue_line)
+
+    def bind(self, map_group: MapGroup):
+        """Point the menu's callbacks at map_group."""
+        if map_group is self.map_group:
+            return
+        self.stop_preview()
+        self.map_group = map_group
+
+    def stop_preview(self):
+        """Stop previewing the slider's isovalue, and show the bound group's full quality mesh again."""
+        if self._preview_task:
+            self._preview_task.cancel()
+            self._preview_task = None
+        if self.map_group:
+            self.map_group.end_preview()
+
+    def set_histogram_image(self, map_group: MapGroup):
         if map_group.png_tempfile:
-            self.ln_img_histogram.add_new_image(map_group.png_tempfile.name)
-        self._plugin.client.update_node(self.ln_img_histogram)
+            self.img_histogram.file_path = map_group.png_tempfile.name
+            self.ln_img_histogram.set_content(self.img_histogram)
+            return
+        self.lbl_histogram.text_value = 'Loading Contour Histogram...' if map_group.has_map() else ''
+        self.ln_img_histogram.set_content(self.lbl_histogram)
 
     def set_isovalue_ui(self, map_group):
+        # Sent with the menu, so the labels aren't updated separately.
         self.set_isovalue_slider_min_max(map_group)
-        self.update_isovalue_lbl(self.sld_isovalue)
+        self.set_isovalue_lbl()
 
     def set_opacity_ui(self, opacity: float):
         self.sld_opacity.current_value = opacity
-        self.update_opacity_lbl(self.sld_opacity)
+        self.set_opacity_lbl()
 
     def update_isovalue_lbl(self, sld):
+        self.set_isovalue_lbl()
+        self._plugin.ui_updates.update_content(self.lbl_isovalue, sld)
+        if self.map_group.has_histogram():
+            self._plugin.ui_updates.update_node(self.ln_isovalue_line)
+
+    def set_isovalue_lbl(self):
         slider_value = self.get_isovalue_from_slider()
         self.lbl_isovalue.text_value = f'{round(slider_value, 3)} A'
-        self._plugin.client.update_content(self.lbl_isovalue, sld)
 
         # /!\ calculation is sensitive to menu and image dimensions
         # position histogram line based on isovalue
@@ -459,36 +752,79 @@ class EditMeshMenu:
             x = (current_value - x_min) / (x_max - x_min)
             left = (100 + x * 620) / 800
             self.ln_isovalue_line.set_padding(left=left)
-            self._plugin.client.update_node(self.ln_isovalue_line)
+
+    @property
+    def live_preview(self):
+        return LIVE_PREVIEW and self.map_group.has_map() and self.map_group.extraction_type == EXTRACTION_TYPE.FULL_MAP
+
+    def on_isovalue_changed(self, sld):
+        self.update_isovalue_lbl(sld)
+        if self.live_preview and not (self._preview_task and not self._preview_task.done()):
+            self._preview_task = asyncio.create_task(self.preview_isovalues())
+
+    async def preview_isovalues(self):
+        """Preview the slider's isovalue while it changes, at most once per PREVIEW_INTERVAL.
+
+        If the slider rests for PREVIEW_RELEASE_TIMEOUT without being released, e.g. the release
+        event was lost, the full map is redrawn at its isovalue.
+        """
+        previewed_isovalue = None
+        resting_time = 0
+        while resting_time < PREVIEW_RELEASE_TIMEOUT:
+            isovalue = self.get_isovalue_from_slider()
+            if isovalue == previewed_isovalue:
+                resting_time += PREVIEW_INTERVAL
+                await asyncio.sleep(PREVIEW_INTERVAL)
+                continue
+            resting_time = 0
+            previewed_isovalue = isovalue
+            await asyncio.gather(
+                self.map_group.generate_preview_mesh(isovalue), asyncio.sleep(PREVIEW_INTERVAL))
+        Logs.debug("Isovalue slider wasn't released, redrawing map")
+        await self.redraw_map()
+
+    async def on_isovalue_released(self, sld):
+        if not self.live_preview:
+            return
+        if self._preview_task:
+            self._preview_task.cancel()
+        await self.redraw_map()
 
     def update_opacity_lbl(self, sld):
-        self.lbl_opacity.text_value = str(round(100 * sld.current_value))
-        self._plugin.client.update_content(self.lbl_opacity, sld)
+        self.set_opacity_lbl()
+        self._plugin.ui_updates.update_content(self.lbl_opacity, sld)
+
+    def set_opacity_lbl(self):
+        self.lbl_opacity.text_value = str(round(100 * self.sld_opacity.current_value))
 
     def sld_radius_update(self, sld):
         sld_current_val = sld.current_value
         self.lbl_radius.text_value = f'{round(sld_current_val, 2)} A'
-        self._plugin.client.update_content(self.lbl_radius, sld)
+        self._plugin.ui_updates.update_content(self.lbl_radius, sld)
 
     async def show_full_map(self, btn):
         Logs.message("Showing full map...")
-        await self.map_group.generate_full_mesh()
+        await self.map_group.generate_full_mesh(priority=JobPriority.INTERACTIVE)
         self._plugin.client.update_content(btn)
+        await self._plugin.checkpoint_session()
 
     async def box_map_around_selection(self, btn: ui.Button):
         Logs.message("Extracting map around selection...")
         await self.map_group.generate_mesh_around_selection()
         self._plugin.client.update_content(btn)
+        await self._plugin.checkpoint_session()
 
     async def box_map_around_model(self, btn):
         Logs.message("Extracting map around model...")
         await self.map_group.generate_mesh_around_model()
         self._plugin.client.update_content(btn)
+        await self._plugin.checkpoint_session()
 
     async def update_color(self, *args):
         color_scheme = self.color_scheme
         opacity = self.opacity
         await self.map_group.update_color(color_scheme, opacity)
+        await self._plugin.checkpoint_session()
 
     async def redraw_map(self, btn=None):
         self.map_group.isovalue = self.get_isovalue_from_slider()
@@ -496,6 +832,9 @@ class EditMeshMenu:
         self.map_group.color_scheme = self.color_scheme
         if self.map_group.has_map():
             await self.map_group.redraw_mesh()
+            # The redraw replaced any preview, unless it failed.
+            self.map_group.end_preview()
+            await self._plugin.checkpoint_session()
 
     async def redraw_new_isovalue(self, btn):
         rendered_isovalue = self.sld_isovalue.current_value
@@ -532,6 +871,7 @@ class EditMeshMenu:
         self.dd_color_scheme.permanent_title = f"Color Scheme ({self.color_scheme.name})"
         self._plugin.client.update_content(self.dd_color_scheme)
         await self.map_group.update_color(self.color_scheme, self.opacity)
+        await self._plugin.checkpoint_session()
 
     def set_isovalue_slider_min_max(self, map_group):
         min_value = map_group.hist_x_min
@@ -0,0 +1,175 @@
+import hashlib
+import json
+import mmap
+import struct
+import numpy as np
+
+from nanome.api import shapes
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+__all__ = ["MESH_ARTIFACT_SUFFIX", "MeshArtifact", "hash_file"]
+
+# Mesh artifacts are saved next to their map, e.g. emd_8216.map.gz.mesh
+MESH_ARTIFACT_SUFFIX = '.mesh'
+MAGIC = b'NMMESH'
+# magic, metadata length
+PREFIX = struct.Struct('<6sI')
+FORMAT_VERSION = 2
+# Arrays start on aligned offsets, so they can be viewed in place from a memory map.
+ALIGNMENT = 16
+HASH_CHUNK_SIZE = 1024 * 1024
+ZSTD_LEVEL = 3
+
+# name -> (dtype, values per element)
+ARRAYS = {
+    'vertices': (np.float32, 3),
+    'normals': (np.float32, 3),
+    'triangles': (np.uint32, 3),
+    # RGBA, 4 floats per vertex like shapes.Mesh.colors
+    'colors': (np.float32, 4),
+}
+
+
+def hash_file(filepath):
+    """sha256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MeshArtifact:
+    """Generated map mesh with the settings it was generated from.
+
+    Serialized as a JSON metadata block followed by float32 vertices, float32 normals,
+    uint32 triangles and optional float32 RGBA colors. The metadata lists the offset
+    and size of each array, and arrays are aligned so `load` can view them in place
+    from a memory map. Triangles can optionally be zstd compressed.
+    Version 1 files, without the array table, can still be read.
+    """
+
+    def __init__(self, vertices, normals, triangles, metadata=None, colors=None):
+        self.vertices = np.asarray(vertices, dtype=np.float32).ravel()
+        self.normals = np.asarray(normals, dtype=np.float32).ravel()
+        self.triangles = np.asarray(triangles, dtype=np.uint32).ravel()
+        self.colors = None if colors is None else np.asarray(colors, dtype=np.float32).ravel()
+        self.metadata = metadata or {}
+
+    @classmethod
+    def from_mesh(cls, mesh: shapes.Mesh, **metadata):
+        colors = mesh.colors if len(mesh.colors) else None
+        return cls(mesh.vertices, mesh.normals, mesh.triangles, metadata, colors)
+
+    def to_mesh(self):
+        # Arrays are shared, not copied, so a memory mapped mesh stays mapped.
+        mesh = shapes.Mesh()
+        mesh.vertices = self.vertices
+        mesh.normals = self.normals
+        mesh.triangles = self.triangles
+        if self.colors is not None:
+            mesh.colors = self.colors
+        return mesh
+
+    @property
+    def isovalue(self):
+        return self.metadata.get('isovalue')
+
+    @property
+    def source_hash(self):
+        return self.metadata.get('source_sha256')
+
+    def to_bytes(self, compress=False):
+        """Serialize the mesh. compress: zstd compress the triangles, requires zstandard."""
+        if compress and zstandard is None:
+            raise ValueError("zstandard is required to compress meshes")
+        buffers = {name: getattr(self, name).tobytes() for name in ARRAYS if getattr(self, name) is not None}
+        if compress:
+            buffers['triangles'] = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(buffers['triangles'])
+
+        # Offsets are relative to the end of the metadata block.
+        table = {}
+        offset = 0
+        for name, buffer in buffers.items():
+            count = len(getattr(self, name)) // ARRAYS[name][1]
+            table[name] = {'offset': offset, 'nbytes': len(buffer), 'count': count}
+            offset = self._align(offset + len(buffer))
+        if compress:
+            table['triangles']['compression'] = 'zstd'
+        metadata = dict(self.metadata, format_version=FORMAT_VERSION, arrays=table)
+        metadata_bytes = json.dumps(metadata).encode()
+        metadata_bytes = metadata_bytes.ljust(self._align(PREFIX.size + len(metadata_bytes)) - PREFIX.size)
+
+        parts = [PREFIX.pack(MAGIC, len(metadata_bytes)), metadata_bytes]
+        position = 0
+        for name, entry in table.items():
+            parts.append(bytes(entry['offset'] - position))
+            parts.append(buffers[name])
+            position = entry['offset'] + entry['nbytes']
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Load a mesh from bytes, or any buffer such as a memory map, without copying.
+
+        Raises ValueError if data is not a complete mesh artifact.
+        """
+        if len(data) < PREFIX.size:
+            raise ValueError("Mesh artifact is truncated")
+        magic, metadata_length = PREFIX.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("Not a mesh artifact")
+        data_start = PREFIX.size + metadata_length
+        metadata = json.loads(bytes(data[PREFIX.size:data_start]))
+        version = metadata.pop('format_version', 1)
+        if version > FORMAT_VERSION:
+            raise ValueError(f"Unsupported mesh artifact version {version}")
+        table = metadata.pop('arrays') if version > 1 else cls._v1_table(metadata)
+
+        arrays = {}
+        for name, entry in table.items():
+            dtype, width = ARRAYS[name]
+            start = data_start + entry['offset']
+            if start + entry['nbytes'] > len(data):
+                raise ValueError("Mesh artifact is truncated")
+            if entry.get('compression') == 'zstd':
+                if zstandard is None:
+                    raise ValueError("zstandard is required to read compressed meshes")
+                raw = zstandard.ZstdDecompressor().decompress(data[start:start + entry['nbytes']])
+                arrays[name] = np.frombuffer(raw, dtype)
+            else:
+                arrays[name] = np.frombuffer(data, dtype, entry['count'] * width, start)
+        if version == 1 and data_start + sum(e['nbytes'] for e in table.values()) != len(data):
+            raise ValueError("Mesh artifact is truncated")
+        return cls(arrays['vertices'], arrays['normals'], arrays['triangles'], metadata, arrays.get('colors'))
+
+    @staticmethod
+    def _v1_table(metadata):
+        # Version 1 stored vertices, normals and triangles back to back after the metadata.
+        table = {}
+        offset = 0
+        for name, count_key in (('vertices', 'vertex_count'), ('normals', 'normal_count'), ('triangles', 'triangle_count')):
+            count = metadata.pop(count_key)
+            table[name] = {'offset': offset, 'count': count, 'nbytes': count * 12}
+            offset += count * 12
+        return table
+
+    def save(self, path, compress=False):
+        with open(path, 'wb') as f:
+            f.write(self.to_bytes(compress))
+
+    @classmethod
+    def load(cls, path):
+        """Load a mesh file through a read-only memory map, so arrays are paged in on use."""
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # The arrays keep the memory map open.
+        return cls.from_bytes(buffer)
+
+    @staticmethod
+    def _align(offset):
+        return -(-offset // ALIGNMENT) * ALIGNMENT
@@ -0,0 +1,215 @@
+import bisect
+import math
+import os
+import threading
+import time
+from aiohttp import web
+from nanome.util import Logs
+
+from . import memory
+
+__all__ = ["MetricsRegistry", "MetricsServer", "registry", "span"]
+
+# Port of the local Prometheus endpoint started by run.py. Disabled when 0.
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+# Seconds between reports of a session's observations to run.py.
+METRICS_REPORT_INTERVAL = 10
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+COUNT_BUCKETS = tuple(10 ** exponent for exponent in range(2, 10))
+PAYLOAD_BUCKETS = tuple(10 ** exponent for exponent in range(0, 8))
+# 1MB to 128GB
+MEMORY_BUCKETS = tuple(2 ** exponent for exponent in range(20, 38))
+
+# name -> (help, buckets)
+METRICS = {
+    'cryoem_stage_seconds': ("Duration of map and mesh pipeline stages.", SECONDS_BUCKETS),
+    'cryoem_stage_voxels': ("Voxels of the map processed by a stage.", COUNT_BUCKETS),
+    'cryoem_stage_vertices': ("Vertices output by a stage.", COUNT_BUCKETS),
+    'cryoem_stage_triangles': ("Triangles output by a stage.", COUNT_BUCKETS),
+    'cryoem_stage_bytes': ("Bytes downloaded or read by a stage.", COUNT_BUCKETS),
+    'cryoem_stage_peak_rss_bytes': ("Peak resident memory of the process during a stage.", MEMORY_BUCKETS),
+    'cryoem_stage_traced_peak_bytes': ("Peak Python allocations made by a stage.", MEMORY_BUCKETS),
+    'cryoem_rpc_seconds': ("Latency of requests to Nanome.", SECONDS_BUCKETS),
+    'cryoem_rpc_payload': ("Complexes or shape vertices sent or requested per request to Nanome.", PAYLOAD_BUCKETS),
+    'cryoem_rpc_serial_gap_seconds': (
+        "Time between back to back requests to Nanome that could have been batched.", SECONDS_BUCKETS),
+}
+
+
+def size_label(voxels):
+    """Order of magnitude of a map's voxel count, so observations of similar maps are aggregated."""
+    return f'1e{int(math.log10(voxels))}' if voxels else '0'
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # Observations per bucket, the last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """Histograms of the observations made in this process.
+
+    Session processes and compute workers keep their observations as unreported,
+    until they are merged into the registry of run.py, which serves them on the metrics endpoint.
+    """
+
+    def __init__(self, report=bool(METRICS_PORT)):
+        # Added to every observation, e.g. the session id.
+        self.labels = {}
+        # (name, labels) -> Histogram
+        self.histograms = {}
+        # name -> (help, callable returning [(labels, value)])
+        self.gauges = {}
+        self.unreported = [] if report else None
+        # Stages run in executor threads too.
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        labels = dict(self.labels, **labels)
+        with self._lock:
+            self._record(name, value, labels)
+            if self.unreported is not None:
+                self.unreported.append((name, value, labels))
+
+    def merge(self, observations):
+        """Add observations reported by another process."""
+        with self._lock:
+            for name, value, labels in observations:
+                self._record(name, value, labels)
+
+    def take_unreported(self):
+        with self._lock:
+            if not self.unreported:
+                return []
+            observations, self.unreported = self.unreported, []
+        return observations
+
+    def remove_series(self, **labels):
+        """Remove the histograms with all of labels, e.g. those of a session that ended."""
+        labels = set(labels.items())
+        with self._lock:
+            for key in [key for key in self.histograms if labels <= set(key[1])]:
+                del self.histograms[key]
+
+    def add_gauge(self, name, help_text, collect):
+        self.gauges[name] = (help_text, collect)
+
+    def _record(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if not histogram:
+            histogram = self.histograms[key] = Histogram(METRICS[name][1])
+        histogram.observe(value)
+
+    def render(self):
+        """The metrics in the Prometheus text format."""
+        lines = []
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            histogram_names = sorted({name for name, _ in self.histograms})
+            for metric_name in histogram_names:
+                lines.append(f'# HELP {metric_name} {METRICS[metric_name][0]}')
+                lines.append(f'# TYPE {metric_name} histogram')
+                for (name, labels), histogram in histograms:
+                    if name != metric_name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {cumulative}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+                    lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+        for name, (help_text, collect) in sorted(self.gauges.items()):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            for labels, value in collect():
+                lines.append(f'{name}{format_labels(tuple(sorted(labels.items())))} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+registry = MetricsRegistry()
+
+
+class span:
+    """Time a stage of the map and mesh pipeline, as cryoem_stage_seconds{stage=...}.
+
+    Counts like voxels, vertices or triangles can be passed in, or set on span.counts inside
+    the block. They are recorded in their own histograms, and the voxel count labels
+    the observations with the map size. With MEMORY_TRACKING, the stage's peak memory is recorded too.
+    Stages that raise are not recorded.
+    """
+
+    def __init__(self, stage, **counts):
+        self.stage = stage
+        self.counts = counts
+        self.seconds = None
+        self.memory = memory.StageMemory() if memory.MEMORY_TRACKING else None
+
+    def __enter__(self):
+        if self.memory:
+            self.memory.start()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.seconds = time.perf_counter() - self._start
+        if self.memory:
+            self.memory.stop()
+        if exc_type:
+            return
+        labels = {'stage': self.stage}
+        if 'voxels' in self.counts:
+            labels['map_size'] = size_label(self.counts['voxels'])
+        registry.observe('cryoem_stage_seconds', self.seconds, **labels)
+        for name, value in self.counts.items():
+            registry.observe(f'cryoem_stage_{name}', value, **labels)
+        if self.memory:
+            registry.observe('cryoem_stage_peak_rss_bytes', self.memory.peak_rss, **labels)
+            if self.memory.traced_peak is not None:
+                registry.observe('cryoem_stage_traced_peak_bytes', self.memory.traced_peak, **labels)
+
+
+class MetricsServer:
+    """Serves a registry on http://METRICS_HOST:METRICS_PORT/metrics, started by run.py."""
+
+    def __init__(self, registry=registry, host=METRICS_HOST, port=METRICS_PORT):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle_metrics)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        Logs.message(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def close(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def handle_metrics(self, request):
+        return web.Response(text=self.registry.render(), content_type='text/plain', charset='utf-8')
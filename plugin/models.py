@@ -9,7 +9,7 @@ import pyfqmr
 import randomcolor
 import sys
 import tempfile
-import time
+from contextlib import asynccontextmanager
 from iotbx.data_manager import DataManager
 from iotbx.map_manager import map_manager
 from iotbx.map_model_manager import map_model_manager
@@ -20,8 +20,19 @@ from typing import List
 from nanome.api import shapes, structure
 from nanome.util import Color, Logs, enums
 
+from .compute import ComputeError, JobPriority
+from .memory import InsufficientMemory, estimate_model_map_memory
+from .mesh_io import MeshArtifact
+from .metrics import span
+from .preview import MeshPreview
 from .utils import cpk_colors, create_hidden_complex, get_extension
 
+# Mesh simplification settings, stored with mesh artifacts.
+MESH_DECIMATION_FACTOR = 5
+MESH_SIMPLIFY_AGGRESSIVENESS = 7
+# Vertices converted to cartesian between cancellation checks.
+VERTEX_CHUNK_SIZE = 100000
+
 
 class EXTRACTION_TYPE(enum.Enum):
     FULL_MAP = 0
@@ -29,6 +40,44 @@ class EXTRACTION_TYPE(enum.Enum):
     SELECTION = 2
 
 
+class MeshJobCancelled(Exception):
+    """The mesh job was superseded by a newer one, or its MapGroup was deleted."""
+
+
+class MeshJob:
+    """Token for one mesh generation of a MapGroup.
+
+    Stages check the token, and stop with MeshJobCancelled once the job is cancelled.
+    Stages awaited with wait() are cancelled right away, e.g. a job in the compute service.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._tasks = set()
+
+    def cancel(self):
+        self.cancelled = True
+        for task in self._tasks:
+            task.cancel()
+
+    def check(self):
+        if self.cancelled:
+            raise MeshJobCancelled()
+
+    async def wait(self, awaitable):
+        self.check()
+        task = asyncio.ensure_future(awaitable)
+        self._tasks.add(task)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if self.cancelled:
+                raise MeshJobCancelled()
+            raise
+        finally:
+            self._tasks.discard(task)
+
+
 class MapMesh:
     """Manages generated map from .map.gz file and renders as Mesh in workspace.
 
@@ -44,6 +93,7 @@ class MapMesh:
         self.mesh_backface: shapes.Mesh = shapes.Mesh()
         self.backface = True
         self.map_manager: map_manager = None
+        self._upload_lock = None
         if mapfile:
             self.map_manager = self.load_mapfile(mapfile)
             self.complex = self.create_map_complex()
@@ -52,9 +102,10 @@ class MapMesh:
     def mapfile(self):
         return self.__mapfile
 
-    def add_mapfile(self, filepath: str):
+    def add_mapfile(self, filepath: str, map_manager: map_manager = None):
+        """Set the map for this mesh. Pass map_manager if it was already loaded from filepath."""
         self.__mapfile = filepath
-        self.map_manager = self.load_mapfile(filepath)
+        self.map_manager = map_manager or self.load_mapfile(filepath)
         self.complex = self.create_map_complex(self.map_manager, filepath)
 
     @property
@@ -73,18 +124,86 @@ class MapMesh:
     def colors(self, value: Color):
         self.mesh.colors = value
 
+    @property
+    def upload_lock(self):
+        # Created lazily, so it is bound to the running event loop.
+        if self._upload_lock is None:
+            self._upload_lock = asyncio.Lock()
+        return self._upload_lock
+
     async def upload(self):
-        meshes = [self.mesh]
-        if self.backface:
-            meshes.append(self.mesh_backface)
-        if self.mesh.index == -1:
-            # Make sure indices get set
-            uploaded_meshes = await self._plugin.client.shapes_upload_multiple(meshes)
-            self.mesh = uploaded_meshes[0]
+        # Uploads are serialized, so a second upload can't start before
+        # the first one has set the mesh index, and create a duplicate mesh.
+        async with self.upload_lock:
+            meshes = [self.mesh]
             if self.backface:
-                self.mesh_backface = uploaded_meshes[1]
-        else:
-            asyncio.create_task(self._plugin.client.shapes_upload_multiple(meshes))
+                meshes.append(self.mesh_backface)
+            if self.mesh.index == -1:
+                # Make sure indices get set
+                with span('upload', vertices=len(self.mesh.vertices) // 3):
+                    uploaded_meshes = await self._plugin.client.shapes_upload_multiple(meshes)
+                self.mesh = uploaded_meshes[0]
+                if self.backface:
+                    self.mesh_backface = uploaded_meshes[1]
+            else:
+                asyncio.create_task(self._upload_meshes(meshes))
+
+    async def _upload_meshes(self, meshes):
+        with span('upload', vertices=len(meshes[0].vertices) // 3):
+            await self._plugin.client.shapes_upload_multiple(meshes)
+
+    def write_mesh(self, path, compress=False, **metadata):
+        """Save the current mesh and its colors to a mesh file, with optional metadata.
+
+        compress: zstd compress the triangles, requires zstandard.
+        """
+        MeshArtifact.from_mesh(self.mesh, **metadata).save(path, compress)
+
+    @staticmethod
+    def read_mesh(path):
+        """Memory map a mesh file saved with write_mesh. Returns (shapes.Mesh, metadata)."""
+        artifact = MeshArtifact.load(path)
+        return artifact.to_mesh(), artifact.metadata
+
+    @staticmethod
+    def create_mesh_artifact(mesh: shapes.Mesh, isovalue, source_hash):
+        """Store the geometry of a full map mesh, with the settings needed to check it can be reused.
+
+        Colors are left out, they depend on the group's model and color scheme.
+        """
+        return MeshArtifact(mesh.vertices, mesh.normals, mesh.triangles, {
+            'isovalue': float(isovalue),
+            'source_sha256': source_hash,
+            'decimation_factor': MESH_DECIMATION_FACTOR,
+            'aggressiveness': MESH_SIMPLIFY_AGGRESSIVENESS,
+        })
+
+    @staticmethod
+    def is_mesh_artifact_current(artifact: MeshArtifact, source_hash):
+        """Whether artifact was generated from the map with source_hash, with the current mesh settings."""
+        metadata = artifact.metadata
+        return (
+            artifact.source_hash == source_hash
+            and metadata.get('decimation_factor') == MESH_DECIMATION_FACTOR
+            and metadata.get('aggressiveness') == MESH_SIMPLIFY_AGGRESSIVENESS)
+
+    @staticmethod
+    def compute_map_stats(map_manager: map_manager):
+        """Statistics used for the default isovalue and the histogram range."""
+        map_data = map_manager.map_data().as_numpy_array()
+        with span('stats', voxels=map_data.size):
+            # Accumulate in float64, maps from the map store are float32
+            mean = float(np.mean(map_data, dtype=np.float64))
+            # Sample standard deviation
+            stdev = float(np.std(map_data, ddof=1, dtype=np.float64))
+            return {
+                'mean': mean,
+                'stdev': stdev,
+                'min': float(np.min(map_data)),
+                'max': float(np.max(map_data)),
+                # Best guess isovalue is the mean + 1 standard deviation
+                'default_isovalue': mean + stdev,
+            }
 
     def load_mesh_backface(self):
         vertices = self.mesh.vertices
@@ -96,18 +215,25 @@ class MapMesh:
         self.mesh_backface.normals = np.array([-n for n in normals]).flatten()
         self.mesh_backface.triangles = np.array([[t[1], t[0], t[2]] for t in triangles]).flatten()
 
-    async def load(self, map_manager: map_manager, isovalue, opacity, selected_residues=None):
-        """Create complex, Generate Mesh, and attach mesh to complex."""
+    async def load(self, map_manager: map_manager, isovalue, opacity, selected_residues=None, mesh=None):
+        """Create complex, Generate Mesh, and attach mesh to complex.
+
+        map_manager: Map the mesh is generated from, e.g. the map model manager's map.
+            The mesh keeps the map set by add_mapfile.
+        mesh: Optional mesh already generated from map_manager at isovalue.
+        """
         selected_residues = selected_residues or []
-        self.map_manager = map_manager
 
-        new_mesh = self.generate_mesh_from_map_manager(map_manager, isovalue)
+        new_mesh = mesh or self.generate_mesh_from_map_manager(map_manager, isovalue)
         if len(list(selected_residues)) > 0:
-            new_mesh.vertices, new_mesh.normals, new_mesh.triangles = self.limit_view(
-                new_mesh.vertices,
-                new_mesh.normals,
-                new_mesh.triangles,
-                selected_residues)
+            with span('crop') as crop_span:
+                new_mesh.vertices, new_mesh.normals, new_mesh.triangles = self.limit_view(
+                    new_mesh.vertices,
+                    new_mesh.normals,
+                    new_mesh.triangles,
+                    selected_residues)
+                crop_span.counts.update(
+                    vertices=len(new_mesh.vertices) // 3, triangles=len(new_mesh.triangles) // 3)
         new_mesh._index = self.mesh.index
         self.mesh = new_mesh
 
@@ -145,15 +271,18 @@ class MapMesh:
         with tempfile.NamedTemporaryFile(suffix='.mrc') as mrc_file:
             mrc_filepath = mrc_file.name
             if extension.endswith('.gz'):
-                with gzip.open(mapfile, 'rb') as f:
+                with span('decompress') as decompress_span, gzip.open(mapfile, 'rb') as f:
                     data = f.read()
                     data_size_mb = round(sys.getsizeof(data) / 10 ** 6, 2)
                     Logs.debug(f"Unzipped file size: {data_size_mb}MB")
                     mrc_file.write(data)
+                    decompress_span.counts['bytes'] = len(data)
             else:
                 with open(mapfile, 'rb') as f:
                     mrc_file.write(f.read())
-            map_manager = dm.get_real_map(mrc_filepath)
+            with span('parse') as parse_span:
+                map_manager = dm.get_real_map(mrc_filepath)
+                parse_span.counts['voxels'] = map_manager.map_data().size()
         return map_manager
 
     @staticmethod
@@ -171,37 +300,64 @@ class MapMesh:
         return comp
 
     @staticmethod
-    def generate_mesh_from_map_manager(map_manager, isovalue):
+    async def generate_mesh(map_manager, isovalue, job: MeshJob = None, stride=1):
+        """Run generate_mesh_from_map_manager in a worker thread, stopping early if job is cancelled."""
+        loop = asyncio.get_event_loop()
+        generate = loop.run_in_executor(
+            None, MapMesh.generate_mesh_from_map_manager, map_manager, isovalue, job and job.check, stride)
+        return await (job.wait(generate) if job else generate)
+
+    @staticmethod
+    def generate_mesh_from_map_manager(map_manager, isovalue, check_cancelled=None, stride=1):
+        """check_cancelled: Optional callable raising an exception to stop between stages.
+
+        stride: Mesh every stride-th voxel along each axis, for maps whose full resolution mesh
+        doesn't fit in memory.
+        """
+        check_cancelled = check_cancelled or (lambda: None)
         Logs.message("Generating Mesh from map...")
         Logs.debug("Marching Cubes...")
         map_origin = map_manager.origin
         map_data = map_manager.map_data().as_numpy_array()
-        grid_vertices, triangles = mcubes.marching_cubes(map_data, isovalue)
+        if stride > 1:
+            Logs.message(f"Meshing every {stride} voxels to fit in memory")
+            map_data = np.ascontiguousarray(map_data[::stride, ::stride, ::stride])
+        voxels = map_data.size
+        with span('marching_cubes', voxels=voxels) as cubes_span:
+            grid_vertices, triangles = mcubes.marching_cubes(map_data, isovalue)
+            cubes_span.counts.update(vertices=len(grid_vertices), triangles=len(triangles))
         Logs.debug("Cubes Marched")
+        check_cancelled()
+        if stride > 1:
+            grid_vertices *= stride
         # offset the vertices using the map origin
         # this makes sure the mesh is in the same coordinates as the molecule
         grid_vertices += np.asarray(map_origin)
         # convert vertices from grid units to cartesian angstroms
         Logs.debug(f"Vertices Count: {grid_vertices.shape[0]}")
         Logs.debug("Converting vertices to cartesian coordinates...")
-        start_time = time.time()
-        vertices_map = map(map_manager.grid_units_to_cart, grid_vertices)
-        # Convert the map object to a 1D numpy array
-        arr = np.fromiter((item for sublist in vertices_map for item in sublist), dtype=np.float64)
-        # Reshape the array to the desired shape
-        vertices = arr.reshape(-1, 3)
-        end_time = time.time()
-        Logs.debug(f"Vertices converted to cartesian in {round(end_time - start_time, 1)} seconds")
+        with span('coordinate_transform', voxels=voxels, vertices=len(grid_vertices)) as transform_span:
+            chunks = []
+            for start in range(0, len(grid_vertices), VERTEX_CHUNK_SIZE):
+                check_cancelled()
+                vertices_map = map(map_manager.grid_units_to_cart, grid_vertices[start:start + VERTEX_CHUNK_SIZE])
+                # Convert the map object to a 1D numpy array
+                chunks.append(np.fromiter((item for sublist in vertices_map for item in sublist), dtype=np.float64))
+            # Reshape the array to the desired shape
+            vertices = np.concatenate(chunks or [np.empty(0)]).reshape(-1, 3)
+        Logs.debug(f"Vertices converted to cartesian in {round(transform_span.seconds, 1)} seconds")
+        check_cancelled()
 
         Logs.debug("Simplifying mesh...")
-        decimation_factor = 5
-        target = max(1000, len(triangles) / decimation_factor)
-        mesh_simplifier = pyfqmr.Simplify()
-        mesh_simplifier.setMesh(vertices, triangles)
-        mesh_simplifier.simplify_mesh(
-            target_count=target, aggressiveness=7, preserve_border=True, verbose=0)
+        with span('simplify', voxels=voxels) as simplify_span:
+            target = max(1000, len(triangles) / MESH_DECIMATION_FACTOR)
+            mesh_simplifier = pyfqmr.Simplify()
+            mesh_simplifier.setMesh(vertices, triangles)
+            mesh_simplifier.simplify_mesh(
+                target_count=target, aggressiveness=MESH_SIMPLIFY_AGGRESSIVENESS, preserve_border=True, verbose=0)
+            vertices, triangles, normals = mesh_simplifier.getMesh()
+            simplify_span.counts.update(vertices=len(vertices), triangles=len(triangles))
         Logs.debug("Mesh Simplified")
-        vertices, triangles, normals = mesh_simplifier.getMesh()
 
         # Setting up mesh.
         mesh = shapes.Mesh()
@@ -210,6 +366,19 @@ class MapMesh:
         mesh.triangles = triangles.flatten()
         return mesh
 
+    def cctbx_map_manager(self):
+        """The map as a cctbx map_manager.
+
+        Each call returns a new copy, as the map model manager shifts and replaces its map in place.
+        Maps from the map store stay shared. Blocking, run it in an executor.
+        """
+        if not isinstance(self.map_manager, map_manager):
+            return self.map_manager.cctbx_map_manager()
+        copy = self.map_manager.deep_copy()
+        # Set by the map file reader, and not copied.
+        copy.origin = self.map_manager.origin
+        return copy
+
     @property
     def map_origin(self):
         if hasattr(self, 'map_manager'):
@@ -283,6 +452,8 @@ class MapGroup:
         self.group_name: str = kwargs.get("group_name", "")
         self.files: List[str] = kwargs.get("files", [])
         self.map_mesh = MapMesh(plugin)
+        # SharedMap attached from the plugin's map store, released when the group's map is replaced or deleted.
+        self.shared_map = None
         self.metadata = None
 
         self.hist_x_min = float('-inf')
@@ -292,12 +463,63 @@ class MapGroup:
         self.__visible = True
         self.position = [0.0, 0.0, 0.0]
         self.isovalue = None
+        # Downsampling of the full map mesh, set by the plugin's memory budget
+        self.mesh_stride = 1
         self.opacity = 0.65
         self.color_scheme = enums.ColorScheme.Element
 
         self._model: manager = None
+        self.model_file: str = None
         self.__model_complex: structure.Complex = None
         self.extraction_type = EXTRACTION_TYPE.FULL_MAP
+        self._lock = None
+        self._mesh_job: MeshJob = None
+        # MeshPreview of the map meshed by generate_full_mesh, created on the first preview
+        self._preview: MeshPreview = None
+        # (mapfile, model) the preview was created from
+        self._preview_source = None
+        self._preview_job: MeshJob = None
+        # Mesh shown again when the preview ends, unless a mesh job replaces the preview first
+        self._mesh_before_preview: shapes.Mesh = None
+
+    @property
+    def lock(self):
+        """Serializes steps that change this group's workspace objects."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def start_mesh_job(self) -> MeshJob:
+        """Cancel the group's in-flight mesh job, and return the token of a new one.
+
+        Only the latest job reaches the workspace, so a newer redraw or extraction supersedes older ones,
+        and previews.
+        """
+        self.cancel_mesh_job()
+        self._mesh_job = MeshJob()
+        return self._mesh_job
+
+    def cancel_mesh_job(self):
+        if self._mesh_job:
+            self._mesh_job.cancel()
+            self._mesh_job = None
+        self._cancel_preview_job()
+
+    def _finish_mesh_job(self, job: MeshJob):
+        if self._mesh_job is job:
+            self._mesh_job = None
+
+    def _cancel_preview_job(self):
+        if self._preview_job:
+            self._preview_job.cancel()
+            self._preview_job = None
+
+    @property
+    def mesh(self) -> shapes.Mesh:
+        """The group's mesh at self.isovalue, also while a preview is shown in its place."""
+        if self._mesh_before_preview is not None:
+            return self._mesh_before_preview
+        return self.map_mesh.mesh
 
     @property
     def model_complex(self):
@@ -311,12 +533,23 @@ class MapGroup:
     def map_complex(self):
         return self.map_mesh.complex
 
-    def add_pdb(self, pdb_file):
+    def add_pdb(self, pdb_file, model: manager = None):
+        """Set the cctbx model for this group. Pass model if it was already loaded from pdb_file."""
+        self._model = model or self.load_model(pdb_file)
+        self.model_file = pdb_file
+
+    @staticmethod
+    def load_model(pdb_file) -> manager:
         dm = DataManager()
-        self._model = dm.get_model(pdb_file)
+        return dm.get_model(pdb_file)
 
-    async def add_mapfile(self, mapfile):
-        self.map_mesh.add_mapfile(mapfile)
+    async def add_mapfile(self, mapfile, map_manager: map_manager = None):
+        if not map_manager:
+            # Parsing large maps takes seconds, so keep it off the event loop.
+            loop = asyncio.get_event_loop()
+            map_manager = await loop.run_in_executor(None, MapMesh.load_mapfile, mapfile)
+        self.map_mesh.add_mapfile(mapfile, map_manager)
+        self._preview = self._preview_source = None
 
     def add_model_complex(self, comp):
         self.__model_complex = comp
@@ -331,24 +564,24 @@ class MapGroup:
         import matplotlib.pyplot as plt
         logging.getLogger('matplotlib').setLevel(logging.CRITICAL)
         Logs.debug("Generating histogram...")
-        start_time = time.time()
-        flat = np.array(self.map_mesh.map_manager.map_data().as_1d(), dtype=np.float32)
-        minmap = np.min(flat)
-        flat_offset = flat + abs(minmap) + 0.001
-        hist, bins = np.histogram(flat_offset, bins=1000)
-        logbins = np.logspace(np.log10(bins[0]), np.log10(bins[-1]), len(bins))
-        bins = logbins - abs(minmap)
-        plt.figure(figsize=(8, 3))
-        plt.hist(flat, bins=bins)
-        plt.ylim(bottom=10)
-        plt.yscale('log')
-        plt.title("Level histogram")
-        self.hist_x_min, self.hist_x_max = plt.xlim()
-        self.png_tempfile = tempfile.NamedTemporaryFile(
-            delete=False, suffix=".png", dir=temp_dir)
-        plt.savefig(self.png_tempfile.name)
-        end_time = time.time()
-        elapsed_time = round(end_time - start_time, 1)
+        with span('histogram') as histogram_span:
+            flat = np.array(self.map_mesh.map_manager.map_data().as_1d(), dtype=np.float32)
+            histogram_span.counts['voxels'] = flat.size
+            minmap = np.min(flat)
+            flat_offset = flat + abs(minmap) + 0.001
+            hist, bins = np.histogram(flat_offset, bins=1000)
+            logbins = np.logspace(np.log10(bins[0]), np.log10(bins[-1]), len(bins))
+            bins = logbins - abs(minmap)
+            plt.figure(figsize=(8, 3))
+            plt.hist(flat, bins=bins)
+            plt.ylim(bottom=10)
+            plt.yscale('log')
+            plt.title("Level histogram")
+            self.hist_x_min, self.hist_x_max = plt.xlim()
+            self.png_tempfile = tempfile.NamedTemporaryFile(
+                delete=False, suffix=".png", dir=temp_dir)
+            plt.savefig(self.png_tempfile.name)
+        elapsed_time = round(histogram_span.seconds, 1)
         Logs.debug(
             f"Histogram Generated in {elapsed_time} seconds",
             extra={"elapsed_time": elapsed_time})
@@ -370,57 +603,214 @@ class MapGroup:
         if hasattr(self, '_model') and self._model:
             kwargs['model'] = self._model
         if hasattr(self, 'map_mesh'):
-            kwargs['map_manager'] = self.map_mesh.map_manager
+            kwargs['map_manager'] = self.map_mesh.cctbx_map_manager()
         mmm = map_model_manager(**kwargs)
         return mmm
 
+    def generate_model_map(self):
+        """The map generated by the map model manager of the map and fitted model."""
+        mmm = self.create_map_model_manager()
+        Logs.debug("Generating Map...")
+        mmm.generate_map()
+        Logs.debug("Map Generated")
+        return mmm.map_manager()
+
+    @asynccontextmanager
+    async def model_map_memory(self, reserved=False):
+        """Hold the plugin's memory budget while the map model manager uses a cctbx copy of the map.
+
+        reserved: The caller's reservation already covers it, e.g. the map load's.
+        Raises InsufficientMemory if the copy can't fit in the budget.
+        """
+        if reserved:
+            yield
+            return
+        nbytes = estimate_model_map_memory(self.map_mesh.map_manager.map_data().size())
+        async with self._plugin.memory_budget.reserve(nbytes):
+            yield
+
+    async def notify_insufficient_memory(self, error: InsufficientMemory):
+        Logs.warning(str(error))
+        await self._plugin.client.send_notification(enums.NotificationTypes.error, str(error))
+
     async def generate_mesh_around_model(self):
+        job = self.start_mesh_job()
+        try:
+            async with self.model_map_memory():
+                await self._generate_mesh_around_model(job)
+        except MeshJobCancelled:
+            Logs.debug("Mesh around model superseded by a newer mesh job")
+        except InsufficientMemory as e:
+            await self.notify_insufficient_memory(e)
+        finally:
+            self._finish_mesh_job(job)
+
+    async def _generate_mesh_around_model(self, job: MeshJob):
+        # Caller must hold model_map_memory
         self.extraction_type = EXTRACTION_TYPE.MODEL
-        mmm = self.create_map_model_manager()
+        loop = asyncio.get_event_loop()
+        mmm = await job.wait(loop.run_in_executor(None, self.create_map_model_manager))
         selected_residues = []
         if self.model_complex:
-            await self.refresh_model_complex()
+            await job.wait(self.refresh_model_complex())
             selected_residues = list(self.model_complex.residues)
         if not selected_residues:
             Logs.warning("No residues selected")
             return
-        await self.map_mesh.load(
-            mmm.map_manager(), self.isovalue, self.opacity, selected_residues)
-        self.color_by_scheme(self.map_mesh, self.color_scheme)
-        asyncio.create_task(self.map_mesh.upload())
+        mesh = await MapMesh.generate_mesh(mmm.map_manager(), self.isovalue, job)
+        await self._load_mesh(job, mmm.map_manager(), mesh, selected_residues)
 
-    async def generate_full_mesh(self):
+    async def generate_full_mesh(self, mesh=None, stats=None, priority=JobPriority.BULK, memory_reserved=False):
+        """Mesh the full map.
+
+        mesh: Optional mesh already generated at self.isovalue.
+        stats: Optional map statistics from MapMesh.compute_map_stats, e.g. from the map cache.
+        priority: Priority of the mesh job in the plugin's compute service.
+        memory_reserved: The caller holds a memory reservation for the map, e.g. while loading it.
+        Returns the map statistics, or None if a newer mesh job superseded this one.
+        """
+        job = self.start_mesh_job()
+        try:
+            # Only the map model manager of a fitted model needs a cctbx copy of the map.
+            async with self.model_map_memory(memory_reserved or not self.has_model()):
+                return await self._generate_full_mesh(job, mesh, stats, priority)
+        except MeshJobCancelled:
+            Logs.debug("Full map mesh superseded by a newer mesh job")
+            return None
+        except InsufficientMemory as e:
+            await self.notify_insufficient_memory(e)
+            return None
+        finally:
+            self._finish_mesh_job(job)
+
+    async def _generate_full_mesh(self, job: MeshJob, mesh, stats, priority):
+        # Caller must hold model_map_memory
         self.extraction_type = EXTRACTION_TYPE.FULL_MAP
-        mmm = self.create_map_model_manager()
-        Logs.debug("Generating Map...")
-        mmm.generate_map()
-        Logs.debug("Map Generated")
-        map_data = mmm.map_manager().map_data().as_1d()
-        Logs.debug(f"Map Data length: {len(map_data)}")
+        loop = asyncio.get_event_loop()
+        map_manager = await self._full_mesh_map(job)
+        if not stats and map_manager is self.shared_map:
+            stats = self.shared_map.stats
+        stats = stats or await job.wait(loop.run_in_executor(None, MapMesh.compute_map_stats, map_manager))
         if self.isovalue is None:
-            # Best guess isovalue is the mean + 1 standard deviation
-            mean = sum(map_data) / len(map_data)
-            stdev = map_data.standard_deviation_of_the_sample()
-            isovalue = mean + stdev
-            Logs.debug(f"Set Isovalue to {isovalue}")
-            self.isovalue = isovalue
-
-        await self.map_mesh.load(
-            mmm.map_manager(), self.isovalue, self.opacity)
+            self.isovalue = stats['default_isovalue']
+            Logs.debug(f"Set Isovalue to {self.isovalue}")
+        if not mesh and map_manager is self.shared_map:
+            mesh = await self.compute_full_mesh(priority, job)
+        if not mesh:
+            mesh = await MapMesh.generate_mesh(map_manager, self.isovalue, job, self.mesh_stride)
+        await self._load_mesh(job, map_manager, mesh)
+        self.hist_x_min = stats['min']
+        self.hist_x_max = stats['max']
+        return stats
+
+    async def _full_mesh_map(self, job: MeshJob):
+        """The map generate_full_mesh meshes."""
+        if self.has_model():
+            loop = asyncio.get_event_loop()
+            return await job.wait(loop.run_in_executor(None, self.generate_model_map))
+        # Without a model, the map model manager returns the map unchanged,
+        # so a map from the map store can be meshed without loading it into cctbx.
+        return self.map_mesh.map_manager
+
+    async def generate_preview_mesh(self, isovalue):
+        """Show a low detail mesh of the full map at isovalue, e.g. while the isovalue slider moves.
+
+        The preview downsamples the same map as the full mesh.
+        self.isovalue is unchanged, redraw afterwards for the full quality mesh, or call end_preview.
+        Skipped while a mesh job runs, e.g. the map's load, as its mesh replaces the preview.
+        """
+        if self._mesh_job:
+            return
+        self._cancel_preview_job()
+        job = self._preview_job = MeshJob()
+        loop = asyncio.get_event_loop()
+        source = (self.mapfile, self._model if self.has_model() else None)
+        try:
+            if self._preview_source != source:
+                async with self.model_map_memory(not self.has_model()):
+                    map_manager = await self._full_mesh_map(job)
+                    self._preview = await job.wait(loop.run_in_executor(None, MeshPreview, map_manager))
+                self._preview_source = source
+            mesh = await job.wait(loop.run_in_executor(None, self._preview.mesh, isovalue))
+            job.check()
+        except MeshJobCancelled:
+            return
+        except InsufficientMemory as e:
+            await self.notify_insufficient_memory(e)
+            return
+        # Colored by scheme with the full quality mesh.
+        mesh.anchors = self.map_mesh.mesh.anchors
+        mesh._index = self.map_mesh.mesh.index
+        mesh.color = Color(255, 255, 255, int(self.opacity * 255))
+        if self._mesh_before_preview is None:
+            self._mesh_before_preview = self.map_mesh.mesh
+        self.map_mesh.mesh = mesh
+        asyncio.create_task(self.map_mesh.upload())
+
+    def end_preview(self):
+        """Cancel the preview, and show the mesh it replaced again."""
+        self._cancel_preview_job()
+        if self._mesh_before_preview is None:
+            return
+        # The preview was uploaded in place of the mesh.
+        self._mesh_before_preview._index = self.map_mesh.mesh.index
+        self.map_mesh.mesh = self._mesh_before_preview
+        self._mesh_before_preview = None
+        asyncio.create_task(self.map_mesh.upload())
+
+    async def _load_mesh(self, job: MeshJob, map_manager, mesh, selected_residues=None):
+        """Place the mesh of job in the workspace, unless a newer job has started."""
+        job.check()
+        await self.map_mesh.load(map_manager, self.isovalue, self.opacity, selected_residues, mesh=mesh)
+        self._mesh_before_preview = None
+        # A newer job that started during load has replaced the mesh, and uploads it.
+        job.check()
         self.color_by_scheme(self.map_mesh, self.color_scheme)
         asyncio.create_task(self.map_mesh.upload())
-        self._set_hist_x_min_max()
+
+    async def compute_full_mesh(self, priority=JobPriority.BULK, job: MeshJob = None):
+        """Mesh the shared map in the plugin's compute service.
+
+        Returns None if the service isn't running, so the caller meshes locally.
+        Cancelling job cancels the job in the service.
+        """
+        compute = self._plugin.compute
+        if not self.shared_map or not compute.available:
+            return None
+        run = compute.run(
+            'mesh', self.mapfile, self.shared_map.source_hash, self.isovalue, self.mesh_stride, priority=priority)
+        try:
+            vertices, normals, triangles = await (job.wait(run) if job else run)
+        except (OSError, ComputeError):
+            Logs.warning("Compute service failed, meshing locally", exc_info=True)
+            return None
+        mesh = shapes.Mesh()
+        mesh.vertices = vertices
+        mesh.normals = normals
+        mesh.triangles = triangles
+        return mesh
 
     async def generate_mesh_around_selection(self):
+        job = self.start_mesh_job()
+        try:
+            async with self.model_map_memory():
+                await self._generate_mesh_around_selection(job)
+        except MeshJobCancelled:
+            Logs.debug("Mesh around selection superseded by a newer mesh job")
+        except InsufficientMemory as e:
+            await self.notify_insufficient_memory(e)
+        finally:
+            self._finish_mesh_job(job)
+
+    async def _generate_mesh_around_selection(self, job: MeshJob):
+        # Caller must hold model_map_memory
         self.extraction_type = EXTRACTION_TYPE.SELECTION
-        mmm = self.create_map_model_manager()
-        Logs.debug("Generating Map...")
-        mmm.generate_map()
-        Logs.debug("Map Generated")
+        loop = asyncio.get_event_loop()
+        map_manager = await job.wait(loop.run_in_executor(None, self.generate_model_map))
         # Get selected residues
         selected_residues = []
         if self.model_complex:
-            await self.refresh_model_complex()
+            await job.wait(self.refresh_model_complex())
             model_comp = self.model_complex
             selected_residues = [
                 res for res in model_comp.residues
@@ -432,10 +822,8 @@ class MapGroup:
                 enums.NotificationTypes.warning, "No residues selected on model.")
             return
 
-        await self.map_mesh.load(
-            mmm.map_manager(), self.isovalue, self.opacity, selected_residues)
-        self.color_by_scheme(self.map_mesh, self.color_scheme)
-        asyncio.create_task(self.map_mesh.upload())
+        mesh = await MapMesh.generate_mesh(map_manager, self.isovalue, job)
+        await self._load_mesh(job, map_manager, mesh, selected_residues)
 
     def color_by_scheme(self, map_mesh, scheme):
         Logs.message(f"Coloring Mesh with scheme {scheme.name}")
@@ -443,12 +831,13 @@ class MapGroup:
             Logs.debug("No model set to color by. Returning")
             return
         comp = self.model_complex
-        if scheme == enums.ColorScheme.Element:
-            self.color_by_element(map_mesh, comp)
-        elif scheme == enums.ColorScheme.BFactor:
-            self.color_by_bfactor(map_mesh, comp)
-        elif scheme == enums.ColorScheme.Chain:
-            self.color_by_chain(map_mesh, comp)
+        with span('coloring', vertices=len(map_mesh.mesh.vertices) // 3):
+            if scheme == enums.ColorScheme.Element:
+                self.color_by_element(map_mesh, comp)
+            elif scheme == enums.ColorScheme.BFactor:
+                self.color_by_bfactor(map_mesh, comp)
+            elif scheme == enums.ColorScheme.Chain:
+                self.color_by_chain(map_mesh, comp)
         asyncio.create_task(map_mesh.upload())
         Logs.message("Mesh colored")
 
@@ -579,6 +968,48 @@ class MapGroup:
     def has_map(self):
         return self.map_mesh.complex is not None
 
+    def has_model(self):
+        return self._model is not None
+
+    def get_state(self):
+        """Settings needed to restore this group with restore_state, as a JSON serializable dict."""
+        return {
+            'group_name': self.group_name,
+            'isovalue': None if self.isovalue is None else float(self.isovalue),
+            'opacity': self.opacity,
+            'color_scheme': self.color_scheme.name,
+            'extraction_type': self.extraction_type.name,
+            'hist_x_min': float(self.hist_x_min),
+            'hist_x_max': float(self.hist_x_max),
+            'map_complex_index': self.map_complex.index if self.map_complex else None,
+            'model_complex_index': self.model_complex.index if self.model_complex else None,
+        }
+
+    async def restore_state(
+            self, state, mapfile, map_manager: map_manager, mesh: shapes.Mesh, model_complex=None,
+            old_map_complex=None):
+        """Rebuild the group from get_state and its last mesh, without remeshing.
+
+        model_complex: Model complex still in the workspace, if the group had one.
+        old_map_complex: Previous map complex, to place the new map complex where it was.
+        """
+        self.group_name = state['group_name']
+        self.isovalue = state['isovalue']
+        self.opacity = state['opacity']
+        self.color_scheme = enums.ColorScheme[state['color_scheme']]
+        self.extraction_type = EXTRACTION_TYPE[state['extraction_type']]
+        self.hist_x_min = state['hist_x_min']
+        self.hist_x_max = state['hist_x_max']
+        await self.add_mapfile(mapfile, map_manager)
+        if old_map_complex:
+            self.map_complex.position = old_map_complex.position
+            self.map_complex.rotation = old_map_complex.rotation
+        if model_complex:
+            self.add_model_complex(model_complex)
+        # The saved mesh keeps its colors, so it isn't recolored.
+        await self.map_mesh.load(map_manager, self.isovalue, self.opacity, mesh=mesh)
+        await self.map_mesh.upload()
+
     def has_histogram(self):
         return self.hist_x_min != float('-inf')
 
@@ -590,13 +1021,9 @@ class MapGroup:
         if self.map_complex in comp_list:
             comps_to_delete.append(self.map_complex)
             self.map_mesh = MapMesh(self._plugin)
+            self._mesh_before_preview = None
         self._plugin.client.remove_from_workspace(comps_to_delete)
 
-    def _set_hist_x_min_max(self):
-        flat = list(self.map_mesh.map_manager.map_data().as_1d())
-        self.hist_x_min = np.min(flat)
-        self.hist_x_max = np.max(flat)
-
     async def refresh_model_complex(self):
         [self.__model_complex] = await self._plugin.client.request_complexes([self.model_complex.index])
 
@@ -631,7 +1058,7 @@ class MapGroup:
 
     async def redraw_mesh(self):
         if self.extraction_type == EXTRACTION_TYPE.FULL_MAP:
-            await self.generate_full_mesh()
+            await self.generate_full_mesh(priority=JobPriority.INTERACTIVE)
         elif self.extraction_type == EXTRACTION_TYPE.SELECTION:
             await self.generate_mesh_around_selection()
         elif self.extraction_type == EXTRACTION_TYPE.MODEL:
@@ -0,0 +1,119 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import requests
+from nanome.util import Logs
+
+from .map_cache import MAP_CACHE_DIR, MapCache
+from .mesh_io import hash_file
+from .models import MapMesh
+from .utils import EMDB_HEADER_URL, EMDB_MAP_URL, EMDBMetadataParser, parse_emdb_ids
+
+__all__ = ["premesh"]
+
+PREMESH_WORKERS = int(os.environ.get('PREMESH_WORKERS', os.cpu_count() or 1))
+# EMDB IDs accepted in one run, ranges included.
+MAX_PREMESH_IDS = 10000
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def premesh(source, cache_dir=MAP_CACHE_DIR):
+    """Mesh a map at its primary contour level, and save the mesh and map statistics to the map cache.
+
+    source: EMDB ID, or path to a local map file.
+    EMDB maps are downloaded into the cache, and meshed at the contour level from their header.
+    Local maps are meshed at the plugin's default isovalue, mean + 1 standard deviation.
+    Returns a summary dict of the mesh.
+    """
+    start_time = time.time()
+    cache = MapCache(cache_dir)
+    isovalue = None
+    if os.path.exists(source):
+        mapfile = source
+    else:
+        mapfile = cache.emdb_map_path(source)
+        isovalue = download_emdb_header(source).isovalue
+        if not os.path.exists(mapfile):
+            download_emdb_map(source, mapfile)
+
+    source_hash = hash_file(mapfile)
+    map_manager = MapMesh.load_mapfile(mapfile)
+    stats = MapMesh.compute_map_stats(map_manager)
+    if isovalue is None:
+        isovalue = stats['default_isovalue']
+
+    artifact = cache.get_mesh(source_hash, isovalue)
+    cached = bool(artifact and MapMesh.is_mesh_artifact_current(artifact, source_hash))
+    if not cached:
+        mesh = MapMesh.generate_mesh_from_map_manager(map_manager, isovalue)
+        artifact = MapMesh.create_mesh_artifact(mesh, isovalue, source_hash)
+        cache.put_mesh(artifact)
+    cache.put_stats(source_hash, stats)
+    return {
+        'source': source,
+        'isovalue': isovalue,
+        'vertices': len(artifact.vertices) // 3,
+        'cached': cached,
+        'seconds': round(time.time() - start_time, 2),
+    }
+
+
+def download_emdb_header(emdb_id):
+    response = requests.get(EMDB_HEADER_URL.format(emdb_id=emdb_id))
+    response.raise_for_status()
+    return EMDBMetadataParser(response.content)
+
+
+def download_emdb_map(emdb_id, file_path):
+    # Download to a temporary name, so an interrupted download is not mistaken for a cached map.
+    temp_path = f'{file_path}.{os.getpid()}.tmp'
+    with requests.get(EMDB_MAP_URL.format(emdb_id=emdb_id), stream=True) as response:
+        response.raise_for_status()
+        with open(temp_path, 'wb') as f:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+    os.replace(temp_path, file_path)
+
+
+def parse_sources(sources):
+    """Split arguments into local map files and EMDB IDs."""
+    paths = [source for source in sources if os.path.exists(source)]
+    query = ' '.join(source for source in sources if source not in paths)
+    return paths + parse_emdb_ids(query, max_ids=MAX_PREMESH_IDS)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate full map meshes ahead of time, so the plugin loads them from the map cache.')
+    parser.add_argument('sources', nargs='+', help='EMDB IDs or ranges, e.g. 8216 or 8216-8220, or local map files')
+    parser.add_argument('--workers', type=int, default=PREMESH_WORKERS, help='Number of worker processes')
+    parser.add_argument('--cache-dir', default=MAP_CACHE_DIR, help='Map cache directory')
+    args = parser.parse_args()
+    try:
+        sources = parse_sources(args.sources)
+    except ValueError as e:
+        parser.error(str(e))
+
+    start_time = time.time()
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(premesh, source, args.cache_dir): source for source in sources}
+        for future in as_completed(futures):
+            source = futures[future]
+            try:
+                result = future.result()
+            except Exception:
+                failed += 1
+                Logs.error(f"Failed to mesh {source}", exc_info=True)
+                continue
+            status = 'cached' if result['cached'] else f"meshed in {result['seconds']} seconds"
+            Logs.message(f"{source}: {result['vertices']} vertices at isovalue {result['isovalue']:.4g}, {status}")
+    Logs.message(
+        f"Meshed {len(sources) - failed}/{len(sources)} maps in {round(time.time() - start_time, 2)} seconds "
+        f"into {args.cache_dir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import mcubes
+import numpy as np
+import os
+from nanome.api import shapes
+
+__all__ = ["MeshPreview"]
+
+# Longest edge of the downsampled map, in voxels.
+PREVIEW_GRID_SIZE = int(os.environ.get('PREVIEW_GRID_SIZE', 96))
+BRICK_SIZE = 16
+
+
+def grid_to_cart_matrix(map_manager):
+    """Matrix converting grid units to cartesian coordinates, like map_manager.grid_units_to_cart."""
+    # The conversion is linear, so the images of the unit vectors are the matrix columns.
+    return np.array([map_manager.grid_units_to_cart(tuple(axis)) for axis in np.eye(3)]).T
+
+
+class MeshPreview:
+    """Low detail meshes of a map, fast enough to follow the isovalue slider.
+
+    The map is downsampled to at most PREVIEW_GRID_SIZE voxels along each axis, and split into
+    bricks. Bricks whose value range doesn't include the isovalue have no surface, and are skipped.
+    Meshes aren't simplified, and their normals are computed from the triangles.
+    """
+
+    def __init__(self, map_manager):
+        map_data = map_manager.map_data().as_numpy_array()
+        self.stride = max(1, -(-max(map_data.shape) // PREVIEW_GRID_SIZE))
+        step = self.stride
+        self.voxels = np.ascontiguousarray(map_data[::step, ::step, ::step], dtype=np.float32)
+        self.origin = np.asarray(map_manager.origin, dtype=np.float64)
+        self.grid_to_cart = grid_to_cart_matrix(map_manager)
+        # (brick start, slices, min value, max value). Bricks overlap by one voxel, so their surfaces meet.
+        self.bricks = []
+        x_size, y_size, z_size = self.voxels.shape
+        for x in range(0, max(x_size - 1, 1), BRICK_SIZE):
+            for y in range(0, max(y_size - 1, 1), BRICK_SIZE):
+                for z in range(0, max(z_size - 1, 1), BRICK_SIZE):
+                    slices = (slice(x, x + BRICK_SIZE + 1), slice(y, y + BRICK_SIZE + 1), slice(z, z + BRICK_SIZE + 1))
+                    brick = self.voxels[slices]
+                    self.bricks.append((np.array([x, y, z]), slices, brick.min(), brick.max()))
+
+    def mesh(self, isovalue) -> shapes.Mesh:
+        grid_vertices = []
+        triangles = []
+        vertex_count = 0
+        for start, slices, min_value, max_value in self.bricks:
+            if not min_value <= isovalue <= max_value:
+                continue
+            brick_vertices, brick_triangles = mcubes.marching_cubes(self.voxels[slices], isovalue)
+            if not len(brick_triangles):
+                continue
+            grid_vertices.append(brick_vertices + start)
+            triangles.append(brick_triangles.astype(np.int64) + vertex_count)
+            vertex_count += len(brick_vertices)
+
+        mesh = shapes.Mesh()
+        if not triangles:
+            return mesh
+        grid_vertices = np.concatenate(grid_vertices) * self.stride + self.origin
+        vertices = grid_vertices @ self.grid_to_cart.T
+        triangles = np.concatenate(triangles)
+        mesh.vertices = vertices.flatten()
+        mesh.normals = self.vertex_normals(vertices, triangles).flatten()
+        mesh.triangles = triangles.flatten()
+        return mesh
+
+    @staticmethod
+    def vertex_normals(vertices, triangles):
+        """Area weighted average of the normals of the triangles around each vertex."""
+        corners = vertices[triangles]
+        face_normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+        normals = np.zeros_like(vertices)
+        for corner in range(3):
+            np.add.at(normals, triangles[:, corner], face_normals)
+        lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+        return normals / np.where(lengths == 0, 1, lengths)
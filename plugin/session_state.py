@@ -0,0 +1,248 @@
+import fcntl
+import glob
+import json
+import os
+import shutil
+import time
+import uuid
+from nanome.api import shapes
+from nanome.util import Logs
+
+from .map_cache import MAP_CACHE_DIR, MapCache, write_atomic
+from .mesh_io import MESH_ARTIFACT_SUFFIX, MeshArtifact, hash_file
+
+__all__ = ["SessionCheckpoint"]
+
+SESSION_STATE_DIR = os.environ.get('SESSION_STATE_DIR', os.path.join(MAP_CACHE_DIR, 'sessions'))
+SESSION_STATE_MAX_AGE = float(os.environ.get('SESSION_STATE_MAX_AGE', 7 * 24 * 3600))
+STATE_FILENAME = 'state.json'
+LOCK_FILENAME = '.lock'
+
+
+class SessionCheckpoint:
+    """MapGroup state of one session, saved to disk so a restarted plugin can restore it.
+
+    Map and model files are kept in the map cache, and each group's current mesh is saved
+    next to the state file. Checkpoints are incremental: files and meshes that are already
+    saved are not written again.
+
+    Each session of a user has its own checkpoint, locked while the session runs. A restarted
+    session adopts the unlocked checkpoint of the same user whose complexes are in its workspace.
+    Unlocked checkpoints not saved for max_age seconds are removed, and cached files are
+    removed once no checkpoint uses them.
+    """
+
+    def __init__(self, user_key, session_id, map_cache: MapCache,
+                 state_dir=SESSION_STATE_DIR, max_age=SESSION_STATE_MAX_AGE):
+        self.state_dir = state_dir
+        self.user_dir = os.path.join(state_dir, user_key)
+        self.map_cache = map_cache
+        self.max_age = max_age
+        self.session_dir = os.path.join(self.user_dir, str(session_id))
+        os.makedirs(self.session_dir, exist_ok=True)
+        self._lock_file = self._try_lock(self.session_dir)
+        if not self._lock_file:
+            # The session id is still used by another process.
+            self.session_dir = os.path.join(self.user_dir, f'{session_id}-{uuid.uuid4().hex}')
+            os.makedirs(self.session_dir)
+            self._lock_file = self._try_lock(self.session_dir)
+        # path -> cached path
+        self._cached_files = {}
+        # Cached files used by the saved states
+        self._saved_files = set()
+        # mesh filename -> (vertices, triangles, colors) arrays of the saved mesh
+        self._saved_meshes = {}
+
+    @property
+    def state_path(self):
+        return os.path.join(self.session_dir, STATE_FILENAME)
+
+    def mesh_path(self, mesh_file):
+        return os.path.join(self.session_dir, mesh_file)
+
+    def save(self, groups):
+        """Save a list of (MapGroup.get_state(), mapfile, model_file, shapes.Mesh) tuples.
+
+        Groups whose files were deleted are left out.
+        """
+        states = []
+        saved_meshes = {}
+        for state, mapfile, model_file, mesh in groups:
+            try:
+                state = dict(
+                    state,
+                    mapfile=self.cache_file(mapfile),
+                    model_file=model_file and self.cache_file(model_file))
+            except FileNotFoundError:
+                Logs.warning(f"Could not checkpoint {state['group_name']}, its files were deleted")
+                continue
+            mesh_file = self._find_saved_mesh(mesh)
+            if not mesh_file:
+                mesh_file = f'{uuid.uuid4().hex}{MESH_ARTIFACT_SUFFIX}'
+                MeshArtifact.from_mesh(mesh).save(self.mesh_path(mesh_file))
+            saved_meshes[mesh_file] = self._mesh_arrays(mesh)
+            states.append(dict(state, mesh_file=mesh_file))
+
+        write_atomic(self.state_path, json.dumps(states).encode())
+        # Remove meshes that were replaced since the previous checkpoint, and files no longer used.
+        for mesh_file in self._saved_meshes.keys() - saved_meshes.keys():
+            os.remove(self.mesh_path(mesh_file))
+        self._saved_meshes = saved_meshes
+        saved_files = self._cached_paths(states)
+        self._release_files(self._saved_files - saved_files)
+        self._saved_files = saved_files
+
+    def cache_file(self, path):
+        if self._is_cached_file(path):
+            return path
+        cached_path = self._cached_files.get(path)
+        # The cached copy is removed when no checkpoint uses it, so it may need copying again.
+        if not cached_path or not os.path.exists(cached_path):
+            cached_path = self._cached_files[path] = self.map_cache.put_file(path, hash_file(path))
+        return cached_path
+
+    def load(self, comp_indices=()):
+        """Load the saved group states. Each state has mapfile, model_file and mesh_file entries.
+
+        If this session has no saved states, the checkpoint of an ended session of the same user
+        with the most groups whose complexes are in comp_indices is adopted.
+        """
+        self.remove_expired()
+        states = self._read_states(self.session_dir)
+        if not states and comp_indices:
+            states = self._adopt(comp_indices)
+        self._saved_files = self._cached_paths(states)
+        return states
+
+    def load_mesh(self, mesh_file):
+        """Memory map a saved mesh. It isn't saved again while the group keeps it."""
+        mesh = MeshArtifact.load(self.mesh_path(mesh_file)).to_mesh()
+        self._saved_meshes[mesh_file] = self._mesh_arrays(mesh)
+        return mesh
+
+    def close(self):
+        """Unlock the checkpoint when the session ends, so a restarted session can adopt it.
+
+        Checkpoints without groups are removed.
+        """
+        if not self._read_states(self.session_dir):
+            shutil.rmtree(self.session_dir, ignore_errors=True)
+        self._lock_file.close()
+
+    def remove_expired(self):
+        """Remove the unlocked checkpoints of every user that weren't saved for max_age seconds."""
+        for session_dir in glob.glob(os.path.join(self.state_dir, '*', '*', '')):
+            session_dir = os.path.dirname(session_dir)
+            if session_dir == self.session_dir or not self._expired(session_dir):
+                continue
+            lock_file = self._try_lock(session_dir)
+            if not lock_file:
+                continue
+            with lock_file:
+                # Checked again, in case another session adopted and saved it before it was locked.
+                if self._expired(session_dir):
+                    Logs.debug(f"Removing expired session checkpoint {session_dir}")
+                    self._remove(session_dir)
+
+    def _adopt(self, comp_indices):
+        best_matches = 0
+        best = None
+        for entry in os.scandir(self.user_dir):
+            if not entry.is_dir() or entry.path == self.session_dir:
+                continue
+            lock_file = self._try_lock(entry.path)
+            if not lock_file:
+                # Used by a running session
+                continue
+            states = self._read_states(entry.path)
+            matches = sum(
+                state['map_complex_index'] in comp_indices or state['model_complex_index'] in comp_indices
+                for state in states)
+            if matches <= best_matches:
+                lock_file.close()
+                continue
+            if best:
+                best[1].close()
+            best_matches = matches
+            best = (entry.path, lock_file, states)
+        if not best:
+            return []
+        session_dir, lock_file, states = best
+        Logs.message(f"Adopting session checkpoint {session_dir}")
+        shutil.rmtree(self.session_dir, ignore_errors=True)
+        self._lock_file.close()
+        self.session_dir = session_dir
+        self._lock_file = lock_file
+        return states
+
+    def _remove(self, session_dir):
+        states = self._read_states(session_dir)
+        shutil.rmtree(session_dir, ignore_errors=True)
+        self._release_files(self._cached_paths(states))
+
+    def _release_files(self, cached_paths):
+        """Remove cached files that no checkpoint uses."""
+        if not cached_paths:
+            return
+        used = set()
+        for state_path in glob.glob(os.path.join(self.state_dir, '*', '*', STATE_FILENAME)):
+            used |= self._cached_paths(self._read_states(os.path.dirname(state_path)))
+        for cached_path in cached_paths - used:
+            self.map_cache.remove_file(cached_path)
+
+    def _cached_paths(self, states):
+        return {
+            path for state in states for path in (state['mapfile'], state['model_file'])
+            if path and self._is_cached_file(path)
+        }
+
+    def _is_cached_file(self, path):
+        """Whether path was kept by MapCache.put_file."""
+        files_dir = os.path.realpath(os.path.join(self.map_cache.cache_dir, 'files'))
+        return os.path.commonpath([files_dir, os.path.realpath(path)]) == files_dir
+
+    def _expired(self, session_dir):
+        for path in (os.path.join(session_dir, STATE_FILENAME), session_dir):
+            try:
+                return time.time() - os.path.getmtime(path) > self.max_age
+            except FileNotFoundError:
+                continue
+        # Removed by another session
+        return False
+
+    @staticmethod
+    def _read_states(session_dir):
+        try:
+            with open(os.path.join(session_dir, STATE_FILENAME)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+        except ValueError:
+            Logs.warning(f"Invalid session checkpoint {session_dir}")
+            return []
+
+    @staticmethod
+    def _try_lock(session_dir):
+        """Lock a checkpoint directory, or return None if another session holds it."""
+        try:
+            lock_file = open(os.path.join(session_dir, LOCK_FILENAME), 'a')
+        except OSError:
+            return None
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def _find_saved_mesh(self, mesh: shapes.Mesh):
+        # Meshes are replaced rather than modified in place, so unchanged meshes have the same arrays.
+        arrays = self._mesh_arrays(mesh)
+        return next((
+            mesh_file for mesh_file, saved_arrays in self._saved_meshes.items()
+            if all(a is b for a, b in zip(arrays, saved_arrays))
+        ), None)
+
+    @staticmethod
+    def _mesh_arrays(mesh: shapes.Mesh):
+        return mesh.vertices, mesh.triangles, mesh.colors
@@ -0,0 +1,64 @@
+import asyncio
+import os
+from nanome.util import Logs
+
+__all__ = ["UIUpdateQueue"]
+
+# Seconds that updates are collected for before they are sent.
+UI_UPDATE_WINDOW = float(os.environ.get('UI_UPDATE_WINDOW', 0.05))
+
+
+class UIUpdateQueue:
+    """Collects a session's menu updates, and sends them in one batch per window.
+
+    Updates to the same menu, layout node or content within a window are merged, since only
+    their latest state is sent. Used for updates sent on every slider change or download
+    chunk; one-off updates can still go straight to the client.
+    """
+
+    def __init__(self, plugin, window=UI_UPDATE_WINDOW):
+        self._plugin = plugin
+        self.window = window
+        self._menus = {}
+        self._nodes = {}
+        self._contents = {}
+        self._flush_handle = None
+        # Updates requested, merged into an update already queued, and client calls made.
+        self.counters = {'requested': 0, 'suppressed': 0, 'sent': 0}
+
+    def update_menu(self, menu):
+        self._queue(self._menus, menu.index, menu)
+
+    def update_node(self, *nodes):
+        for node in nodes:
+            self._queue(self._nodes, node._id, node)
+
+    def update_content(self, *contents):
+        for content in contents:
+            self._queue(self._contents, content._content_id, content)
+
+    def _queue(self, pending, key, item):
+        self.counters['requested'] += 1
+        if key in pending:
+            self.counters['suppressed'] += 1
+        pending[key] = item
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(self.window, self.flush)
+
+    def flush(self):
+        """Send the queued updates now."""
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        client = self._plugin.client
+        menus, nodes, contents = self._menus, self._nodes, self._contents
+        self._menus, self._nodes, self._contents = {}, {}, {}
+        # Whole menus first, so node and content updates aren't overwritten by older menu state.
+        for menu in menus.values():
+            client.update_menu(menu)
+        if nodes:
+            client.update_node(*nodes.values())
+        if contents:
+            client.update_content(*contents.values())
+        self.counters['sent'] += len(menus) + bool(nodes) + bool(contents)
+        Logs.debug("Flushed UI updates", extra=self.counters)
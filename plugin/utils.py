@@ -1,8 +1,19 @@
+import gzip
+import os
+import re
+import struct
 from nanome.api import structure
 import xml.etree.ElementTree as ET
 from nanome.util import Logs
 
-__all__ = ["cpk_colors", "create_hidden_complex", "EMDBMetadataParser"]
+__all__ = ["cpk_colors", "create_hidden_complex", "EMDBMetadataParser", "MRCHeader", "parse_emdb_ids"]
+
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 20))
+EMDB_HEADER_URL = "https://ftp.ebi.ac.uk/pub/databases/emdb/structures/EMD-{emdb_id}/header/emd-{emdb_id}.xml"
+EMDB_MAP_URL = "https://ftp.ebi.ac.uk/pub/databases/emdb/structures/EMD-{emdb_id}/map/emd_{emdb_id}.map.gz"
+MRC_HEADER_SIZE = 1024
+# Bytes per voxel for each MRC data mode
+MRC_MODE_BYTES = {0: 1, 1: 2, 2: 4, 3: 4, 4: 8, 6: 2, 12: 2}
 
 
 class EMDBMetadataParser:
@@ -55,6 +66,17 @@ class EMDBMetadataParser:
             filesize = None
         return filesize
 
+    @property
+    def map_dimensions(self):
+        """Grid size of the map as (col, row, sec), or None if missing."""
+        map_tag = next(self.xml_root.iter("map"))
+        dimensions_tag = map_tag.find("dimensions")
+        try:
+            return tuple(int(dimensions_tag.find(axis).text) for axis in ("col", "row", "sec"))
+        except (AttributeError, TypeError, ValueError):
+            Logs.warning("Could not parse map dimensions from XML")
+            return None
+
     @property
     def pdb_list(self):
         # Parse xml and get isovalue
@@ -67,6 +89,60 @@ class EMDBMetadataParser:
         return pdb_list
 
 
+class MRCHeader:
+    """Grid information from the 1024 byte header of an MRC/CCP4 map.
+
+    file_size is the size of the uncompressed map, if known.
+    Raises ValueError if header_bytes is not a valid MRC header.
+    """
+
+    def __init__(self, header_bytes: bytes, file_size=None):
+        if len(header_bytes) < MRC_HEADER_SIZE or header_bytes[208:212] != b'MAP ':
+            raise ValueError("Not an MRC map header")
+        # MACHST stamp gives the byte order, 0x11 is big endian
+        endian = '>' if header_bytes[212] == 0x11 else '<'
+        self.nx, self.ny, self.nz, self.mode = struct.unpack(f'{endian}4i', header_bytes[0:16])
+        mx, my, mz = struct.unpack(f'{endian}3i', header_bytes[28:40])
+        cell = struct.unpack(f'{endian}3f', header_bytes[40:52])
+        self.nsymbt = struct.unpack(f'{endian}i', header_bytes[92:96])[0]
+        self.voxel_size = tuple(
+            round(length / samples, 3) if samples else 0.0
+            for length, samples in zip(cell, (mx, my, mz)))
+        if self.mode not in MRC_MODE_BYTES:
+            raise ValueError(f"Unsupported MRC mode {self.mode}")
+        self.file_size = file_size
+
+    @classmethod
+    def read(cls, path):
+        """Header of a local map file, gzipped or not, or None if it isn't an MRC map."""
+        open_file = gzip.open if path.endswith('.gz') else open
+        try:
+            with open_file(path, 'rb') as f:
+                return cls(f.read(MRC_HEADER_SIZE))
+        # EOFError for truncated gzip files
+        except (OSError, EOFError, ValueError):
+            return None
+
+    @property
+    def dimensions(self):
+        return (self.nx, self.ny, self.nz)
+
+    @property
+    def data_size(self):
+        """Size in bytes of an uncompressed map with this header."""
+        voxels = self.nx * self.ny * self.nz
+        return MRC_HEADER_SIZE + self.nsymbt + voxels * MRC_MODE_BYTES[self.mode]
+
+    @property
+    def size_mb(self):
+        return round(max(self.file_size or 0, self.data_size) / 10 ** 6, 2)
+
+    @property
+    def summary(self):
+        dims = 'x'.join(str(d) for d in self.dimensions)
+        return f'{dims} | {self.voxel_size[0]}Å | {self.size_mb}MB'
+
+
 def cpk_colors(a):
     colors = {}
     colors["xx"] = "#030303"
@@ -225,3 +301,40 @@ def get_extension(filepath):
     if extension == 'gz':
         extension = '.'.join(filepath.split('.')[-2:])
     return extension
+
+
+def parse_emdb_ids(query: str, max_ids=MAX_BATCH_SIZE):
+    """Parse a list or range of EMDB IDs.
+
+    Accepts IDs separated by commas or whitespace, with or without the EMD- prefix,
+    and inclusive ranges such as 8216-8220 or 8216 - 8220. IDs are zero padded to
+    EMDB's 4 digit minimum. Duplicates are dropped, order is kept.
+    Raises ValueError for invalid IDs, or if more than max_ids IDs are requested.
+    """
+    query = re.sub(r'(?i)emd[-_]', '', query)
+    query = re.sub(r'\s*-\s*', '-', query.strip())
+    emdb_ids = []
+    seen = set()
+    for token in re.split(r'[,\s]+', query):
+        if not token:
+            continue
+        if '-' in token:
+            start, _, end = token.partition('-')
+            if not (start.isdigit() and end.isdigit()) or int(end) < int(start):
+                raise ValueError(f"Invalid EMDB ID range: {token}")
+            if int(end) - int(start) + 1 > max_ids:
+                raise ValueError(f"Cannot load more than {max_ids} EMDB IDs at once")
+            ids = range(int(start), int(end) + 1)
+        elif token.isdigit():
+            ids = [int(token)]
+        else:
+            raise ValueError(f"Invalid EMDB ID: {token}")
+        for emdb_id in ids:
+            emdb_id = str(emdb_id).zfill(4)
+            if emdb_id in seen:
+                continue
+            if len(emdb_ids) >= max_ids:
+                raise ValueError(f"Cannot load more than {max_ids} EMDB IDs at once")
+            seen.add(emdb_id)
+            emdb_ids.append(emdb_id)
+    return emdb_ids
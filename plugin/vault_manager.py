@@ -1,55 +1,312 @@
-import requests
+import aiohttp
+import asyncio
+import copy
+import os
+import struct
+import time
+import zlib
+from nanome.util import Logs
+
+from .utils import MRC_HEADER_SIZE, MRCHeader
+
+# Timeouts in seconds for Vault requests. Downloads only bound the time between reads,
+# so large maps aren't cut off.
+VAULT_TIMEOUT = float(os.environ.get('VAULT_TIMEOUT', 30))
+VAULT_CONNECT_TIMEOUT = float(os.environ.get('VAULT_CONNECT_TIMEOUT', 10))
+VAULT_MAX_CONNECTIONS = int(os.environ.get('VAULT_MAX_CONNECTIONS', 8))
+DOWNLOAD_CHUNK_SIZE = 8192
+UPLOAD_CHUNK_SIZE = 256 * 1024
+# Failed uploads from bytes or a local file are retried, with exponential backoff.
+VAULT_UPLOAD_RETRIES = int(os.environ.get('VAULT_UPLOAD_RETRIES', 3))
+UPLOAD_RETRY_DELAY = 1
+# Seconds a directory listing is reused before it is fetched again.
+VAULT_LISTING_TTL = float(os.environ.get('VAULT_LISTING_TTL', 30))
+# Compressed bytes fetched to decompress the MRC header of a .gz map.
+PROBE_GZIP_BYTES = 16384
 
 
 class VaultManager:
+    """Async client for the Vault file server.
+
+    All requests share one keep-alive aiohttp session, which is created on first use
+    so it is bound to the running event loop. Call `close` when the plugin stops.
+
+    Directory listings are cached per (path, key) for `listing_ttl` seconds. Commands
+    that change a path invalidate the listings of that path and its parent.
+    """
 
-    def __init__(self, api_key, server_url):
+    def __init__(self, api_key, server_url, listing_ttl=VAULT_LISTING_TTL):
         self.api_key = api_key
         if server_url.endswith('/'):
             server_url = server_url[:-1]
         self.server_url = server_url
+        self._session = None
+        self.listing_ttl = listing_ttl
+        # (path, key) -> (fetch time, listing)
+        self._listings = {}
+        # (path, key) -> task for a listing currently being fetched
+        self._pending_listings = {}
+        # Bumped on invalidation, so fetches that started before it aren't cached.
+        self._listing_generation = 0
+        # (path, ETag) -> MRCHeader
+        self._map_probes = {}
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=VAULT_MAX_CONNECTIONS, keepalive_timeout=60)
+            timeout = aiohttp.ClientTimeout(total=VAULT_TIMEOUT, connect=VAULT_CONNECT_TIMEOUT)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    async def close(self):
+        for task in self._pending_listings.values():
+            task.cancel()
+        self._pending_listings.clear()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
 
     # add data to vault at path/filename, where filename can contain a path
-    def add_file(self, path, filename, data, key=None):
-        return self._command('upload', path, {'key': key}, {'files': (filename, data)})
+    async def add_file(self, path, filename, data, key=None, progress_callback=None):
+        """Stream a multipart upload of data to path/filename.
+
+        data can be bytes, the path of a local file, or an async iterable of byte chunks.
+        Bytes and files are sent in UPLOAD_CHUNK_SIZE chunks, and retried on connection
+        errors. An async iterable can only be consumed once, so it is not retried.
+        progress_callback receives (uploaded bytes, total bytes or None).
+        """
+        replayable = isinstance(data, (bytes, bytearray, str, os.PathLike))
+        attempts = 1 + VAULT_UPLOAD_RETRIES if replayable else 1
+        for attempt in range(attempts):
+            chunks = self._upload_chunks(data) if replayable else data
+            form = aiohttp.FormData()
+            form.add_field('command', 'upload')
+            if key:
+                form.add_field('key', key)
+            total = self._upload_size(data)
+            form.add_field('files', self._track_progress(chunks, total, progress_callback), filename=filename)
+            try:
+                result = await self._post(path, form, timeout=self._streaming_timeout())
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == attempts - 1:
+                    raise
+                delay = UPLOAD_RETRY_DELAY * 2 ** attempt
+                Logs.warning(f"Upload of {filename} failed, retrying in {delay} seconds")
+                await asyncio.sleep(delay)
+        self.invalidate(path)
+        return result
+
+    @staticmethod
+    def _upload_size(data):
+        if isinstance(data, (bytes, bytearray)):
+            return len(data)
+        if isinstance(data, (str, os.PathLike)):
+            return os.path.getsize(data)
+        return None
+
+    @staticmethod
+    async def _upload_chunks(data):
+        if isinstance(data, (bytes, bytearray)):
+            view = memoryview(data)
+            for start in range(0, len(view), UPLOAD_CHUNK_SIZE):
+                yield bytes(view[start:start + UPLOAD_CHUNK_SIZE])
+            return
+        loop = asyncio.get_event_loop()
+        with open(data, 'rb') as f:
+            while True:
+                chunk = await loop.run_in_executor(None, f.read, UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+    @staticmethod
+    async def _track_progress(chunks, total, progress_callback):
+        uploaded = 0
+        last_update = time.time()
+        async for chunk in chunks:
+            yield chunk
+            uploaded += len(chunk)
+            now = time.time()
+            if progress_callback and now - last_update > 1:
+                progress_callback(uploaded, total)
+                last_update = now
+        if progress_callback:
+            progress_callback(uploaded, total)
+
+    @staticmethod
+    def _streaming_timeout():
+        # Only bound the time between reads, so large transfers aren't cut off.
+        return aiohttp.ClientTimeout(total=None, sock_read=VAULT_TIMEOUT, connect=VAULT_CONNECT_TIMEOUT)
 
     # creates a path and returns True. returns False if path exists
-    def create_path(self, path, key=None):
-        return self._command('create', path, {'key': key})
+    async def create_path(self, path, key=None):
+        return await self._command('create', path, {'key': key})
+
+    # rename file or folder at path to name
+    async def rename_path(self, path, name, key=None):
+        return await self._command('rename', path, {'name': name, 'key': key})
+
+    # delete file or folder at path
+    async def delete_path(self, path, key=None):
+        return await self._command('delete', path, {'key': key})
 
     # decrypts full contents of path, return False if key invalid
-    def decrypt_folder(self, path, key):
-        return self._command('decrypt', path, {'key': key})
+    async def decrypt_folder(self, path, key):
+        return await self._command('decrypt', path, {'key': key})
 
     # get supported file extensions
-    def get_extensions(self):
+    async def get_extensions(self):
         url = f'{self.server_url}/info'
-        r = requests.get(url)
-        return r.json()['extensions']
-
-    # write decrypted file to out_put
-    def get_file(self, path, key, out_path):
-        response = self.get(path, key)
-        if not response.ok:
-            return False
-        with open(out_path, 'wb') as f:
-            f.write(response.content)
+        async with self.session.get(url) as response:
+            response.raise_for_status()
+            return (await response.json())['extensions']
+
+    # write decrypted file to out_path
+    async def get_file(self, path, key, out_path, progress_callback=None):
+        """Stream file at path to out_path. progress_callback receives (downloaded bytes, total bytes)."""
+        url = self.get_url(path)
+        async with self.session.get(url, headers=self.get_headers(key), timeout=self._streaming_timeout()) as response:
+            if not response.ok:
+                return False
+            total = response.content_length
+            downloaded = 0
+            last_update = time.time()
+            with open(out_path, 'wb') as f:
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    downloaded += len(chunk)
+                    now = time.time()
+                    if progress_callback and now - last_update > 1:
+                        progress_callback(downloaded, total)
+                        last_update = now
         return True
 
     # check if key is correct to decrypt
-    def is_key_valid(self, path, key):
-        r = self._command('verify', path, {'key': key})
-        return r.json()['success']
+    async def is_key_valid(self, path, key):
+        result = await self._command('verify', path, {'key': key})
+        return result['success']
 
     # list files, folders, and locked folders in path
-    def list_path(self, path=None, key=None):
-        r = self.get(path, key)
-        return r.json()
+    async def list_path(self, path=None, key=None, use_cache=True):
+        """List path, reusing a cached listing if it is newer than listing_ttl.
+
+        Returns a copy, so callers can modify the listing.
+        """
+        cache_key = (self.normalize_path(path), key)
+        cached = self._listings.get(cache_key)
+        if use_cache and cached and time.time() - cached[0] < self.listing_ttl:
+            return copy.deepcopy(cached[1])
+        # Share a fetch that is already in flight, e.g. from a prefetch.
+        task = self._pending_listings.get(cache_key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_listing(path, key, cache_key))
+            self._pending_listings[cache_key] = task
+            task.add_done_callback(lambda _: self._pending_listings.pop(cache_key, None))
+        listing = await asyncio.shield(task)
+        return copy.deepcopy(listing)
 
-    def get(self, path, key):
+    def prefetch_listings(self, paths, key=None):
+        """Fetch listings for paths in the background, skipping ones already cached."""
+        for path in paths:
+            cache_key = (self.normalize_path(path), key)
+            cached = self._listings.get(cache_key)
+            if cached and time.time() - cached[0] < self.listing_ttl:
+                continue
+            if cache_key in self._pending_listings:
+                continue
+            task = asyncio.ensure_future(self._fetch_listing(path, key, cache_key))
+            self._pending_listings[cache_key] = task
+            task.add_done_callback(self._on_prefetch_done(cache_key))
+
+    def _on_prefetch_done(self, cache_key):
+        def callback(task):
+            self._pending_listings.pop(cache_key, None)
+            if not task.cancelled() and task.exception():
+                Logs.debug(f"Failed to prefetch Vault listing {cache_key[0]}: {task.exception()}")
+        return callback
+
+    def invalidate(self, path=None):
+        """Drop cached listings of path and its parent, or every listing if path is None."""
+        self._listing_generation += 1
+        if path is None:
+            self._listings.clear()
+            return
+        path = self.normalize_path(path)
+        parent = path.rsplit('/', 1)[0] if '/' in path else ''
+        for cache_key in list(self._listings):
+            if cache_key[0] in (path, parent) or cache_key[0].startswith(f'{path}/'):
+                del self._listings[cache_key]
+
+    async def _fetch_listing(self, path, key, cache_key):
+        generation = self._listing_generation
+        async with self.session.get(self.get_url(path), headers=self.get_headers(key)) as response:
+            response.raise_for_status()
+            listing = await response.json()
+        if generation == self._listing_generation:
+            self._listings[cache_key] = (time.time(), listing)
+        return listing
+
+    @staticmethod
+    def normalize_path(path):
+        path = (path or '').strip('/')
+        if path == '.':
+            return ''
+        if path.startswith('./'):
+            path = path[2:]
+        return path
+
+    async def get_filesize(self, path):
+        """Get size of file at path in KB."""
+        async with self.session.head(self.get_url(path), headers=self.get_headers()) as response:
+            response.raise_for_status()
+            return int(response.headers['Content-Length']) / 1000
+
+    async def probe_map(self, path, key=None):
+        """Read the MRC header and uncompressed size of a map, without downloading it.
+
+        Uses HTTP Range requests for the start of the file and, for .gz files, the gzip
+        trailer, which stores the uncompressed size. Results are cached per path and ETag.
+        Returns an MRCHeader, or None if the server doesn't support Range requests
+        or the file isn't an MRC map.
+        """
+        url = self.get_url(path)
+        async with self.session.head(url, headers=self.get_headers(key)) as response:
+            response.raise_for_status()
+            etag = response.headers.get('ETag')
+            size = int(response.headers['Content-Length'])
+        cache_key = (self.normalize_path(path), etag)
+        if etag and cache_key in self._map_probes:
+            return self._map_probes[cache_key]
+        try:
+            if path.endswith('.gz'):
+                head = await self._get_range(url, key, 0, min(size, PROBE_GZIP_BYTES) - 1)
+                trailer = await self._get_range(url, key, size - 4, size - 1)
+                header_bytes = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(head, MRC_HEADER_SIZE)
+                # ISIZE is stored modulo 2^32, MRCHeader.size_mb also checks the grid size.
+                file_size = struct.unpack('<I', trailer)[0]
+            else:
+                header_bytes = await self._get_range(url, key, 0, MRC_HEADER_SIZE - 1)
+                file_size = size
+            header = MRCHeader(header_bytes, file_size)
+        except (ValueError, zlib.error, struct.error) as e:
+            Logs.debug(f"Could not probe map header of {path}: {e}")
+            return None
+        if etag:
+            self._map_probes[cache_key] = header
+        return header
+
+    async def _get_range(self, url, key, start, end):
         headers = self.get_headers(key)
-        url = self.server_url + '/files/' + (path or '')
-        return requests.get(url, headers=headers)
+        headers['Range'] = f'bytes={start}-{end}'
+        async with self.session.get(url, headers=headers) as response:
+            if response.status != 206:
+                raise ValueError("Range requests not supported")
+            return await response.read()
+
+    def get_url(self, path):
+        return self.server_url + '/files/' + (path or '')
 
     def get_headers(self, key=None):
         headers = {}
@@ -59,21 +316,18 @@ class VaultManager:
             headers['vault-key'] = key
         return headers
 
-    def _command(self, command, path, data=None, files=None):
-        headers = {}
-        if self.api_key:
-            headers['vault-api-key'] = self.api_key
-        if data is None:
-            data = {}
+    async def _command(self, command, path, data=None):
+        data = {k: v for k, v in (data or {}).items() if v is not None}
         data['command'] = command
-        url = self.server_url + '/files/' + path
-        return requests.post(url, headers=headers, data=data, files=files)
+        result = await self._post(path, data)
+        if command in ('create', 'rename', 'delete', 'decrypt'):
+            self.invalidate(path)
+        return result
 
-    def get_filesize(self, path):
-        headers = {}
-        if self.api_key:
-            headers['vault-api-key'] = self.api_key
-        url = self.server_url + '/files/' + (path or '')
-        response = requests.head(url, headers=headers)
-        filesize = int(response.headers['Content-Length']) / 1000
-        return filesize
+    async def _post(self, path, data, timeout=None):
+        kwargs = {'timeout': timeout} if timeout else {}
+        async with self.session.post(self.get_url(path), headers=self.get_headers(), data=data, **kwargs) as response:
+            if response.status >= 500:
+                # Server errors are retried by add_file
+                response.raise_for_status()
+            return await response.json(content_type=None)
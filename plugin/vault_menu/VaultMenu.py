@@ -1,6 +1,8 @@
 import aiohttp
+import asyncio
 import gzip
 import os
+import shutil
 import sys
 import tempfile
 import time
@@ -11,7 +13,11 @@ import nanome
 from nanome.util import Color, Logs, enums
 from nanome.util.enums import ExportFormats
 
-from plugin.utils import get_extension
+from plugin.memory import InsufficientMemory
+from plugin.mesh_io import MESH_ARTIFACT_SUFFIX, MeshArtifact, hash_file
+from plugin.metrics import span
+from plugin.models import MapGroup, MapMesh
+from plugin.utils import MRC_MODE_BYTES, get_extension
 
 
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -25,6 +31,13 @@ ORG_FOLDER = 'my org'
 
 
 MAX_MAP_SIZE_MB = int(os.environ.get('MAX_MAP_SIZE_MB', 350))
+MODEL_EXTENSIONS = ['pdb', 'sdf', 'cif', 'mmcif']  # More formats need to be added
+MAP_EXTENSIONS = ['map.gz', 'map', 'mrc', 'ccp4']
+SUPPORTED_FILE_FORMATS = ['pdb', 'sdf', 'cif', 'map', 'map.gz', 'ccp4']
+# List items are only created for the page being shown.
+VAULT_FILES_PER_PAGE = int(os.environ.get('VAULT_FILES_PER_PAGE', 50))
+# Save generated meshes next to their map in Vault, so the next load can skip meshing.
+SAVE_MESH_ARTIFACTS = os.environ.get('SAVE_MESH_ARTIFACTS', '').lower() in ('1', 'true', 'yes')
 
 
 class VaultMenu:
@@ -33,6 +46,8 @@ class VaultMenu:
         self.ui_manager = plugin_instance.ui_manager
         self.plugin_instance = plugin_instance
         self.session_client = plugin_instance.client
+        # Progress updates are batched, they're sent for every downloaded chunk.
+        self.ui_updates = plugin_instance.ui_updates
         self.address = vault_manager.server_url
         self.vault_manager = vault_manager
         self.path = '.'
@@ -42,6 +57,14 @@ class VaultMenu:
         self.selected_items = []
         self.showing_upload = False
 
+        # (item, is_folder) for every entry of the current listing, in display order
+        self.entries = []
+        # Names of all files in the current listing, including unsupported ones
+        self.listed_files = set()
+        self.page = 0
+        # (name, is_folder) -> list item node, created when its page is first shown
+        self.item_nodes = {}
+
         self.pending_action = None
         self.pending_integration = False
 
@@ -55,9 +78,17 @@ class VaultMenu:
         self.folder_to_unlock = None
 
         self.btn_upload_selected = None
+        # urlpath -> (downloaded bytes, total bytes) for downloads in progress
+        self.download_progress = {}
+        # Files in the batch being loaded, including those not downloading yet
+        self.download_batch_size = 0
         self.upload_item = None
         self.upload_name = None
         self.upload_ext = None
+        # Exports are spooled to this file, so they aren't held in memory until uploaded
+        self.upload_path = None
+        # Background task filling in the map info of the current listing
+        self.map_info_task = None
 
         self.create_menu()
 
@@ -69,8 +100,8 @@ class VaultMenu:
         self.pfb_list_item = nanome.ui.LayoutNode.io.from_json(LIST_ITEM_PATH)
 
         # outer wrapper components
-        def go_up(button):
-            self.open_folder('..')
+        async def go_up(button):
+            await self.open_folder('..')
             self.toggle_upload(show=False)
         self.btn_up = root.find_node('GoUpButton').get_content()
         self.ui_manager.register_btn_pressed_callback(self.btn_up, go_up)
@@ -105,6 +136,13 @@ class VaultMenu:
         self.lst_files = ln_file_list.get_content()
         self.lst_files.parent = ln_file_list
 
+        self.ln_pager = root.find_node('FilePager')
+        self.lbl_page = self.ln_pager.find_node('PageLabel').get_content()
+        self.btn_prev_page = self.ln_pager.find_node('PrevPage').get_content()
+        self.btn_next_page = self.ln_pager.find_node('NextPage').get_content()
+        self.ui_manager.register_btn_pressed_callback(self.btn_prev_page, self.prev_page)
+        self.ui_manager.register_btn_pressed_callback(self.btn_next_page, self.next_page)
+
         ln_file_loading = root.find_node('FileLoading')
         self.lbl_loading = ln_file_loading.get_content()
         self.lbl_loading.parent = ln_file_loading
@@ -119,7 +157,7 @@ class VaultMenu:
         self.lst_actions = root.find_node('ActionsList').get_content()
 
         inp_dialog_action = self.ln_actions_dialog.find_node('Input').get_content()
-        inp_dialog_action.register_submitted_callback(self.on_action_confirm)
+        self.ui_manager.register_text_submit_callback(inp_dialog_action, self.on_action_confirm)
         btn_action_cancel = self.ln_actions_dialog.find_node('Cancel').get_content()
         self.ui_manager.register_btn_pressed_callback(btn_action_cancel, self.on_action_cancel)
         btn_action_confirm = self.ln_actions_dialog.find_node('Confirm').get_content()
@@ -143,7 +181,7 @@ class VaultMenu:
 
         self.inp_unlock = root.find_node('UnlockInput').get_content()
         self.inp_unlock.password = True
-        self.inp_unlock.register_submitted_callback(self.open_locked_folder)
+        self.ui_manager.register_text_submit_callback(self.inp_unlock, self.open_locked_folder)
 
         self.btn_unlock_cancel = root.find_node('UnlockCancel').get_content()
         self.ui_manager.register_btn_pressed_callback(self.btn_unlock_cancel, self.cancel_open_locked)
@@ -172,7 +210,7 @@ class VaultMenu:
 
         self.ln_upload_workspace = root.find_node('UploadWorkspace')
         self.inp_workspace_name = root.find_node('UploadWorkspaceName').get_content()
-        self.inp_workspace_name.register_submitted_callback(self.upload_workspace)
+        self.ui_manager.register_text_submit_callback(self.inp_workspace_name, self.upload_workspace)
         btn_workspace_continue = root.find_node('UploadWorkspaceContinue').get_content()
         self.ui_manager.register_btn_pressed_callback(btn_workspace_continue, self.upload_workspace)
 
@@ -192,9 +230,9 @@ class VaultMenu:
         self.ln_lb_vault_load = root.find_node('ln_lb_vault_load')
         self.lb_vault_load = self.ln_lb_vault_load.get_content()
 
-    def show_menu(self):
+    async def show_menu(self):
         self.lbl_instr.text_value = f'Visit {self.address} in browser to add files'
-        self.update()
+        await self.update()
         self.menu.enabled = True
         self.session_client.update_menu(self.menu)
 
@@ -205,9 +243,14 @@ class VaultMenu:
             path = path.replace(self.org, org_folder)
         return path
 
-    def update(self):
+    async def update(self):
         self.selected_items.clear()
-        items = self.vault_manager.list_path(self.path + '/', self.folder_key)
+        try:
+            items = await self.vault_manager.list_path(self.path + '/', self.folder_key)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            Logs.warning(f"Failed to list Vault path {self.path}", exc_info=True)
+            await self.session_client.send_notification(enums.NotificationTypes.error, "Could not reach Vault")
+            return
         at_root = self.path == '.'
 
         if at_root:
@@ -232,6 +275,46 @@ class VaultMenu:
         self.update_crumbs()
         self.update_explorer(items)
         self.update_controls()
+        self.prefetch_subfolders(items)
+
+    def prefetch_subfolders(self, items):
+        """Load listings of the visible subfolders in the background, so opening them is instant."""
+        paths = [
+            f"{self.path}/{folder['name']}/" for folder in items['folders']
+            if folder['name'] not in items['locked'] or self.folder_key
+        ]
+        self.vault_manager.prefetch_listings(paths, self.folder_key)
+
+    async def show_map_info(self):
+        """Show grid and unzipped size of the listed maps, read from their headers."""
+        if self.sort_by != 'name':
+            # InfoNode is showing the sort field
+            return
+        path = self.path
+        map_items = [
+            item for item in self.lst_files.items
+            if not item.is_folder and get_extension(item.name) in MAP_EXTENSIONS
+        ]
+        if not map_items:
+            return
+        headers = await asyncio.gather(*[self.probe_map(item.name) for item in map_items])
+        if path != self.path:
+            return
+        for item, header in zip(map_items, headers):
+            if header:
+                ln_info = item.find_node('InfoNode')
+                ln_info.get_content().text_value = header.summary
+                ln_info.enabled = True
+        self.session_client.update_content(self.lst_files)
+
+    async def probe_map(self, filename):
+        """Get the MRCHeader of a map in the current folder, or None if it can't be read remotely."""
+        path = os.path.join(self.path, filename)
+        try:
+            return await self.vault_manager.probe_map(path, self.folder_key)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            Logs.warning(f"Failed to probe {path}", exc_info=True)
+            return None
 
     def update_crumbs(self):
         at_root = self.path == '.'
@@ -257,8 +340,6 @@ class VaultMenu:
         if self.locked_path is None:
             self.folder_key = None
 
-        self.lst_files.items.clear()
-
         # sort desc for 1 unless sorting by name
         if self.sort_by == 'name':
             reverse = self.sort_order == -1
@@ -267,22 +348,57 @@ class VaultMenu:
             reverse = self.sort_order == 1
             def key_fn(x): return x[self.sort_by]
 
+        self.listed_files = {file['name'] for file in items['files']}
+        # Filter before sorting, sorted computes each key once.
+        files = [file for file in items['files'] if get_extension(file['name']) in SUPPORTED_FILE_FORMATS]
         folders = sorted(items['folders'], key=key_fn, reverse=reverse)
-        files = sorted(items['files'], key=key_fn, reverse=reverse)
+        files.sort(key=key_fn, reverse=reverse)
+
+        self.entries = [(folder, True) for folder in folders] + [(file, False) for file in files]
+        self.item_nodes.clear()
+        self.page = 0
+        self.render_page()
+
+    @property
+    def page_count(self):
+        return max(1, -(-len(self.entries) // VAULT_FILES_PER_PAGE))
+
+    def render_page(self):
+        """Show the current page of entries, creating list items only for entries on it."""
+        page_count = self.page_count
+        self.page = max(0, min(self.page, page_count - 1))
+        start = self.page * VAULT_FILES_PER_PAGE
+        self.lst_files.items.clear()
+        for item, is_folder in self.entries[start:start + VAULT_FILES_PER_PAGE]:
+            node_key = (item['name'], is_folder)
+            if node_key not in self.item_nodes:
+                self.item_nodes[node_key] = self.create_item(item, is_folder)
+            self.lst_files.items.append(self.item_nodes[node_key])
+
+        self.ln_pager.enabled = page_count > 1
+        self.lbl_page.text_value = f'{self.page + 1} / {page_count}'
+        self.btn_prev_page.unusable = self.page == 0
+        self.btn_next_page.unusable = self.page == page_count - 1
+        self.session_client.update_node(self.ln_pager)
+        self.session_client.update_content(self.lst_files)
 
-        for folder in folders:
-            self.add_item(folder, True)
+        if self.map_info_task:
+            self.map_info_task.cancel()
+        self.map_info_task = asyncio.ensure_future(self.show_map_info())
 
-        for file in files:
-            supported_file_formats = ['pdb', 'sdf', 'cif', 'map', 'map.gz', 'ccp4']
-            extension = file['name'].split('.')[-1]
-            if extension == 'gz':
-                # Make sure we catch map.gz files
-                extension = '.'.join(file['name'].split('.')[-2:])
-            if extension in supported_file_formats:
-                self.add_item(file, False)
+    def prev_page(self, button=None):
+        self.change_page(-1)
 
-        self.session_client.update_content(self.lst_files)
+    def next_page(self, button=None):
+        self.change_page(1)
+
+    def change_page(self, step):
+        page = self.page + step
+        if page < 0 or page >= self.page_count:
+            return
+        self.page = page
+        self.render_page()
+        self.update_controls()
 
     def update_actions(self):
         def make_action(action):
@@ -339,7 +455,7 @@ class VaultMenu:
         self.btn_load.text.value.set_all('Load' + items_text)
         self.session_client.update_content(self.btn_load)
 
-    def add_item(self, item, is_folder):
+    def create_item(self, item, is_folder):
         name = item['name']
         new_item = self.pfb_list_item.clone()
         new_item.name = name
@@ -372,8 +488,7 @@ class VaultMenu:
 
         cb = self.on_folder_pressed if is_folder else self.on_file_pressed
         self.ui_manager.register_btn_pressed_callback(btn, cb)
-
-        self.lst_files.items.append(new_item)
+        return new_item
 
     def on_file_pressed(self, button):
         button.selected = not button.selected
@@ -385,10 +500,10 @@ class VaultMenu:
         self.update_controls()
         self.session_client.update_content(button)
 
-    def on_folder_pressed(self, button):
-        self.open_folder(button.item_name)
+    async def on_folder_pressed(self, button):
+        await self.open_folder(button.item_name)
 
-    def open_folder(self, folder):
+    async def open_folder(self, folder):
         if folder in self.locked_folders and not self.folder_key:
             self.ln_explorer.enabled = False
             self.inp_unlock.input_text = ''
@@ -407,15 +522,15 @@ class VaultMenu:
         if self.path[:2] == '..':
             self.path = '.'
 
-        self.update()
+        await self.update()
 
-    def open_locked_folder(self, button=None):
+    async def open_locked_folder(self, button=None):
         key = self.inp_unlock.input_text
         path = os.path.join(self.path, self.folder_to_unlock)
 
-        if self.vault_manager.is_key_valid(path, key):
+        if await self.vault_manager.is_key_valid(path, key):
             self.folder_key = key
-            self.open_folder(self.folder_to_unlock)
+            await self.open_folder(self.folder_to_unlock)
             self.cancel_open_locked()
         else:
             self.ln_unlock_error.enabled = True
@@ -472,35 +587,37 @@ class VaultMenu:
         self.ln_actions_dialog.enabled = False
         self.session_client.update_node(self.ln_actions_panel)
 
-    def on_action_confirm(self, button):
+    async def on_action_confirm(self, button):
         inp_text = self.ln_actions_dialog.find_node('Input').get_content().input_text
         key = self.folder_key
 
         if self.pending_action == 'New Folder':
-            self.vault_manager.create_path(f'{self.path}/{inp_text}', key)
+            await self.vault_manager.create_path(f'{self.path}/{inp_text}', key)
 
         elif self.pending_action == 'Rename':
             name = self.selected_items[0].item_name
             ext = name.split('.')[-1]
             new_name = inp_text + '.' + ext
-            self.vault_manager.rename_path(f'{self.path}/{name}', new_name, key)
+            await self.vault_manager.rename_path(f'{self.path}/{name}', new_name, key)
 
         elif self.pending_action == 'Delete':
-            for item in self.selected_items:
+            await asyncio.gather(*[
                 self.vault_manager.delete_path(f'{self.path}/{item.item_name}', key)
+                for item in self.selected_items
+            ])
 
         elif self.pending_action == 'Rename Folder':
-            self.vault_manager.rename_path(self.path, inp_text, key)
+            await self.vault_manager.rename_path(self.path, inp_text, key)
 
         elif self.pending_action == 'Delete Folder':
-            self.vault_manager.delete_path(self.path, key)
+            await self.vault_manager.delete_path(self.path, key)
 
         self.toggle_actions()
 
         if self.pending_action in ['Rename Folder', 'Delete Folder']:
-            self.open_folder('..')
+            await self.open_folder('..')
         else:
-            self.update()
+            await self.update()
 
     def toggle_actions(self, button=None):
         enabled = not self.ln_actions_panel.enabled
@@ -522,7 +639,7 @@ class VaultMenu:
         self.ln_actions_panel.enabled = enabled
         self.session_client.update_node(self.ln_actions_panel)
 
-    def change_sort(self, button):
+    async def change_sort(self, button):
         # reset state of old sort button
         if self.sort_btn is not None and button != self.sort_btn:
             self.sort_btn.selected = False
@@ -542,7 +659,7 @@ class VaultMenu:
             button.icon.active = True
 
         self.session_client.update_content(self.sort_btn)
-        self.update()
+        await self.update()
 
     def select_all(self, button):
         if self.selected_items:
@@ -551,7 +668,7 @@ class VaultMenu:
                 item.selected = False
             self.selected_items.clear()
         else:
-            # select all files
+            # select all files on the current page
             self.selected_items.clear()
             for item in self.lst_files.items:
                 if item.is_folder:
@@ -582,6 +699,7 @@ class VaultMenu:
         self.upload_item = None
         self.upload_name = None
         self.upload_ext = None
+        self.discard_upload_file()
 
         self.ln_upload_message.enabled = True
         self.ln_upload_workspace.enabled = False
@@ -625,8 +743,8 @@ class VaultMenu:
             return
 
         results = await self.session_client.request_export(ExportFormats.Nanome)
-        self.upload_item = results[0]
         self.upload_name = name
+        await self.spool_upload_file(results.pop(0))
         self.upload_ext = 'nanome'
         self.ln_upload_workspace.enabled = False
         self.show_upload_confirm()
@@ -681,7 +799,8 @@ class VaultMenu:
     async def upload_complex(self, extension, format, button):
         results = await self.session_client.request_export(format, entities=[self.upload_item.index])
         self.upload_name = self.upload_item.name
-        self.upload_item = results[0]
+        self.upload_item = None
+        await self.spool_upload_file(results.pop(0))
         self.upload_ext = extension
         self.ln_upload_complex_type.enabled = False
         self.show_upload_confirm()
@@ -701,10 +820,43 @@ class VaultMenu:
         self.lbl_upload_confirm.text_value = f'upload {self.upload_name}.{self.upload_ext}?'
         self.session_client.update_menu(self.menu)
 
-    def confirm_upload(self, button):
-        self.session_client.save_file(self.upload_item, self.upload_name, self.upload_ext)
+    async def spool_upload_file(self, data):
+        """Write exported data to a temp file, which confirm_upload streams to Vault."""
+        self.discard_upload_file()
+        fd, self.upload_path = tempfile.mkstemp(dir=self.plugin_instance.temp_dir.name)
+        loop = asyncio.get_event_loop()
+        with os.fdopen(fd, 'wb') as f:
+            await loop.run_in_executor(None, f.write, data)
+
+    def discard_upload_file(self):
+        if self.upload_path and os.path.exists(self.upload_path):
+            os.remove(self.upload_path)
+        self.upload_path = None
+
+    async def confirm_upload(self, button):
+        filename = f'{self.upload_name}.{self.upload_ext}'
+        data = self.upload_path or self.upload_item.encode()
+        loading_bar = self.ln_lb_vault_load.get_content()
+        loading_bar.percentage = 0
+        self.ln_lb_vault_load.enabled = True
+        self.ui_updates.update_node(self.ln_lb_vault_load)
+
+        def on_progress(uploaded, total):
+            if total:
+                loading_bar.percentage = uploaded / total
+                self.ui_updates.update_content(loading_bar)
+
+        try:
+            await self.vault_manager.add_file(
+                f'{self.path}/', filename, data, self.folder_key, progress_callback=on_progress)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            Logs.warning(f"Failed to upload {filename} to Vault", exc_info=True)
+            await self.session_client.send_notification(enums.NotificationTypes.error, f"Could not upload {filename}")
+        finally:
+            self.ln_lb_vault_load.enabled = False
+            self.ui_updates.update_node(self.ln_lb_vault_load)
         self.toggle_upload(show=False)
-        self.update()
+        await self.update()
 
     async def load_files(self, button=None):
         if not self.selected_items:
@@ -717,29 +869,40 @@ class VaultMenu:
 
         # Set up loading bar
         self.ln_lb_vault_load.enabled = True
-        self.session_client.update_node(self.ln_lb_vault_load)
+        self.ui_updates.update_node(self.ln_lb_vault_load)
         loading_bar = self.ln_lb_vault_load.get_content()
 
-        self.session_client.update_node(self.ln_explorer, self.ln_lb_vault_load)
+        self.ui_updates.update_node(self.ln_explorer, self.ln_lb_vault_load)
         self.ln_lb_vault_load.enabled = True
-        self.session_client.update_node(self.ln_lb_vault_load)
+        self.ui_updates.update_node(self.ln_lb_vault_load)
 
-        # Get all the selected files and setup coroutines to download
-        load_requests = []
+        # Every file loads into the same MapGroup, resolved once up front.
+        mapgroup = self.get_target_mapgroup()
+        if not mapgroup:
+            await self.session_client.send_notification(enums.NotificationTypes.error, "Please select a MapGroup.")
+        else:
+            # Files download and parse concurrently. Workspace updates are serialized
+            # by the MapGroup lock, so concurrent loads can't create duplicate meshes.
+            filenames = [btn.item_name for btn in self.selected_items]
+            self.download_progress.clear()
+            self.download_batch_size = len(filenames)
+            loaded = 0
+
+            async def load(filename):
+                nonlocal loaded
+                try:
+                    await self.load_file(filename, mapgroup)
+                finally:
+                    loaded += 1
+                    self.update_lbl_loading_text(f'loading... ({loaded}/{len(filenames)})')
+            results = await asyncio.gather(*[load(filename) for filename in filenames], return_exceptions=True)
+            for filename, result in zip(filenames, results):
+                if isinstance(result, Exception):
+                    Logs.error(f"Failed to load {filename}: {result}")
+            await self.plugin_instance.menu.render(selected_mapgroup=mapgroup)
         for btn in self.selected_items:
-            filename = btn.item_name
-            load_requests.append(self.load_file(filename))
             btn.selected = False
 
-        # Using .gather() is a nicer solution here when multiple files are being uploaded,
-        # but it causes a bug where redrawing the mesh after loading creates a new copy, instead
-        # of updating the original. Very weird, but getting rid of .gather() fixes it
-        # await asyncio.gather(*load_requests)
-        for i in range(0, len(load_requests)):
-            coro = load_requests[i]
-            self.update_lbl_loading_text(f'loading... ({i + 1}/{len(load_requests)})')
-            await coro
-
         self.lb_vault_load.percentage = 0
         self.btn_load.text.value.set_all("Load")
         self.session_client.update_content(self.btn_load, self.lb_vault_load)
@@ -756,86 +919,139 @@ class VaultMenu:
         loading_bar.percentage = 0
         self.session_client.update_menu(self.menu)
 
-    async def load_file(self, filename):
+    def get_target_mapgroup(self):
+        """Get the MapGroup selected in the main menu, creating one if there are none."""
+        plugin = self.plugin_instance
+        if not plugin.groups:
+            return plugin.add_mapgroup()
+        return plugin.get_group(plugin.menu.get_selected_mapgroup())
+
+    async def load_file(self, filename, mapgroup=None):
         path = os.path.join(self.path, filename)
         key = self.folder_key
         extension = filename.split('.')[-1]
         if extension == 'gz':
             extension = '.'.join(filename.split('.')[-2:])
 
-        # Download file from Vault and save to temp directory
-        temp_dir = tempfile.TemporaryDirectory()
-        local_file = os.path.join(temp_dir.name, filename)
-        await self.download_file_from_vault(path, local_file, key)
+        # Reject maps that don't fit in memory from their header, before downloading them
+        header = await self.probe_map(filename) if extension in MAP_EXTENSIONS else None
+        if header:
+            try:
+                self.plugin_instance.memory_budget.plan(header.dimensions, MRC_MODE_BYTES[header.mode])
+            except InsufficientMemory as e:
+                Logs.warning(f"Cannot load {filename}: {e}")
+                await self.session_client.send_notification(enums.NotificationTypes.error, str(e))
+                return
+
+        # Download file from Vault into the session's temp directory.
+        # MapGroups read their files again after loading, e.g. to box the map, so it is kept until the session ends.
+        download_dir = tempfile.mkdtemp(dir=self.plugin_instance.temp_dir.name)
+        local_file = os.path.join(download_dir, filename)
+        if not await self.download_file_from_vault(path, local_file, key):
+            shutil.rmtree(download_dir)
+            await self.session_client.send_notification(enums.NotificationTypes.error, f"Could not download {filename}")
+            return
 
-        # Validate file size
-        valid = await self.validate_filesize(local_file)
-        if not valid:
+        # Validate file size, if it wasn't known from the header
+        if not header and not await self.validate_filesize(local_file):
             unzipped_filesize = self.get_unzipped_filesize_mb(local_file)
-            msg = f"{'Unzipped' if extension == '.gz' else ''} Map file is too large: {unzipped_filesize}MB > {MAX_MAP_SIZE_MB}MB"
-            await self.session_client.send_notification(enums.NotificationTypes.error, msg)
-            Logs.error(msg)
-            Logs.warning(f"File too large. Cannot load {filename}")
+            shutil.rmtree(download_dir)
+            await self.notify_file_too_large(filename, extension, unzipped_filesize)
             return
-        model_extensions = ['pdb', 'sdf', 'cif', 'mmcif']  # More formats need to be added
-        map_extensions = ['map.gz', 'map', 'mrc', 'ccp4']
-        if extension in model_extensions:
-            await self.plugin_instance.add_model_to_group(local_file)
-        elif extension in map_extensions:
-            self.update_load_btn_text("Generating mesh...")
-            await self.plugin_instance.add_mapfile_to_group(local_file)
+        loop = asyncio.get_event_loop()
+        if extension in MODEL_EXTENSIONS:
+            # Parse in worker threads, before waiting on the MapGroup.
+            model_comp, model = await asyncio.gather(
+                self.plugin_instance.create_model_complex(local_file),
+                loop.run_in_executor(None, MapGroup.load_model, local_file))
+            await self.plugin_instance.add_model_to_group(local_file, mapgroup, model_comp, model)
+        elif extension in MAP_EXTENSIONS:
+            # The map is parsed once per host, by the plugin's map store.
+            source_hash = await loop.run_in_executor(None, hash_file, local_file)
+            artifact = await self.load_mesh_artifact(filename, source_hash, download_dir)
+            self.update_load_btn_text("Loading mesh..." if artifact else "Generating mesh...")
+            try:
+                mapgroup = await self.plugin_instance.add_mapfile_to_group(
+                    local_file, isovalue=artifact and artifact.isovalue, mapgroup=mapgroup,
+                    mesh=artifact and artifact.to_mesh(), source_hash=source_hash)
+            except InsufficientMemory:
+                # The user was notified by add_mapfile_to_group.
+                shutil.rmtree(download_dir)
+                return
+            if mapgroup and not artifact and SAVE_MESH_ARTIFACTS:
+                await self.save_mesh_artifact(filename, mapgroup, source_hash)
         else:
+            shutil.rmtree(download_dir)
             Logs.warning(f"Invalid file type. Cannot load .{extension} files")
 
+    async def load_mesh_artifact(self, filename, source_hash, temp_dir):
+        """Download the mesh artifact saved next to a map, if it was generated from the same map and settings."""
+        artifact_name = filename + MESH_ARTIFACT_SUFFIX
+        if artifact_name not in self.listed_files:
+            return None
+        local_file = os.path.join(temp_dir, artifact_name)
+        if not await self.vault_manager.get_file(os.path.join(self.path, artifact_name), self.folder_key, local_file):
+            return None
+        try:
+            artifact = MeshArtifact.load(local_file)
+        except ValueError:
+            Logs.warning(f"Invalid mesh artifact {artifact_name}")
+            return None
+        if not MapMesh.is_mesh_artifact_current(artifact, source_hash):
+            Logs.message(f"Mesh artifact {artifact_name} is out of date")
+            return None
+        Logs.message(f"Using mesh artifact {artifact_name}")
+        return artifact
+
+    async def save_mesh_artifact(self, filename, mapgroup, source_hash):
+        artifact = MapMesh.create_mesh_artifact(mapgroup.map_mesh.mesh, mapgroup.isovalue, source_hash)
+        artifact_name = filename + MESH_ARTIFACT_SUFFIX
+        try:
+            await self.vault_manager.add_file(f'{self.path}/', artifact_name, artifact.to_bytes(), self.folder_key)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            Logs.warning(f"Failed to save mesh artifact {artifact_name}", exc_info=True)
+
+    async def notify_file_too_large(self, filename, extension, size_mb):
+        msg = f"{'Unzipped ' if extension == 'map.gz' else ''}Map file is too large: {size_mb}MB > {MAX_MAP_SIZE_MB}MB"
+        await self.session_client.send_notification(enums.NotificationTypes.error, msg)
+        Logs.error(msg)
+        Logs.warning(f"File too large. Cannot load {filename}")
+
     async def download_file_from_vault(self, urlpath, file_path: str, key=None):
         Logs.message("Downloading file from Vault")
-        url = f"{self.vault_manager.server_url}/files/{urlpath}"
-        # Write the map to a .map file
-        headers = self.vault_manager.get_headers()
-        session = aiohttp.ClientSession()
-
-        # Get content size from head request
-        response = await session.head(url, headers=headers)
-        file_size_mb = int(response.headers['Content-Length']) / (10 ** 6)
-
-        chunk_size = 8192
         loading_bar = self.ln_lb_vault_load.get_content()
-        response = await session.get(url, headers=headers)
-        with open(file_path, 'wb') as file:
-            start_time = time.time()
-            data_check = start_time
-            downloaded_chunks = 0
-            while True:
-                chunk = await response.content.read(chunk_size)
-                if not chunk:
-                    break
-                downloaded_chunks += len(chunk)
-                file.write(chunk)
-                now = time.time()
-                # Update UI with download progress
-                ui_update_interval = 1
-                if now - data_check > ui_update_interval:
-                    downloaded_mb = int(downloaded_chunks / 1000000)
-                    Logs.debug(f"{int(now - start_time)} seconds: {downloaded_mb} / {file_size_mb} mbs")
-                    loading_bar.percentage = downloaded_mb / file_size_mb
-                    btn_text = f"{int(downloaded_mb)}/{int(file_size_mb)} MB)"
-                    self.update_load_btn_text(btn_text)
-                    self.session_client.update_content(loading_bar)
-                    data_check = now
-        # Ensure the session is closed when you're done
-        await session.close()
-        self.update_load_btn_text("Load")
-        self.ln_lb_vault_load.enabled = False
-        self.session_client.update_node(self.ln_lb_vault_load)
-        Logs.message("Download Completed.")
+        start_time = time.time()
+
+        # Update UI with combined progress of all downloads in the batch.
+        # Files that haven't started downloading count as 0%, so the bar doesn't move back.
+        def on_progress(downloaded, total):
+            self.download_progress[urlpath] = (downloaded, total or downloaded)
+            downloaded_mb = sum(d for d, _ in self.download_progress.values()) / (10 ** 6)
+            file_size_mb = sum(t for _, t in self.download_progress.values()) / (10 ** 6)
+            Logs.debug(f"{int(time.time() - start_time)} seconds: {int(downloaded_mb)} / {file_size_mb} mbs")
+            batch_size = max(self.download_batch_size, len(self.download_progress))
+            loading_bar.percentage = sum(d / t for d, t in self.download_progress.values() if t) / batch_size
+            btn_text = f"{int(downloaded_mb)}/{int(file_size_mb)} MB)"
+            self.update_load_btn_text(btn_text)
+            self.ui_updates.update_content(loading_bar)
+
+        with span('download') as download_span:
+            success = await self.vault_manager.get_file(urlpath, key, file_path, progress_callback=on_progress)
+            download_span.counts['bytes'] = self.download_progress.get(urlpath, (0, 0))[0]
+        # The loading bar is hidden by load_files, once every file in the batch has loaded.
+        if success:
+            Logs.message("Download Completed.")
+        else:
+            Logs.warning(f"Failed to download {urlpath} from Vault")
+        return success
 
     def update_load_btn_text(self, text):
         self.btn_load.text.value.set_all(text)
-        self.session_client.update_content(self.btn_load)
+        self.ui_updates.update_content(self.btn_load)
 
     def update_lbl_loading_text(self, text):
         self.lbl_loading.text_value = text
-        self.session_client.update_content(self.lbl_loading)
+        self.ui_updates.update_content(self.lbl_loading)
 
     @staticmethod
     def get_unzipped_filesize_mb(filepath):
@@ -5,6 +5,8 @@ import nanome
 
 from nanome.beta.nanome_sdk.plugin_server import PluginServer
 from plugin import CryoEM
+from plugin.compute import ComputeService
+from plugin.metrics import METRICS_PORT, MetricsServer, registry
 
 
 def create_parser():
@@ -48,7 +50,27 @@ def main():
     name = "Cryo-EM"
     description = "Nanome plugin to load Cryo-EM maps and display them in Nanome as iso-surfaces"
     plugin_class = CryoEM
-    asyncio.run(server.run(host, port, name, description, plugin_class))
+    asyncio.run(run_server(server, host, port, name, description, plugin_class))
+
+
+async def run_server(server, *args):
+    # Compute workers are shared by every session, so they're owned by the server process.
+    compute_service = ComputeService()
+    await compute_service.start()
+    # Sessions report their metrics through the compute service.
+    metrics_server = None
+    if METRICS_PORT:
+        registry.add_gauge(
+            'cryoem_compute_jobs', "Queued and running compute jobs, and connected sessions.",
+            lambda: [({'state': state}, count) for state, count in compute_service.queue_depth().items()])
+        metrics_server = MetricsServer()
+        await metrics_server.start()
+    try:
+        await server.run(*args)
+    finally:
+        if metrics_server:
+            await metrics_server.close()
+        await compute_service.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from plugin import benchmark
+from plugin.CryoEM import CryoEM
+from plugin.models import MapMesh
+from plugin.utils import MRCHeader
+
+
+class BenchmarkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def test_synthetic_case(self):
+        with patch.object(benchmark, 'CASES', {'blobs_32': (32, 32)}):
+            mapfile, modelfile = benchmark.prepare_case('blobs_32', self.temp_dir.name)
+        header = MRCHeader.read(mapfile)
+        self.assertEqual(header.dimensions, (32, 32, 32))
+        self.assertEqual(header.mode, 2)
+        map_manager = MapMesh.load_mapfile(mapfile)
+        self.assertEqual(map_manager.map_data().size(), 32 ** 3)
+
+        comp = benchmark.load_complex(modelfile)
+        self.assertEqual(len(list(comp.atoms)), benchmark.BLOB_COUNT * len(benchmark.BLOB_ATOMS))
+        self.assertEqual(len(list(comp.chains)), 4)
+        CryoEM.remove_hydrogens(comp)
+        self.assertFalse([atom for atom in comp.atoms if atom.symbol == 'H'])
+
+    def test_run_case(self):
+        timings = benchmark.run_case('emd_8216', self.temp_dir.name, repeat=1)
+        expected_stages = {
+            'load_model', 'remove_hydrogens', 'load', 'stats', 'mesh', 'marching_cubes', 'coordinate_transform',
+            'simplify', 'limit_view', 'color_element', 'color_bfactor', 'color_chain', 'histogram', 'checkpoint',
+            'restore'}
+        self.assertEqual(set(timings), expected_stages)
+        self.assertGreater(timings['mesh'], timings['simplify'])
+        self.assertEqual(os.listdir(self.temp_dir.name), [])
+
+    def test_compare_results(self):
+        baseline = {'results': {'emd_8216': {'mesh': 1.0, 'stats': 0.01, 'histogram': 0.5}}}
+        results = {'results': {
+            'emd_8216': {'mesh': 1.3, 'stats': 0.03, 'histogram': 0.7, 'limit_view': 0.2},
+            'blobs_256': {'mesh': 20.0},
+        }}
+        regressions = benchmark.compare_results(results, baseline, threshold=0.25)
+        # stats tripled, but by less than the noise floor
+        self.assertEqual([(r.case, r.stage) for r in regressions], [('emd_8216', 'mesh'), ('emd_8216', 'histogram')])
+        regressions = benchmark.compare_results(results, baseline, threshold=0.25, stage_thresholds={'histogram': 0.5})
+        self.assertEqual([r.stage for r in regressions], ['mesh'])
@@ -0,0 +1,62 @@
+import asyncio
+import unittest
+from unittest.mock import patch
+
+from nanome.api import shapes, structure
+
+from plugin import client_profiler
+from plugin.client_profiler import ProfiledClient
+from plugin.metrics import MetricsRegistry
+
+
+class FakeClient:
+
+    def __init__(self):
+        self.reader = None
+
+    async def request_complexes(self, id_list):
+        await asyncio.sleep(0)
+        return [structure.Complex() for _ in id_list]
+
+    async def shapes_upload_multiple(self, shape_list):
+        return shape_list
+
+    def update_content(self, *content):
+        return content
+
+
+class ProfiledClientTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry(report=False)
+        patcher = patch.object(client_profiler, 'registry', self.registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = ProfiledClient(FakeClient())
+
+    def histogram(self, name, method):
+        return self.registry.histograms[(name, (('method', method),))]
+
+    async def test_records_latency_and_payload(self):
+        complexes = await self.client.request_complexes([1, 2, 3])
+        self.assertEqual(len(complexes), 3)
+        mesh = shapes.Mesh()
+        mesh.vertices = [0.0] * 30
+        await self.client.shapes_upload_multiple([mesh])
+
+        self.assertEqual(self.histogram('cryoem_rpc_seconds', 'request_complexes').count, 1)
+        self.assertEqual(self.histogram('cryoem_rpc_payload', 'request_complexes').sum, 3)
+        self.assertEqual(self.histogram('cryoem_rpc_payload', 'shapes_upload_multiple').sum, 10)
+        # Other methods and attributes are passed through
+        self.assertEqual(self.client.update_content('lbl'), ('lbl',))
+        self.client.reader = 'reader'
+        self.assertEqual(self.client._client.reader, 'reader')
+        self.assertEqual(self.client.calls['request_complexes'], 1)
+
+    async def test_flags_serial_calls(self):
+        for index in range(3):
+            await self.client.request_complexes([index])
+        # Concurrent calls are not serial
+        await asyncio.gather(self.client.request_complexes([3]), self.client.request_complexes([4]))
+        self.assertEqual(self.client.serial_calls['request_complexes'], 3)
+        self.assertEqual(self.histogram('cryoem_rpc_serial_gap_seconds', 'request_complexes').count, 3)
@@ -0,0 +1,129 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from unittest.mock import patch
+
+from plugin import compute
+from plugin.compute import ComputeClient, ComputeError, ComputeService, Job, JobPriority
+from plugin.metrics import MetricsRegistry
+from plugin.mesh_io import hash_file
+
+
+fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def add_job(a, b):
+    return a + b
+
+
+def failing_job():
+    raise ValueError('bad input')
+
+
+class ComputeQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.service = ComputeService(max_workers=1)
+
+    def submit(self, session, job_id, priority=JobPriority.BULK):
+        job = Job(session, job_id, 'mesh', (), priority)
+        with patch.object(self.service, '_jobs_available'):
+            self.service.submit(job)
+        return job
+
+    def test_interactive_jobs_first(self):
+        self.submit('session_1', 1)
+        self.submit('session_2', 2, JobPriority.INTERACTIVE)
+        self.assertEqual(self.service.next_job().job_id, 2)
+        self.assertEqual(self.service.next_job().job_id, 1)
+        self.assertIsNone(self.service.next_job())
+
+    def test_round_robin_between_sessions(self):
+        self.submit('session_1', 1)
+        self.submit('session_1', 2)
+        self.submit('session_1', 3)
+        self.submit('session_2', 4)
+        order = [self.service.next_job().job_id for _ in range(4)]
+        self.assertEqual(order, [1, 4, 2, 3])
+
+    def test_cancel(self):
+        self.submit('session_1', 1)
+        self.submit('session_1', 2)
+        self.submit('session_2', 3)
+        self.service.cancel('session_1', 1)
+        self.assertEqual(self.service.queue_depth()['BULK'], 2)
+        # Disconnecting drops every queued job of the session
+        self.service.cancel('session_1')
+        self.assertEqual(self.service.next_job().job_id, 3)
+        self.assertIsNone(self.service.next_job())
+
+
+@patch.dict(compute.JOBS, {'add': add_job, 'fail': failing_job})
+class ComputeServiceTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        socket_path = os.path.join(self.temp_dir.name, 'compute.sock')
+        self.service = ComputeService(socket_path, max_workers=2)
+        await self.service.start()
+        self.client = ComputeClient(socket_path)
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.service.close()
+        self.temp_dir.cleanup()
+
+    async def test_run(self):
+        self.assertTrue(self.client.available)
+        self.assertEqual(await self.client.run('add', 1, 2, priority=JobPriority.INTERACTIVE), 3)
+        depth = await self.client.queue_depth()
+        self.assertEqual(depth['sessions'], 1)
+        self.assertEqual(depth['BULK'], 0)
+
+    async def test_failed_job(self):
+        with self.assertRaises(ComputeError):
+            await self.client.run('fail')
+        # The connection is still usable
+        self.assertEqual(await self.client.run('add', 2, 2), 4)
+
+    async def test_service_stopped(self):
+        await self.service.close()
+        self.assertFalse(ComputeClient(self.service.socket_path).available)
+        with self.assertRaises(ConnectionError):
+            await self.client.run('add', 1, 2)
+
+    async def test_session_metrics_removed_on_disconnect(self):
+        registry = MetricsRegistry(report=False)
+        with patch.object(compute, 'registry', registry):
+            await self.client.report_metrics([('cryoem_stage_seconds', 0.1, {'session': '1', 'stage': 'stats'})])
+            # Messages are handled in order, so the metrics are merged once this returns
+            await self.client.queue_depth()
+            self.assertEqual(len(registry.histograms), 1)
+            await self.client.close()
+            while self.service.sessions:
+                await asyncio.sleep(0.01)
+        self.assertEqual(registry.histograms, {})
+
+    async def test_private_socket(self):
+        self.assertEqual(os.stat(self.service.socket_path).st_mode & 0o777, 0o600)
+        # Other users could replace a socket in a shared directory
+        shared_dir = os.path.join(self.temp_dir.name, 'shared')
+        os.mkdir(shared_dir, 0o755)
+        os.chmod(shared_dir, 0o777)
+        with self.assertRaises(PermissionError):
+            await ComputeService(os.path.join(shared_dir, 'compute.sock')).start()
+
+    async def test_other_user_rejected(self):
+        with patch.object(compute, 'peer_uid', return_value=os.getuid() + 1):
+            with self.assertRaises(ConnectionError):
+                await self.client.run('add', 1, 2)
+        self.assertEqual(self.service.queue_depth()['sessions'], 0)
+
+    async def test_mesh_job(self):
+        map_file = os.path.join(fixtures_dir, 'emd_8216.map.gz')
+        vertices, normals, triangles = compute.mesh_job(map_file, hash_file(map_file), 0.5)
+        self.assertEqual(len(vertices), len(normals))
+        self.assertEqual(np.max(triangles), len(vertices) // 3 - 1)
@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from plugin.emdb_catalog import EMDBCatalog, EMDBEntry, parse_header
+
+
+fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+class EMDBCatalogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.metadata_file = os.path.join(fixtures_dir, 'metadata_8216.xml')
+        self.catalog = EMDBCatalog(':memory:')
+
+    def tearDown(self):
+        self.catalog.close()
+
+    def test_parse_header(self):
+        entry = parse_header(self.metadata_file)
+        self.assertEqual(entry.emdb_id, '8216')
+        self.assertEqual(entry.title, 'MicroED structure of tau VQIVYK peptide at 1.1 A resolution')
+        self.assertEqual(entry.resolution, 1.1)
+        self.assertEqual(entry.map_size_kb, 1661)
+        self.assertEqual(entry.symmetry, 'C 1 2 1')
+        self.assertEqual(entry.pdb_ids, ['5k7n'])
+
+    def test_add_header(self):
+        with open(self.metadata_file, 'rb') as f:
+            self.catalog.add_header(f.read())
+        self.assertEqual(len(self.catalog), 1)
+        self.assertEqual(self.catalog.get('8216'), parse_header(self.metadata_file))
+        self.assertIsNone(self.catalog.get('0001'))
+
+    def test_search(self):
+        self.catalog.add_entry(EMDBEntry('8216', 'tau VQIVYK peptide', 1.1, 1661, 'C 1 2 1', ['5k7n']))
+        self.catalog.add_entry(EMDBEntry('8720', 'Ribosome', 3.5, 400000, 'C1', ['5vos']))
+        self.catalog.add_entry(EMDBEntry('30288', 'Small molecule', None, 2000, None, []))
+        self.assertEqual([e.emdb_id for e in self.catalog.search()], ['8216', '8720', '30288'])
+        self.assertEqual([e.emdb_id for e in self.catalog.search('ribosome')], ['8720'])
+        self.assertEqual([e.emdb_id for e in self.catalog.search('EMD-82')], ['8216'])
+        self.assertEqual([e.emdb_id for e in self.catalog.search('5VOS')], ['8720'])
+        self.assertEqual([e.emdb_id for e in self.catalog.search(max_resolution=2)], ['8216'])
+        self.assertEqual([e.emdb_id for e in self.catalog.search(max_map_size_kb=350000)], ['8216', '30288'])
+
+    def test_index_directory(self):
+        header_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, header_dir)
+        entry_dir = os.path.join(header_dir, 'EMD-8216', 'header')
+        os.makedirs(entry_dir)
+        header_path = os.path.join(entry_dir, 'emd-8216.xml')
+        shutil.copy(self.metadata_file, header_path)
+        self.assertEqual(self.catalog.index_directory(header_dir), 1)
+        self.assertEqual(self.catalog.get('8216').pdb_ids, ['5k7n'])
+        # Unchanged headers are skipped on refresh
+        self.assertEqual(self.catalog.index_directory(header_dir), 0)
+        mtime = os.path.getmtime(header_path) + 10
+        os.utime(header_path, (mtime, mtime))
+        self.assertEqual(self.catalog.index_directory(header_dir), 1)
+        self.assertEqual(len(self.catalog), 1)
@@ -0,0 +1,106 @@
+import asyncio
+import os
+import requests
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+
+from plugin.ingest import EMDBIngestQueue, IngestItem
+from plugin.utils import EMDBMetadataParser
+
+fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+class EMDBIngestQueueTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.plugin = MagicMock()
+        self.plugin.groups = []
+
+        def add_mapgroup():
+            mapgroup = MagicMock()
+            mapgroup.has_map.return_value = False
+            self.plugin.groups.append(mapgroup)
+            return mapgroup
+        self.plugin.add_mapgroup.side_effect = add_mapgroup
+        self.plugin.menu.render = AsyncMock()
+        self.plugin.client.send_notification = AsyncMock()
+        self.map_gz_file = os.path.join(fixtures_dir, 'emd_8216.map.gz')
+        with open(os.path.join(fixtures_dir, 'metadata_8216.xml'), 'rb') as f:
+            self.parser = EMDBMetadataParser(f.read())
+
+        self.emdb_menu = MagicMock()
+        self.emdb_menu.download_metadata_from_emdbid.return_value = self.parser
+        self.active_downloads = 0
+        self.max_active_downloads = 0
+
+        async def download_mapgz(emdb_id, metadata_parser, progress_callback=None):
+            self.active_downloads += 1
+            self.max_active_downloads = max(self.max_active_downloads, self.active_downloads)
+            await asyncio.sleep(0.01)
+            progress_callback(0.5)
+            await asyncio.sleep(0.01)
+            progress_callback(1.0)
+            self.active_downloads -= 1
+            return self.map_gz_file
+        self.emdb_menu.download_mapgz_from_emdbid = download_mapgz
+
+        self.active_meshing = 0
+        self.max_active_meshing = 0
+
+        async def add_mapfile_to_group(*args, **kwargs):
+            self.active_meshing += 1
+            self.max_active_meshing = max(self.max_active_meshing, self.active_meshing)
+            await asyncio.sleep(0.01)
+            self.active_meshing -= 1
+        self.plugin.add_mapfile_to_group = MagicMock(side_effect=add_mapfile_to_group)
+
+    async def test_submit(self):
+        updates = []
+        queue = EMDBIngestQueue(
+            self.emdb_menu, self.plugin, on_update=lambda items: updates.append([i.status for i in items]),
+            max_downloads=2, max_meshing=1)
+        items = queue.submit(['8216', '8217', '8218'])
+        await queue.join()
+        # Each ID gets its own MapGroup
+        self.assertEqual(self.plugin.add_mapgroup.call_count, 3)
+        self.assertEqual(len({id(item.mapgroup) for item in items}), 3)
+        self.assertTrue(all(item.status == IngestItem.DONE for item in items))
+        for item in items:
+            self.plugin.add_mapfile_to_group.assert_any_call(
+                self.map_gz_file, self.parser.isovalue, self.parser, mapgroup=item.mapgroup)
+        # Concurrency limits are respected
+        self.assertEqual(self.max_active_downloads, 2)
+        self.assertEqual(self.max_active_meshing, 1)
+        self.assertTrue(updates)
+
+    async def test_item_failure(self):
+        def download_metadata(emdb_id):
+            if emdb_id == '0000':
+                raise requests.exceptions.HTTPError()
+            return self.parser
+        self.emdb_menu.download_metadata_from_emdbid.side_effect = download_metadata
+
+        updates = []
+        queue = EMDBIngestQueue(
+            self.emdb_menu, self.plugin, on_update=lambda items: updates.append([i.status for i in items]))
+        failed_item, ok_item = queue.submit(['0000', '8216'])
+        failed_mapgroup = failed_item.mapgroup
+        await queue.join()
+        await asyncio.sleep(0)
+        self.assertEqual(failed_item.status, IngestItem.FAILED)
+        self.assertEqual(failed_item.error, "EMDB ID not found")
+        self.assertIn('failed', failed_item.status_text)
+        self.assertEqual(ok_item.status, IngestItem.DONE)
+        self.assertEqual(updates[-1], [IngestItem.FAILED, IngestItem.DONE])
+        self.plugin.client.send_notification.assert_awaited_once()
+        # Empty MapGroup of the failed item is removed from the main menu
+        self.assertNotIn(failed_mapgroup, self.plugin.groups)
+        self.assertIn(ok_item.mapgroup, self.plugin.groups)
+        self.plugin.menu.render.assert_awaited()
+
+    async def test_clear_finished(self):
+        queue = EMDBIngestQueue(self.emdb_menu, self.plugin)
+        queue.submit(['8216'])
+        await queue.join()
+        queue.clear_finished()
+        self.assertEqual(queue.items, [])
@@ -0,0 +1,88 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from unittest.mock import patch
+
+from plugin.map_store import MapStore
+from plugin.mesh_io import hash_file
+from plugin.models import MapMesh
+
+
+fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+class MapStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.store = MapStore(self.temp_dir.name)
+        self.map_file = os.path.join(fixtures_dir, 'emd_8216.map.gz')
+        self.source_hash = hash_file(self.map_file)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_shared_map_matches_map_manager(self):
+        map_manager = MapMesh.load_mapfile(self.map_file)
+        shared_map = self.store.attach(self.map_file, self.source_hash)
+        self.assertEqual(shared_map.origin, tuple(map_manager.origin))
+        self.assertEqual(shared_map.data.last(), tuple(map_manager.map_data().last()))
+        np.testing.assert_allclose(
+            shared_map.map_data().as_numpy_array(), map_manager.map_data().as_numpy_array(), rtol=1e-6)
+        np.testing.assert_allclose(
+            shared_map.grid_units_to_cart((3, 5, 7)), map_manager.grid_units_to_cart((3, 5, 7)))
+        stats = MapMesh.compute_map_stats(map_manager)
+        self.assertAlmostEqual(shared_map.stats['default_isovalue'], stats['default_isovalue'], places=5)
+        # Read only
+        with self.assertRaises(ValueError):
+            shared_map.map_data().as_numpy_array()[0, 0, 0] = 1
+
+    def test_cctbx_map_manager_matches_map_file(self):
+        map_manager = MapMesh.load_mapfile(self.map_file)
+        shared_map = self.store.attach(self.map_file, self.source_hash)
+        copy = shared_map.cctbx_map_manager()
+        self.assertEqual(tuple(copy.origin), tuple(map_manager.origin))
+        self.assertEqual(copy.map_data().origin(), map_manager.map_data().origin())
+        np.testing.assert_allclose(
+            copy.map_data().as_numpy_array(), map_manager.map_data().as_numpy_array(), rtol=1e-6)
+        np.testing.assert_allclose(copy.grid_units_to_cart((3, 5, 7)), map_manager.grid_units_to_cart((3, 5, 7)))
+        self.assertTrue(copy.unit_cell_crystal_symmetry().is_similar_symmetry(
+            map_manager.unit_cell_crystal_symmetry()))
+        # Each call gets its own copy, the stored voxels stay shared
+        self.assertIsNot(shared_map.cctbx_map_manager().map_data(), copy.map_data())
+
+    def test_attach_reuses_stored_map(self):
+        shared_map = self.store.attach(self.map_file, self.source_hash)
+        self.assertIs(self.store.attach(self.map_file, self.source_hash), shared_map)
+        # Another session process opens the stored voxels without parsing the map
+        other_store = MapStore(self.temp_dir.name)
+        with patch.object(MapMesh, 'load_mapfile') as load_mock:
+            other_map = other_store.attach(self.map_file, self.source_hash)
+        load_mock.assert_not_called()
+        self.assertEqual(other_map.data.array.filename, shared_map.data.array.filename)
+
+    def test_evicted_after_last_release(self):
+        entry_dir = self.store.entry_dir(self.source_hash)
+        shared_map = self.store.attach(self.map_file, self.source_hash)
+        self.store.attach(self.map_file, self.source_hash)
+        self.store.release(shared_map)
+        self.assertTrue(os.path.exists(entry_dir))
+        self.store.release(shared_map)
+        self.assertFalse(os.path.exists(entry_dir))
+        # Voxels already mapped stay readable
+        self.assertIsNotNone(shared_map.map_data().as_numpy_array().max())
+
+    def test_exited_holders_evicted(self):
+        self.store.attach(self.map_file, self.source_hash)
+        entry_dir = self.store.entry_dir(self.source_hash)
+        with patch.object(MapStore, '_is_running', return_value=False):
+            self.store.evict_unused()
+        self.assertFalse(os.path.exists(entry_dir))
+
+    def test_failed_add_releases_reference(self):
+        with patch.object(MapMesh, 'load_mapfile', side_effect=OSError):
+            with self.assertRaises(OSError):
+                self.store.attach(self.map_file, self.source_hash)
+        self.assertFalse(os.path.exists(self.store.entry_dir(self.source_hash)))
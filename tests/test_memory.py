@@ -0,0 +1,60 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from plugin import memory
+from plugin.memory import InsufficientMemory, MemoryBudget, estimate_peak_memory
+from plugin.utils import MRCHeader
+
+fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+class MemoryBudgetTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.budget = MemoryBudget(20 * 10 ** 6, self.temp_dir.name, poll_interval=0.01)
+
+    def test_plan(self):
+        header = MRCHeader.read(os.path.join(fixtures_dir, 'emd_8216.map.gz'))
+        plan = self.budget.plan(header.dimensions)
+        self.assertEqual(plan.stride, 1)
+        self.assertEqual(plan.peak, max(estimate_peak_memory(header.dimensions).values()))
+
+        # Dense meshes are downsampled to fit
+        with patch.object(memory, 'MESH_VERTEX_FRACTION', 1.0):
+            plan = self.budget.plan(header.dimensions)
+        self.assertEqual(plan.stride, 2)
+        self.assertLessEqual(plan.peak, self.budget.capacity)
+
+        # Downsampling the mesh doesn't help if the map doesn't fit
+        with self.assertRaises(InsufficientMemory):
+            self.budget.plan((512, 512, 512))
+
+    async def test_reserve_waits_for_release(self):
+        order = []
+
+        async def load(name, nbytes, seconds):
+            async with self.budget.reserve(nbytes):
+                order.append(name)
+                await asyncio.sleep(seconds)
+
+        first = asyncio.create_task(load('first', 15 * 10 ** 6, 0.05))
+        await asyncio.sleep(0)
+        self.assertEqual(self.budget.reserved(), 15 * 10 ** 6)
+        await asyncio.gather(load('second', 10 * 10 ** 6, 0), first)
+        self.assertEqual(order, ['first', 'second'])
+        self.assertEqual(self.budget.reserved(), 0)
+
+        with self.assertRaises(InsufficientMemory):
+            async with self.budget.reserve(30 * 10 ** 6):
+                pass
+
+    def test_ignores_exited_processes(self):
+        with open(os.path.join(self.temp_dir.name, '999999999-0'), 'w') as f:
+            f.write(str(15 * 10 ** 6))
+        self.assertEqual(self.budget.reserved(), 0)
+        self.assertEqual(os.listdir(self.temp_dir.name), ['.lock'])
@@ -6,10 +6,11 @@ import tempfile
 import unittest
 
 from nanome.api import structure, ui
-from unittest.mock import MagicMock
+from unittest.mock import AsyncMock, MagicMock, call, patch
 
 import plugin
 from plugin import models, menu
+from plugin.emdb_catalog import EMDBCatalog, EMDBEntry
 from plugin.utils import EMDBMetadataParser
 import threading
 
@@ -24,6 +25,7 @@ class EditMeshMenuTestCase(unittest.IsolatedAsyncioTestCase):
         self.plugin.temp_dir = tempfile.TemporaryDirectory()
         self.plugin.client = MagicMock()
         self.plugin.ui_manager = UIManager()
+        self.plugin.checkpoint_session = AsyncMock()
         self.pdb_file = os.path.join(fixtures_dir, '7c4u.pdb')
         self.mapgz_file = os.path.join(fixtures_dir, 'emd_8216.map.gz')
         self.map_group = models.MapGroup(self.plugin)
@@ -42,6 +44,9 @@ class EditMeshMenuTestCase(unittest.IsolatedAsyncioTestCase):
         # We sometimes need to wait for generate_histogram thread to finish
         # before we can cleanup the temporary directory
         for thread in threading.enumerate():
+            # Idle executor threads, e.g. from meshing, only exit when the event loop closes.
+            if thread.name.startswith('ThreadPoolExecutor'):
+                continue
             try:
                 thread.join()
             except RuntimeError:
@@ -86,13 +91,128 @@ class EditMeshMenuTestCase(unittest.IsolatedAsyncioTestCase):
         self.assertTrue(math.isclose(sld_max_value, self.map_group.hist_x_max, rel_tol=rel_tol))
         self.assertTrue(isinstance(self.menu.ln_img_histogram.get_content(), ui.Image))
 
+    async def test_isovalue_preview(self):
+        await self.render_with_mesh()
+        isovalue = self.map_group.isovalue
+        full_mesh = self.map_group.map_mesh.mesh
+
+        sld = self.menu.sld_isovalue
+        sld.current_value = (sld.current_value + sld.max_value) / 2
+        self.menu.on_isovalue_changed(sld)
+        await self.wait_for_preview(full_mesh)
+        # The preview replaces the mesh, without changing the group's isovalue or saved mesh
+        self.assertGreater(len(self.map_group.map_mesh.computed_vertices), 0)
+        self.assertEqual(self.map_group.isovalue, isovalue)
+        self.assertIs(self.map_group.mesh, full_mesh)
+
+        # Releasing the slider redraws at full quality
+        await self.menu.on_isovalue_released(sld)
+        self.assertTrue(math.isclose(self.map_group.isovalue, self.menu.get_isovalue_from_slider()))
+        self.assertIs(self.map_group.mesh, self.map_group.map_mesh.mesh)
+        self.plugin.checkpoint_session.assert_awaited()
+
+    async def test_isovalue_preview_ended_by_bind(self):
+        await self.render_with_mesh()
+        full_mesh = self.map_group.map_mesh.mesh
+        sld = self.menu.sld_isovalue
+        sld.current_value = (sld.current_value + sld.max_value) / 2
+        self.menu.on_isovalue_changed(sld)
+        await self.wait_for_preview(full_mesh)
+
+        # Switching groups drops the preview, and shows the full mesh again
+        self.menu.bind(models.MapGroup(self.plugin))
+        self.assertIs(self.map_group.map_mesh.mesh, full_mesh)
+
+    async def test_isovalue_preview_without_release(self):
+        await self.render_with_mesh()
+        sld = self.menu.sld_isovalue
+        sld.current_value = (sld.current_value + sld.max_value) / 2
+        with patch.object(menu, 'PREVIEW_RELEASE_TIMEOUT', 0.3):
+            self.menu.on_isovalue_changed(sld)
+            await self.menu._preview_task
+        # The slider's release event never came, so the full map was redrawn once it rested
+        self.assertTrue(math.isclose(self.map_group.isovalue, self.menu.get_isovalue_from_slider()))
+        self.assertIs(self.map_group.mesh, self.map_group.map_mesh.mesh)
+
+    async def render_with_mesh(self):
+        # Uploads keep the mesh objects, so the preview and full meshes can be told apart.
+        self.plugin.client.shapes_upload_multiple = AsyncMock(side_effect=lambda meshes: meshes)
+        await self.map_group.add_mapfile(self.mapgz_file)
+        await self.map_group.generate_full_mesh()
+        self.menu.render(self.map_group)
+
+    async def wait_for_preview(self, full_mesh):
+        while self.map_group.map_mesh.mesh is full_mesh:
+            await asyncio.sleep(0.01)
+
+
+class MainMenuTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.plugin = MagicMock()
+        self.plugin.ui_manager = UIManager()
+        self.plugin.groups = [models.MapGroup(self.plugin, group_name=f'MapGroup {i}') for i in range(3)]
+        self.menu = menu.MainMenu(self.plugin)
+
+    async def test_render_reuses_rows(self):
+        await self.menu.render(force_enable=True)
+        items = list(self.menu.lst_groups.items)
+        self.assertEqual(len(items), 3)
+        self.assertEqual(self.menu.get_selected_mapgroup(), 'MapGroup 0')
+        self.plugin.ui_updates.reset_mock()
+
+        # Only the changed label is sent
+        self.plugin.groups[1].group_name = 'emd_8216'
+        await self.menu.render(selected_mapgroup=self.plugin.groups[0])
+        self.assertEqual([id(item) for item in self.menu.lst_groups.items], [id(item) for item in items])
+        [changed_label] = self.plugin.ui_updates.update_content.call_args[0]
+        self.assertEqual(changed_label.text_value, 'emd_8216')
+
+        # Nothing is sent when nothing changed
+        self.plugin.ui_updates.reset_mock()
+        await self.menu.render(selected_mapgroup=self.plugin.groups[0])
+        self.plugin.ui_updates.update_content.assert_not_called()
+
+    async def test_render_removed_and_added_groups(self):
+        await self.menu.render()
+        items = list(self.menu.lst_groups.items)
+        del self.plugin.groups[0]
+        self.plugin.groups.append(models.MapGroup(self.plugin, group_name='MapGroup 4'))
+        self.plugin.ui_updates.reset_mock()
+        await self.menu.render(selected_mapgroup=self.plugin.groups[1])
+        self.assertEqual(len(self.menu.lst_groups.items), 3)
+        self.assertIs(self.menu.lst_groups.items[0], items[1])
+        self.plugin.ui_updates.update_content.assert_called_once_with(self.menu.lst_groups)
+        self.assertEqual(self.menu.get_selected_mapgroup(), 'MapGroup 2')
+
+    def test_edit_mesh_menu_reused(self):
+        edit_mesh_menu = self.menu.edit_mesh_menu
+        menu_count = len(self.plugin.ui_manager._menus)
+        for map_group in self.plugin.groups[:2]:
+            self.plugin.client.reset_mock()
+            edit_mesh_menu.render(map_group)
+            self.assertIs(edit_mesh_menu.map_group, map_group)
+            self.assertTrue(edit_mesh_menu._menu.title.startswith(map_group.group_name))
+            self.assertEqual(self.plugin.client.method_calls, [call.update_menu(edit_mesh_menu._menu)])
+        self.assertEqual(len(self.plugin.ui_manager._menus), menu_count)
+        self.assertIs(edit_mesh_menu.ln_img_histogram.get_content(), edit_mesh_menu.lbl_histogram)
+
+    def test_select_mapgroup(self):
+        self.menu.render_map_groups(self.plugin.groups, self.plugin.groups[0])
+        row = self.menu._group_rows[id(self.plugin.groups[2])]
+        row.btn_select.selected = True
+        self.menu.select_mapgroup(row.btn_select)
+        self.assertEqual(self.menu.get_selected_mapgroup(), 'MapGroup 2')
+
 
 class LoadFromEmdbMenuTestCase(unittest.IsolatedAsyncioTestCase):
 
     def setUp(self):
         self.plugin = plugin.CryoEM()
         self.plugin.client = MagicMock()
+        self.plugin.client.send_notification = AsyncMock()
         self.menu = menu.LoadFromEmdbMenu(self.plugin)
+        self.menu.catalog = EMDBCatalog(':memory:')
         self.menu._menu.enabled = False
 
     def test_render(self):
@@ -107,6 +227,40 @@ class LoadFromEmdbMenuTestCase(unittest.IsolatedAsyncioTestCase):
         self.menu.on_browse_emdb(btn)
         open_url_mock.assert_called_once()
 
+    def test_on_browse_emdb_with_catalog(self):
+        self.menu.catalog.add_entry(EMDBEntry('8216', 'tau VQIVYK peptide', 1.1, 1661, 'C 1 2 1', ['5k7n']))
+        self.menu.on_browse_emdb(MagicMock())
+        self.plugin.client.open_url.assert_not_called()
+        self.assertTrue(self.menu.ln_catalog_search.enabled)
+
+    def test_on_catalog_search(self):
+        self.menu.catalog.add_entry(EMDBEntry('8216', 'tau VQIVYK peptide', 1.1, 1661, 'C 1 2 1', ['5k7n']))
+        self.menu.catalog.add_entry(EMDBEntry('8720', 'Too large', 3.5, (menu.MAX_MAP_SIZE_MB + 1) * 1000, 'C1', []))
+        self.menu.ti_catalog_query.input_text = ''
+        self.menu.on_catalog_search(MagicMock())
+        self.assertEqual(len(self.menu.lst_catalog_results.items), 1)
+        btn = self.menu.lst_catalog_results.items[0].get_content()
+        self.assertTrue(btn.text.value.idle.startswith('EMD-8216'))
+        entry = self.menu.catalog.get('8216')
+        self.menu.select_catalog_entry(entry, btn)
+        self.assertEqual(self.menu.ti_embl_query.input_text, '8216')
+
+    def test_on_catalog_search_without_catalog(self):
+        self.menu.catalog = None
+        self.menu.send_error = MagicMock()
+        self.menu.on_catalog_search(MagicMock())
+        self.menu.send_error.assert_called_once_with("EMDB catalog unavailable")
+        self.assertEqual(len(self.menu.lst_catalog_results.items), 0)
+
+    async def test_on_emdb_submit_catalog_prevalidation(self):
+        self.menu.catalog.add_entry(EMDBEntry('8720', 'Too large', 3.5, (menu.MAX_MAP_SIZE_MB + 1) * 1000, 'C1', []))
+        self.menu.ti_embl_query.input_text = '8720'
+        self.menu.download_metadata_from_emdbid = MagicMock()
+        self.menu.send_error = MagicMock()
+        await self.menu.on_emdb_submit(MagicMock())
+        self.menu.download_metadata_from_emdbid.assert_not_called()
+        self.menu.send_error.assert_called_once()
+
     async def test_on_emdb_submit(self):
         self.menu.ti_embl_query.input_text = '8216'
 
@@ -124,9 +278,141 @@ class LoadFromEmdbMenuTestCase(unittest.IsolatedAsyncioTestCase):
         mapgz_download_mock = MagicMock(return_value=fut)
         self.menu.download_mapgz_from_emdbid = mapgz_download_mock
 
+        self.menu.download_pdb_from_rcsb = MagicMock(return_value=None)
+
         btn = MagicMock()
         await self.menu.on_emdb_submit(btn)
 
         # Make sure mocks were called.
         metadata_mock.assert_called_once()
         mapgz_download_mock.assert_called_once()
+
+    async def test_on_emdb_submit_prefetches_fitted_model(self):
+        self.menu.btn_prefetch_model.selected = True
+        self.menu.ti_embl_query.input_text = '8216'
+        metadata_file = os.path.join(fixtures_dir, 'metadata_8216.xml')
+        map_gz_file = os.path.join(fixtures_dir, 'emd_8216.map.gz')
+        pdb_file = os.path.join(fixtures_dir, '7c4u.pdb')
+        with open(metadata_file, 'rb') as f:
+            parser = EMDBMetadataParser(f.read())
+        self.menu.download_metadata_from_emdbid = MagicMock(return_value=parser)
+
+        # Map download should not block the model download
+        pdb_download_mock = MagicMock(return_value=pdb_file)
+        self.menu.fetch_pdb_from_rcsb = pdb_download_mock
+
+        async def download_mapgz(*args):
+            await asyncio.sleep(0.1)
+            pdb_download_mock.assert_called_once_with('5k7n')
+            return map_gz_file
+        self.menu.download_mapgz_from_emdbid = download_mapgz
+
+        async def add_mapfile_to_group(*args, fitted_model=None):
+            return await fitted_model
+        self.plugin.add_mapfile_to_group = MagicMock(side_effect=add_mapfile_to_group)
+
+        btn = MagicMock()
+        await self.menu.on_emdb_submit(btn)
+        self.plugin.add_mapfile_to_group.assert_called_once()
+        fitted_model = self.plugin.add_mapfile_to_group.call_args.kwargs['fitted_model']
+        model_path, model_comp, model = fitted_model.result()
+        self.assertEqual(model_path, pdb_file)
+        self.assertTrue(isinstance(model_comp, structure.Complex))
+        self.assertTrue(model is not None)
+        # Model was already loaded, so RCSB input is not prefilled.
+        self.assertEqual(self.menu.ti_rcsb_query.input_text, '')
+        self.assertFalse(btn.unusable)
+        self.assertFalse(self.menu.btn_rcsb_submit.unusable)
+
+    async def test_on_emdb_submit_prefetch_skipped_for_group_with_model(self):
+        self.menu.btn_prefetch_model.selected = True
+        await self.plugin.menu.render()
+        mapgroup = self.plugin.get_group(self.plugin.menu.get_selected_mapgroup())
+        mapgroup.add_model_complex(structure.Complex())
+        metadata_file = os.path.join(fixtures_dir, 'metadata_8216.xml')
+        with open(metadata_file, 'rb') as f:
+            parser = EMDBMetadataParser(f.read())
+        self.menu.download_metadata_from_emdbid = MagicMock(return_value=parser)
+        fut = asyncio.Future()
+        fut.set_result(os.path.join(fixtures_dir, 'emd_8216.map.gz'))
+        self.menu.download_mapgz_from_emdbid = MagicMock(return_value=fut)
+        add_mapfile_fut = asyncio.Future()
+        add_mapfile_fut.set_result(MagicMock())
+        self.plugin.add_mapfile_to_group = MagicMock(return_value=add_mapfile_fut)
+        self.menu.fetch_pdb_from_rcsb = MagicMock()
+
+        await self.menu.on_emdb_submit(MagicMock())
+        self.menu.fetch_pdb_from_rcsb.assert_not_called()
+        self.assertIsNone(self.plugin.add_mapfile_to_group.call_args.kwargs['fitted_model'])
+
+    async def test_on_emdb_submit_cancels_prefetch_on_error(self):
+        self.menu.btn_prefetch_model.selected = True
+        metadata_file = os.path.join(fixtures_dir, 'metadata_8216.xml')
+        with open(metadata_file, 'rb') as f:
+            parser = EMDBMetadataParser(f.read())
+        self.menu.download_metadata_from_emdbid = MagicMock(return_value=parser)
+        prefetch_started = asyncio.Event()
+        prefetch_cancelled = asyncio.Event()
+
+        async def prefetch_fitted_model(pdb_id):
+            prefetch_started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                prefetch_cancelled.set()
+                raise
+        self.menu.prefetch_fitted_model = prefetch_fitted_model
+
+        async def download_mapgz(*args):
+            await prefetch_started.wait()
+            raise ConnectionError()
+        self.menu.download_mapgz_from_emdbid = download_mapgz
+
+        btn = MagicMock()
+        with self.assertRaises(ConnectionError):
+            await self.menu.on_emdb_submit(btn)
+        self.assertFalse(btn.unusable)
+        self.assertFalse(self.menu.btn_rcsb_submit.unusable)
+        await asyncio.wait_for(prefetch_cancelled.wait(), 1)
+
+    async def test_on_emdb_submit_batch(self):
+        self.menu.ti_embl_query.input_text = '8216-8218'
+        self.menu.ingest_queue.submit = MagicMock()
+        self.menu.download_metadata_from_emdbid = MagicMock()
+        btn = MagicMock()
+        await self.menu.on_emdb_submit(btn)
+        self.menu.ingest_queue.submit.assert_called_once_with(['8216', '8217', '8218'])
+        # Button is usable again while the batch loads
+        self.assertFalse(btn.unusable)
+        self.menu.download_metadata_from_emdbid.assert_not_called()
+
+    def test_render_ingest_queue(self):
+        from plugin.ingest import IngestItem
+        self.assertFalse(self.menu.ln_ingest_queue.enabled)
+        items = [IngestItem('8216'), IngestItem('8217')]
+        items[0].status = IngestItem.DOWNLOADING
+        items[0].progress = 0.5
+        self.menu.render_ingest_queue(items)
+        self.assertTrue(self.menu.ln_ingest_queue.enabled)
+        self.assertEqual(len(self.menu.lst_ingest_queue.items), 2)
+        lbl = self.menu.lst_ingest_queue.items[0].get_content()
+        self.assertEqual(lbl.text_value, 'EMD-8216: downloading (50%)')
+
+    async def test_on_emdb_submit_prefetch_disabled(self):
+        # Prefetch is off by default
+        self.assertFalse(self.menu.prefetch_model)
+        metadata_file = os.path.join(fixtures_dir, 'metadata_8216.xml')
+        with open(metadata_file, 'rb') as f:
+            parser = EMDBMetadataParser(f.read())
+        self.menu.download_metadata_from_emdbid = MagicMock(return_value=parser)
+        fut = asyncio.Future()
+        fut.set_result(os.path.join(fixtures_dir, 'emd_8216.map.gz'))
+        self.menu.download_mapgz_from_emdbid = MagicMock(return_value=fut)
+        add_mapfile_fut = asyncio.Future()
+        add_mapfile_fut.set_result(MagicMock())
+        self.plugin.add_mapfile_to_group = MagicMock(return_value=add_mapfile_fut)
+        self.menu.download_pdb_from_rcsb = MagicMock()
+
+        await self.menu.on_emdb_submit(MagicMock())
+        self.menu.download_pdb_from_rcsb.assert_not_called()
+        self.assertIsNone(self.plugin.add_mapfile_to_group.call_args.kwargs['fitted_model'])
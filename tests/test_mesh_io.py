@@ -0,0 +1,125 @@
+import json
+import mmap
+import os
+import struct
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+from nanome.api import shapes
+
+from plugin import mesh_io
+from plugin.mesh_io import MeshArtifact, hash_file
+from plugin.models import MapMesh
+
+
+fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+class MeshArtifactTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.mesh = shapes.Mesh()
+        self.mesh.vertices = np.array([0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.5, 0.0])
+        # One normal per triangle, like the simplified map meshes
+        self.mesh.normals = np.array([0.0, 0.0, 1.0])
+        self.mesh.triangles = np.array([0, 1, 2])
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.mesh_file = os.path.join(self.temp_dir.name, 'emd_8216.map.gz.mesh')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def assert_same_geometry(self, mesh):
+        np.testing.assert_array_equal(mesh.vertices, self.mesh.vertices)
+        np.testing.assert_array_equal(mesh.normals, self.mesh.normals)
+        np.testing.assert_array_equal(mesh.triangles, self.mesh.triangles)
+
+    def test_round_trip(self):
+        artifact = MeshArtifact.from_mesh(self.mesh, isovalue=0.5, source_sha256='abc')
+        loaded = MeshArtifact.from_bytes(artifact.to_bytes())
+        self.assertEqual(loaded.isovalue, 0.5)
+        self.assertEqual(loaded.source_hash, 'abc')
+        self.assertIsNone(loaded.colors)
+        self.assert_same_geometry(loaded.to_mesh())
+
+    def test_colors(self):
+        self.mesh.colors = np.array([1.0, 0.5, 0.0, 1.0] * 3)
+        loaded = MeshArtifact.from_bytes(MeshArtifact.from_mesh(self.mesh).to_bytes())
+        np.testing.assert_array_equal(loaded.to_mesh().colors, self.mesh.colors)
+
+    def test_arrays_aligned(self):
+        data = MeshArtifact.from_mesh(self.mesh, isovalue=0.5).to_bytes()
+        metadata_length = struct.unpack_from('<I', data, 6)[0]
+        metadata = json.loads(data[10:10 + metadata_length])
+        self.assertEqual(metadata['format_version'], 2)
+        self.assertEqual((10 + metadata_length) % mesh_io.ALIGNMENT, 0)
+        for entry in metadata['arrays'].values():
+            self.assertEqual(entry['offset'] % mesh_io.ALIGNMENT, 0)
+
+    def test_load_memory_maps_file(self):
+        MeshArtifact.from_mesh(self.mesh, isovalue=0.5).save(self.mesh_file)
+        loaded = MeshArtifact.load(self.mesh_file)
+        # Arrays are views of the memory map, not copies
+        base = loaded.vertices
+        while isinstance(base, np.ndarray):
+            base = base.base
+        self.assertIsInstance(base.obj, mmap.mmap)
+        self.assertEqual(loaded.isovalue, 0.5)
+        self.assert_same_geometry(loaded.to_mesh())
+
+    def test_read_version_1(self):
+        metadata = json.dumps({'isovalue': 0.5, 'vertex_count': 3, 'normal_count': 1, 'triangle_count': 1}).encode()
+        data = b''.join([
+            struct.pack('<6sI', b'NMMESH', len(metadata)), metadata,
+            self.mesh.vertices.astype(np.float32).tobytes(),
+            self.mesh.normals.astype(np.float32).tobytes(),
+            self.mesh.triangles.astype(np.uint32).tobytes(),
+        ])
+        loaded = MeshArtifact.from_bytes(data)
+        self.assertEqual(loaded.metadata, {'isovalue': 0.5})
+        self.assert_same_geometry(loaded.to_mesh())
+        with self.assertRaises(ValueError):
+            MeshArtifact.from_bytes(data[:-4])
+
+    def test_newer_version_rejected(self):
+        with patch('plugin.mesh_io.FORMAT_VERSION', 3):
+            data = MeshArtifact.from_mesh(self.mesh).to_bytes()
+        with self.assertRaises(ValueError):
+            MeshArtifact.from_bytes(data)
+
+    def test_invalid_data(self):
+        data = MeshArtifact.from_mesh(self.mesh).to_bytes()
+        with self.assertRaises(ValueError):
+            MeshArtifact.from_bytes(b'not a mesh' + data)
+        with self.assertRaises(ValueError):
+            MeshArtifact.from_bytes(data[:-4])
+
+    @unittest.skipIf(mesh_io.zstandard is None, "zstandard is not installed")
+    def test_compressed_triangles(self):
+        self.mesh.triangles = np.zeros(3000, dtype=np.uint32)
+        artifact = MeshArtifact.from_mesh(self.mesh)
+        data = artifact.to_bytes(compress=True)
+        self.assertLess(len(data), len(artifact.to_bytes()))
+        np.testing.assert_array_equal(MeshArtifact.from_bytes(data).triangles, self.mesh.triangles)
+
+    @patch('plugin.mesh_io.zstandard', None)
+    def test_compress_requires_zstandard(self):
+        with self.assertRaises(ValueError):
+            MeshArtifact.from_mesh(self.mesh).to_bytes(compress=True)
+
+    def test_map_mesh_write_and_read(self):
+        map_mesh = MapMesh(MagicMock())
+        map_mesh.mesh = self.mesh
+        map_mesh.write_mesh(self.mesh_file, isovalue=0.5)
+        mesh, metadata = MapMesh.read_mesh(self.mesh_file)
+        self.assertEqual(metadata, {'isovalue': 0.5})
+        self.assert_same_geometry(mesh)
+
+    def test_hash_file(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'map data')
+            f.flush()
+            self.assertEqual(
+                hash_file(f.name), 'd1bc36e6467a1ac4509f837400cf9e17ff0dc274787b7dfcfc0258e316610751')
@@ -0,0 +1,81 @@
+import aiohttp
+import socket
+import unittest
+from unittest.mock import patch
+
+from plugin import metrics
+from plugin.metrics import MetricsRegistry, MetricsServer, span
+
+
+class MetricsRegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry(report=True)
+        self.registry.labels['session'] = '1'
+
+    def test_render(self):
+        self.registry.observe('cryoem_stage_seconds', 0.02, stage='stats')
+        self.registry.observe('cryoem_stage_seconds', 3, stage='stats')
+        text = self.registry.render()
+        self.assertIn('# TYPE cryoem_stage_seconds histogram', text)
+        self.assertIn('cryoem_stage_seconds_bucket{session="1",stage="stats",le="0.01"} 0', text)
+        self.assertIn('cryoem_stage_seconds_bucket{session="1",stage="stats",le="0.025"} 1', text)
+        self.assertIn('cryoem_stage_seconds_bucket{session="1",stage="stats",le="+Inf"} 2', text)
+        self.assertIn('cryoem_stage_seconds_count{session="1",stage="stats"} 2', text)
+
+    def test_merge_unreported(self):
+        self.registry.observe('cryoem_stage_vertices', 14303, stage='simplify')
+        observations = self.registry.take_unreported()
+        self.assertEqual(len(observations), 1)
+        self.assertEqual(self.registry.take_unreported(), [])
+
+        server_registry = MetricsRegistry(report=False)
+        server_registry.merge(observations)
+        server_registry.merge(observations)
+        [histogram] = server_registry.histograms.values()
+        self.assertEqual(histogram.count, 2)
+        self.assertIsNone(server_registry.unreported)
+
+    def test_remove_series(self):
+        self.registry.observe('cryoem_stage_seconds', 0.02, stage='stats')
+        self.registry.observe('cryoem_stage_seconds', 0.02, stage='stats', session='2')
+        self.registry.remove_series(session='1')
+        [(_, labels)] = self.registry.histograms
+        self.assertIn(('session', '2'), labels)
+
+    def test_span(self):
+        with patch.object(metrics, 'registry', self.registry):
+            with span('marching_cubes', voxels=120 ** 3) as cubes_span:
+                cubes_span.counts['vertices'] = 50000
+            with self.assertRaises(ValueError):
+                with span('parse'):
+                    raise ValueError()
+        names = {(name, dict(labels)['stage'], dict(labels)['map_size']) for name, labels in self.registry.histograms}
+        self.assertEqual(names, {
+            ('cryoem_stage_seconds', 'marching_cubes', '1e6'),
+            ('cryoem_stage_voxels', 'marching_cubes', '1e6'),
+            ('cryoem_stage_vertices', 'marching_cubes', '1e6'),
+        })
+        self.assertGreater(cubes_span.seconds, 0)
+
+
+class MetricsServerTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def test_metrics_endpoint(self):
+        registry = MetricsRegistry(report=False)
+        registry.observe('cryoem_stage_seconds', 0.5, stage='upload')
+        registry.add_gauge('cryoem_compute_jobs', "Compute jobs.", lambda: [({'state': 'running'}, 2)])
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        server = MetricsServer(registry, '127.0.0.1', port)
+        await server.start()
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f'http://127.0.0.1:{port}/metrics') as response:
+                    self.assertEqual(response.status, 200)
+                    text = await response.text()
+        finally:
+            await server.close()
+        self.assertIn('cryoem_stage_seconds_count{stage="upload"} 1', text)
+        self.assertIn('cryoem_compute_jobs{state="running"} 2', text)
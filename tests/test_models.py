@@ -2,16 +2,19 @@ import asyncio
 import gzip
 import os
 import tempfile
+import threading
 import unittest
 
 from nanome.api import structure
-from unittest.mock import MagicMock
+from unittest.mock import AsyncMock, MagicMock, patch
 from iotbx.data_manager import DataManager
 from iotbx.map_manager import map_manager
 from iotbx.map_model_manager import map_model_manager
 
 from mmtbx.model.model import manager
-from plugin.models import MapGroup, MapMesh
+from plugin.map_store import MapStore
+from plugin.mesh_io import hash_file
+from plugin.models import MapGroup, MapMesh, MeshJob, MeshJobCancelled
 
 fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
 
@@ -56,6 +59,91 @@ class MapGroupTestCase(unittest.IsolatedAsyncioTestCase):
         await self.map_group.generate_full_mesh()
         self.assertEqual(len(self.map_group.map_mesh.computed_vertices), expected_vertices)
 
+    async def test_new_mesh_job_supersedes_in_flight_one(self):
+        fut = asyncio.Future()
+        fut.set_result([structure.Complex()])
+        self.plugin.client.add_to_workspace.return_value = fut
+        await self.map_group.add_mapfile(self.mapgz_file)
+
+        self.map_group.isovalue = 0.2
+        first_redraw = asyncio.create_task(self.map_group.generate_full_mesh())
+        # Let the first job start meshing
+        await asyncio.sleep(0)
+        self.map_group.isovalue = 0.5
+        stats = await self.map_group.generate_full_mesh()
+        self.assertIsNotNone(stats)
+        self.assertIsNone(await first_redraw)
+        expected_mesh = MapMesh.generate_mesh_from_map_manager(self.map_group.map_mesh.map_manager, 0.5)
+        self.assertEqual(len(self.map_group.map_mesh.computed_vertices), len(expected_mesh.vertices) // 3)
+
+    def test_cancelled_job_stops_meshing(self):
+        job = MeshJob()
+        job.cancel()
+        map_manager = MapMesh.load_mapfile(self.mapgz_file)
+        with self.assertRaises(MeshJobCancelled):
+            MapMesh.generate_mesh_from_map_manager(map_manager, 0.5, job.check)
+
+    async def test_preview_meshes_model_map(self):
+        await self.map_group.add_mapfile(self.mapgz_file)
+        self.map_group.add_pdb(self.pdb_file)
+        model_map = MagicMock()
+        with patch.object(MapGroup, 'generate_model_map', return_value=model_map) as generate_model_map, \
+                patch('plugin.models.MeshPreview') as preview_mock:
+            await self.map_group.generate_preview_mesh(0.5)
+            await self.map_group.generate_preview_mesh(0.6)
+        # Like the full mesh, the preview is of the map generated with the model, created once
+        generate_model_map.assert_called_once()
+        preview_mock.assert_called_once_with(model_map)
+
+    async def test_model_map_keeps_shared_map(self):
+        fut = asyncio.Future()
+        fut.set_result([structure.Complex()])
+        self.plugin.client.add_to_workspace.return_value = fut
+        with tempfile.TemporaryDirectory() as store_dir:
+            shared_map = MapStore(store_dir).attach(self.mapgz_file, hash_file(self.mapgz_file))
+            await self.map_group.add_mapfile(self.mapgz_file, shared_map)
+            self.map_group.add_pdb(self.pdb_file)
+            await self.map_group.generate_full_mesh()
+        self.assertGreater(len(self.map_group.map_mesh.computed_vertices), 0)
+        # The map model manager used a copy of the map, held in the memory budget
+        self.assertIs(self.map_group.map_mesh.map_manager, shared_map)
+        self.plugin.memory_budget.reserve.assert_called_once_with(shared_map.data.size() * 24)
+
+    async def test_preview_keeps_full_mesh(self):
+        fut = asyncio.Future()
+        fut.set_result([structure.Complex()])
+        self.plugin.client.add_to_workspace.return_value = fut
+        self.plugin.client.shapes_upload_multiple = AsyncMock(side_effect=lambda meshes: meshes)
+        await self.map_group.add_mapfile(self.mapgz_file)
+        # A preview doesn't supersede a mesh job in progress, e.g. the map's load
+        load = asyncio.create_task(self.map_group.generate_full_mesh())
+        await asyncio.sleep(0)
+        await self.map_group.generate_preview_mesh(0.5)
+        self.assertIsNotNone(await load)
+        full_mesh = self.map_group.map_mesh.mesh
+
+        await self.map_group.generate_preview_mesh(0.5)
+        self.assertIsNot(self.map_group.map_mesh.mesh, full_mesh)
+        self.assertIs(self.map_group.mesh, full_mesh)
+        self.map_group.end_preview()
+        self.assertIs(self.map_group.map_mesh.mesh, full_mesh)
+
+    async def test_box_map_off_event_loop(self):
+        await self.map_group.add_mapfile(self.mapgz_file)
+        self.map_group.add_pdb(self.pdb_file)
+        threads = []
+
+        def record_thread(*args):
+            threads.append(threading.current_thread())
+            return MagicMock()
+        with patch.object(MapGroup, 'generate_model_map', side_effect=record_thread), \
+                patch.object(MapGroup, 'create_map_model_manager', side_effect=record_thread):
+            await self.map_group.generate_mesh_around_selection()
+            await self.map_group.generate_mesh_around_model()
+        # The map model manager's map is generated in a worker thread
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.main_thread(), threads)
+
     async def test_generate_histogram(self):
         # Assert that attributes are set after load_map called.
         fut = asyncio.Future()
@@ -89,6 +177,23 @@ class MapMeshTestCase(unittest.IsolatedAsyncioTestCase):
         fut.set_result([structure.Complex()])
         self.plugin.client.add_to_workspace.return_value = fut
 
+    async def test_concurrent_upload_creates_one_mesh(self):
+        """Regression test for duplicate meshes when uploads overlap before the mesh index is set."""
+        new_mesh_uploads = []
+
+        async def shapes_upload_multiple(meshes):
+            if meshes[0].index == -1:
+                new_mesh_uploads.append(meshes)
+            await asyncio.sleep(0.01)
+            for i, mesh in enumerate(meshes):
+                if mesh.index == -1:
+                    mesh._index = len(new_mesh_uploads) * 10 + i
+            return meshes
+        self.plugin.client.shapes_upload_multiple = shapes_upload_multiple
+        await asyncio.gather(self.map_mesh.upload(), self.map_mesh.upload())
+        self.assertEqual(len(new_mesh_uploads), 1)
+        self.assertNotEqual(self.map_mesh.mesh.index, -1)
+
     def test_add_mapfile_mapgz(self):
         """Test that add_mapfile works with .map.gz files."""
         # Set future result for request_complexes mock
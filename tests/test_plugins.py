@@ -4,11 +4,21 @@ import os
 import tempfile
 import unittest
 
+import numpy as np
 from nanome.api import structure
-from unittest.mock import MagicMock
+from nanome.util import enums
+from unittest.mock import AsyncMock, MagicMock, patch
 
 from plugin.CryoEM import CryoEM
-from plugin.models import MapGroup
+from plugin.compute import ComputeClient
+from plugin import premesh
+from plugin.map_cache import MapCache
+from plugin.ingest import EMDBIngestQueue, IngestItem
+from plugin.map_store import MapStore
+from plugin.memory import InsufficientMemory, MemoryBudget
+from plugin.mesh_io import hash_file
+from plugin.models import MapGroup, MapMesh
+from plugin.session_state import SessionCheckpoint
 
 from distutils.spawn import find_executable
 
@@ -19,14 +29,8 @@ class CryoEMPluginTestCase(unittest.IsolatedAsyncioTestCase):
 
     def setUp(self):
         super().setUp()
-        self.plugin = CryoEM()
-        plugin_id = 1
-        session_id = 1
-        version_table_file = os.path.join(fixtures_dir, "version_table_1_24_2.json")
-        with open(version_table_file, 'r') as f:
-            version_table = json.load(f)
-        self.plugin.set_client(plugin_id, session_id, version_table)
-        self.plugin.client = MagicMock()
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.plugin = self.create_plugin()
         # self.plugin.client.reader = MagicMock()
         # self.plugin.client.writer = MagicMock()
         self.map_group = MapGroup(self.plugin)
@@ -42,6 +46,23 @@ class CryoEMPluginTestCase(unittest.IsolatedAsyncioTestCase):
     def tearDown(self):
         super().tearDown()
         self.plugin.temp_dir.cleanup()
+        self.cache_dir.cleanup()
+
+    def create_plugin(self):
+        plugin = CryoEM()
+        plugin_id = 1
+        session_id = 1
+        version_table_file = os.path.join(fixtures_dir, "version_table_1_24_2.json")
+        with open(version_table_file, 'r') as f:
+            version_table = json.load(f)
+        plugin.set_client(plugin_id, session_id, version_table)
+        plugin.client = MagicMock()
+        plugin.map_cache = MapCache(self.cache_dir.name)
+        plugin.map_store = MapStore(os.path.join(self.cache_dir.name, 'store'))
+        plugin.memory_budget = MemoryBudget(reservations_dir=os.path.join(self.cache_dir.name, 'memory'))
+        # No compute service running, so meshes are generated in the session
+        plugin.compute = ComputeClient(os.path.join(self.cache_dir.name, 'compute.sock'))
+        return plugin
 
     def test_add_mapgroup(self):
         self.assertEqual(len(self.plugin.groups), 1)
@@ -102,6 +123,141 @@ class CryoEMPluginTestCase(unittest.IsolatedAsyncioTestCase):
         await self.plugin.add_mapfile_to_group(self.map_file)
         self.assertEqual(len(self.plugin.groups), 1)
 
+    async def test_add_mapfile_to_group_with_fitted_model(self):
+        await self.plugin.menu.render()
+        selected_mapgroup = self.plugin.get_group(self.plugin.menu.get_selected_mapgroup())
+
+        def add_to_workspace(comps):
+            fut = asyncio.Future()
+            fut.set_result(comps)
+            return fut
+        self.plugin.client.add_to_workspace = MagicMock(side_effect=add_to_workspace)
+
+        model_comp = await self.plugin.create_model_complex(self.pdb_file)
+        fitted_model = asyncio.Future()
+        fitted_model.set_result((self.pdb_file, model_comp, MapGroup.load_model(self.pdb_file)))
+        mapgroup = await self.plugin.add_mapfile_to_group(self.map_file, fitted_model=fitted_model)
+        # Model should be added to the same group as the map
+        self.assertEqual(mapgroup, selected_mapgroup)
+        self.assertTrue(isinstance(mapgroup.model_complex, structure.Complex))
+        self.assertTrue(isinstance(mapgroup.map_complex, structure.Complex))
+
+    async def test_add_mapfile_to_explicit_group_keeps_selection(self):
+        await self.plugin.menu.render()
+        selected_mapgroup = self.plugin.get_group(self.plugin.menu.get_selected_mapgroup())
+        add_to_workspace_fut = asyncio.Future()
+        add_to_workspace_fut.set_result([structure.Complex()])
+        self.plugin.client.add_to_workspace = MagicMock(return_value=add_to_workspace_fut)
+
+        other_mapgroup = self.plugin.add_mapgroup()
+        mapgroup = await self.plugin.add_mapfile_to_group(self.map_file, mapgroup=other_mapgroup)
+        self.assertEqual(mapgroup, other_mapgroup)
+        self.assertTrue(other_mapgroup.has_map())
+        self.assertFalse(selected_mapgroup.has_map())
+        self.assertEqual(self.plugin.menu.get_selected_mapgroup(), selected_mapgroup.group_name)
+
+    async def test_add_mapfile_to_group_uses_map_cache(self):
+        await self.plugin.menu.render()
+        add_to_workspace_fut = asyncio.Future()
+        add_to_workspace_fut.set_result([structure.Complex()])
+        self.plugin.client.add_to_workspace = MagicMock(return_value=add_to_workspace_fut)
+        result = premesh.premesh(self.map_file, self.cache_dir.name)
+
+        with patch.object(MapMesh, 'generate_mesh_from_map_manager') as generate_mock:
+            mapgroup = await self.plugin.add_mapfile_to_group(self.map_file)
+        generate_mock.assert_not_called()
+        self.assertEqual(mapgroup.isovalue, result['isovalue'])
+        self.assertEqual(len(mapgroup.map_mesh.mesh.vertices) // 3, result['vertices'])
+
+    async def test_add_mapfile_to_group_fills_map_cache(self):
+        await self.plugin.menu.render()
+        add_to_workspace_fut = asyncio.Future()
+        add_to_workspace_fut.set_result([structure.Complex()])
+        self.plugin.client.add_to_workspace = MagicMock(return_value=add_to_workspace_fut)
+        mapgroup = await self.plugin.add_mapfile_to_group(self.map_file)
+        source_hash = hash_file(self.map_file)
+        self.assertIsNotNone(self.plugin.map_cache.get_stats(source_hash))
+        self.assertIsNotNone(self.plugin.map_cache.get_mesh(source_hash, mapgroup.isovalue))
+
+    async def test_add_mapfile_to_group_attaches_shared_map(self):
+        await self.plugin.menu.render()
+        add_to_workspace_fut = asyncio.Future()
+        add_to_workspace_fut.set_result([structure.Complex()])
+        self.plugin.client.add_to_workspace = MagicMock(return_value=add_to_workspace_fut)
+        mapgroup = await self.plugin.add_mapfile_to_group(self.map_file)
+        self.assertIs(mapgroup.map_mesh.map_manager, mapgroup.shared_map)
+
+        # A second session attaches the same voxels
+        plugin = self.create_plugin()
+        self.addCleanup(plugin.temp_dir.cleanup)
+        shared_map = await plugin._attach_shared_map(self.map_file, hash_file(self.map_file))
+        self.assertEqual(shared_map.data.array.filename, mapgroup.shared_map.data.array.filename)
+        self.plugin.map_store.release_all()
+        plugin.map_store.release_all()
+        self.assertEqual(os.listdir(plugin.map_store.store_dir), ['.lock'])
+
+    async def test_add_mapfile_to_group_over_memory_budget(self):
+        await self.plugin.menu.render()
+        self.plugin.client.send_notification = AsyncMock()
+        self.plugin.memory_budget.capacity = 10 ** 6
+        with self.assertRaises(InsufficientMemory):
+            await self.plugin.add_mapfile_to_group(self.map_file)
+        self.assertFalse(self.plugin.groups[0].has_map())
+        self.plugin.client.send_notification.assert_awaited_once()
+        notification_type = self.plugin.client.send_notification.call_args[0][0]
+        self.assertEqual(notification_type, enums.NotificationTypes.error)
+        self.assertEqual(self.plugin.memory_budget.reserved(), 0)
+
+        # Batch loads mark the map as failed
+        emdb_menu = MagicMock()
+        emdb_menu.download_mapgz_from_emdbid = AsyncMock(return_value=self.map_file)
+        queue = EMDBIngestQueue(emdb_menu, self.plugin)
+        [item] = queue.submit(['8216'])
+        await queue.join()
+        self.assertEqual(item.status, IngestItem.FAILED)
+        self.assertNotIn('EMD-8216', [group.group_name for group in self.plugin.groups])
+
+    async def test_restore_session(self):
+        await self.plugin.menu.render()
+        next_index = iter(range(1, 100))
+
+        async def add_to_workspace(comps):
+            for comp in comps:
+                comp.index = next(next_index)
+            return comps
+        self.plugin.client.add_to_workspace = add_to_workspace
+        state_dir = os.path.join(self.cache_dir.name, 'sessions')
+        self.plugin.session_checkpoint = SessionCheckpoint('org-1-user-1', 1, self.plugin.map_cache, state_dir)
+        mapgroup = await self.plugin.add_mapfile_to_group(self.map_file)
+        await mapgroup.update_color(enums.ColorScheme.Chain, 0.4)
+        await self.plugin.checkpoint_session()
+
+        self.plugin.session_checkpoint.close()
+
+        # Restart the plugin in a new session, the map complex is still in the workspace
+        plugin = self.create_plugin()
+        self.addCleanup(plugin.temp_dir.cleanup)
+        plugin.session_checkpoint = SessionCheckpoint('org-1-user-1', 2, plugin.map_cache, state_dir)
+        plugin.client.add_to_workspace = add_to_workspace
+        plugin.client.request_complex_list = AsyncMock(return_value=[mapgroup.map_complex])
+        plugin.client.request_complexes = AsyncMock(return_value=[mapgroup.map_complex])
+        plugin.client.remove_from_workspace = AsyncMock()
+        plugin.client.shapes_upload_multiple = AsyncMock(side_effect=lambda meshes: meshes)
+        with patch.object(MapMesh, 'generate_mesh_from_map_manager') as generate_mock:
+            await plugin.restore_session()
+        generate_mock.assert_not_called()
+
+        [restored] = plugin.groups
+        self.assertEqual(restored.group_name, mapgroup.group_name)
+        self.assertEqual(restored.isovalue, mapgroup.isovalue)
+        self.assertEqual(restored.opacity, 0.4)
+        self.assertEqual(restored.color_scheme, enums.ColorScheme.Chain)
+        self.assertEqual(restored.hist_x_max, mapgroup.hist_x_max)
+        np.testing.assert_array_equal(restored.map_mesh.mesh.vertices, mapgroup.map_mesh.mesh.vertices)
+        # The old map complex is replaced
+        plugin.client.remove_from_workspace.assert_called_once_with([mapgroup.map_complex])
+        self.assertNotEqual(restored.map_complex.index, mapgroup.map_complex.index)
+
     async def test_delete_mapgroup(self):
         self.assertEqual(len(self.plugin.groups), 1)
         remove_from_workspace_fut = asyncio.Future()
@@ -125,6 +281,25 @@ class CryoEMPluginTestCase(unittest.IsolatedAsyncioTestCase):
         # Validate that the map file was deleted
         self.assertFalse(os.path.exists(existing_group.mapfile))
 
+    async def test_on_complex_added_removed(self):
+        removed_group, kept_group = self.plugin.groups[0], self.plugin.add_mapgroup()
+        # Still loading, so it has no complex in the workspace.
+        loading_group = self.plugin.add_mapgroup()
+        for index, mapgroup in enumerate([removed_group, kept_group], 1):
+            comp = structure.Complex()
+            comp.index = index
+            mapgroup.add_model_complex(comp)
+        workspace_comp = structure.Complex()
+        workspace_comp.index = 2
+        self.plugin.client.request_complex_list = AsyncMock(return_value=[workspace_comp])
+
+        # Changes in a burst are checked with one request.
+        for _ in range(3):
+            await self.plugin.on_complex_added_removed()
+        await self.plugin._workspace_sync_task
+        self.plugin.client.request_complex_list.assert_called_once()
+        self.assertEqual(self.plugin.groups, [kept_group, loading_group])
+
     async def test_create_model_complex(self):
         # Test pdb file
         model_complex = await self.plugin.create_model_complex(self.pdb_file)
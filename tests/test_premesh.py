@@ -0,0 +1,134 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+
+from plugin import premesh
+from plugin.map_cache import MapCache
+from plugin.mesh_io import MeshArtifact, hash_file
+from plugin.models import MapMesh
+from plugin.utils import EMDBMetadataParser
+
+
+fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+class MapCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache = MapCache(self.temp_dir.name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_put_get_mesh(self):
+        artifact = MeshArtifact([0, 0, 0, 1, 0, 0, 0, 1, 0], [0, 0, 1], [0, 1, 2], {
+            'isovalue': 0.25, 'source_sha256': 'abc'})
+        self.assertIsNone(self.cache.get_mesh('abc', 0.25))
+        self.cache.put_mesh(artifact)
+        cached = self.cache.get_mesh('abc', 0.25)
+        np.testing.assert_array_equal(cached.vertices, artifact.vertices)
+        # Other isovalues are separate meshes
+        self.assertIsNone(self.cache.get_mesh('abc', 0.5))
+        # No temporary files are left behind
+        self.assertEqual(os.listdir(os.path.dirname(self.cache.mesh_path('abc', 0.25))), [
+            os.path.basename(self.cache.mesh_path('abc', 0.25))])
+
+    def test_invalid_mesh(self):
+        with open(self.cache.mesh_path('abc', 0.25), 'wb') as f:
+            f.write(b'not a mesh')
+        self.assertIsNone(self.cache.get_mesh('abc', 0.25))
+
+    def test_put_get_stats(self):
+        self.assertIsNone(self.cache.get_stats('abc'))
+        self.cache.put_stats('abc', {'mean': 0.1})
+        self.assertEqual(self.cache.get_stats('abc'), {'mean': 0.1})
+
+    def test_evict_least_recently_used(self):
+        old_time = time.time() - 60
+        for i, source_hash in enumerate(['a', 'b', 'c']):
+            self.cache.put_stats(source_hash, {'mean': 'x' * 30})
+            os.utime(self.cache.stats_path(source_hash), (old_time + i, old_time + i))
+        # Room for three statistics files
+        self.cache.max_bytes = 3 * os.path.getsize(self.cache.stats_path('a'))
+        # Using a's statistics makes b the least recently used
+        self.assertIsNotNone(self.cache.get_stats('a'))
+        self.cache.put_stats('d', {'mean': 'x' * 30})
+        self.assertIsNone(self.cache.get_stats('b'))
+        for source_hash in ['a', 'c', 'd']:
+            self.assertIsNotNone(self.cache.get_stats(source_hash))
+
+    def test_files_not_evicted(self):
+        self.cache.max_bytes = 0
+        cached_path = self.cache.put_file(os.path.join(fixtures_dir, 'emd_8216.map.gz'), 'abc')
+        self.cache.put_stats('abc', {'mean': 0.1})
+        self.assertIsNone(self.cache.get_stats('abc'))
+        self.assertTrue(os.path.exists(cached_path))
+        self.cache.remove_file(cached_path)
+        self.assertFalse(os.path.exists(os.path.dirname(cached_path)))
+
+    def test_contains(self):
+        self.assertTrue(self.cache.contains(self.cache.emdb_map_path('8216')))
+        self.assertFalse(self.cache.contains(os.path.join(fixtures_dir, 'emd_8216.map.gz')))
+
+
+class PremeshTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = self.temp_dir.name
+        self.map_file = os.path.join(fixtures_dir, 'emd_8216.map.gz')
+        with open(os.path.join(fixtures_dir, 'metadata_8216.xml'), 'rb') as f:
+            self.parser = EMDBMetadataParser(f.read())
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_premesh_local_file(self):
+        result = premesh.premesh(self.map_file, self.cache_dir)
+        self.assertFalse(result['cached'])
+        cache = MapCache(self.cache_dir)
+        source_hash = hash_file(self.map_file)
+        stats = cache.get_stats(source_hash)
+        self.assertEqual(result['isovalue'], stats['default_isovalue'])
+        artifact = cache.get_mesh(source_hash, result['isovalue'])
+        self.assertTrue(MapMesh.is_mesh_artifact_current(artifact, source_hash))
+        self.assertEqual(len(artifact.vertices) // 3, result['vertices'])
+        self.assertIsNone(artifact.colors)
+
+        # Second run reuses the mesh
+        with patch.object(MapMesh, 'generate_mesh_from_map_manager') as generate_mock:
+            result = premesh.premesh(self.map_file, self.cache_dir)
+        generate_mock.assert_not_called()
+        self.assertTrue(result['cached'])
+
+    @patch('plugin.premesh.download_emdb_map')
+    @patch('plugin.premesh.download_emdb_header')
+    def test_premesh_emdb_id(self, header_mock, map_mock):
+        header_mock.return_value = self.parser
+        map_mock.side_effect = lambda emdb_id, file_path: shutil.copy(self.map_file, file_path)
+        result = premesh.premesh('8216', self.cache_dir)
+        map_mock.assert_called_once_with('8216', MapCache(self.cache_dir).emdb_map_path('8216'))
+        # Meshed at the contour level from the header
+        self.assertEqual(result['isovalue'], self.parser.isovalue)
+
+        # Cached maps are not downloaded again
+        premesh.premesh('8216', self.cache_dir)
+        map_mock.assert_called_once()
+
+    def test_parse_sources(self):
+        sources = premesh.parse_sources([self.map_file, 'EMD-8216', '8217-8218'])
+        self.assertEqual(sources, [self.map_file, '8216', '8217', '8218'])
+
+    def test_main(self):
+        argv = ['premesh', self.map_file, '--workers', '1', '--cache-dir', self.cache_dir]
+        with patch.object(sys, 'argv', argv):
+            premesh.main()
+        source_hash = hash_file(self.map_file)
+        self.assertIsNotNone(MapCache(self.cache_dir).get_stats(source_hash))
@@ -0,0 +1,48 @@
+import os
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+
+from plugin.models import MapMesh
+from plugin.preview import MeshPreview, grid_to_cart_matrix
+
+
+fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+class MeshPreviewTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.map_manager = MapMesh.load_mapfile(os.path.join(fixtures_dir, 'emd_8216.map.gz'))
+        cls.stats = MapMesh.compute_map_stats(cls.map_manager)
+
+    def test_grid_to_cart_matrix(self):
+        matrix = grid_to_cart_matrix(self.map_manager)
+        grid_units = (3.0, 5.0, 7.0)
+        np.testing.assert_allclose(matrix @ grid_units, self.map_manager.grid_units_to_cart(grid_units))
+
+    def test_preview_matches_full_mesh(self):
+        isovalue = self.stats['default_isovalue']
+        preview = MeshPreview(self.map_manager).mesh(isovalue)
+        full_mesh = MapMesh.generate_mesh_from_map_manager(self.map_manager, isovalue)
+        preview_vertices = np.reshape(preview.vertices, (-1, 3))
+        full_vertices = np.reshape(full_mesh.vertices, (-1, 3))
+        # Same surface, within a few voxels
+        voxel_size = np.linalg.norm(grid_to_cart_matrix(self.map_manager), axis=0).max()
+        np.testing.assert_allclose(preview_vertices.min(axis=0), full_vertices.min(axis=0), atol=3 * voxel_size)
+        np.testing.assert_allclose(preview_vertices.max(axis=0), full_vertices.max(axis=0), atol=3 * voxel_size)
+        self.assertEqual(len(preview.normals), len(preview.vertices))
+        self.assertEqual(np.max(preview.triangles), len(preview_vertices) - 1)
+
+    def test_downsampled(self):
+        with patch('plugin.preview.PREVIEW_GRID_SIZE', 16):
+            preview = MeshPreview(self.map_manager)
+        self.assertGreater(preview.stride, 1)
+        self.assertLessEqual(max(preview.voxels.shape), 16)
+        self.assertGreater(len(preview.mesh(self.stats['default_isovalue']).vertices), 0)
+
+    def test_no_surface(self):
+        preview = MeshPreview(self.map_manager)
+        self.assertEqual(len(preview.mesh(self.stats['max'] + 1).vertices), 0)
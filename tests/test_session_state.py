@@ -0,0 +1,138 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+from nanome.api import shapes
+
+from plugin.map_cache import MapCache
+from plugin.session_state import SessionCheckpoint
+
+
+fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+class SessionCheckpointTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.map_cache = MapCache(os.path.join(self.temp_dir.name, 'cache'))
+        self.state_dir = os.path.join(self.temp_dir.name, 'sessions')
+        self.checkpoint = SessionCheckpoint('org-1-user-1', 1, self.map_cache, self.state_dir)
+        # Copy of the map in a download directory
+        self.map_file = os.path.join(self.temp_dir.name, 'emd_8216.map.gz')
+        shutil.copy(os.path.join(fixtures_dir, 'emd_8216.map.gz'), self.map_file)
+        self.mesh = self.create_mesh()
+        self.state = {
+            'group_name': 'emd_8216.map', 'isovalue': 0.5, 'map_complex_index': 10, 'model_complex_index': None}
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    @staticmethod
+    def create_mesh():
+        mesh = shapes.Mesh()
+        mesh.vertices = np.array([0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0, 0.0])
+        mesh.normals = np.array([0.0, 0.0, 1.0])
+        mesh.triangles = np.array([0, 1, 2])
+        return mesh
+
+    def saved_meshes(self):
+        return sorted(f for f in os.listdir(self.checkpoint.session_dir) if f.endswith('.mesh'))
+
+    def test_save_load(self):
+        self.checkpoint.save([(self.state, self.map_file, None, self.mesh)])
+        [state] = self.checkpoint.load()
+        self.assertEqual(state['isovalue'], 0.5)
+        self.assertIsNone(state['model_file'])
+        # The map is kept in the map cache, under its original name
+        self.assertTrue(self.map_cache.contains(state['mapfile']))
+        self.assertEqual(os.path.basename(state['mapfile']), 'emd_8216.map.gz')
+        os.remove(self.map_file)
+        self.assertTrue(os.path.exists(state['mapfile']))
+
+        mesh = self.checkpoint.load_mesh(state['mesh_file'])
+        np.testing.assert_array_equal(mesh.vertices, self.mesh.vertices)
+
+    def test_unchanged_mesh_not_saved_again(self):
+        self.checkpoint.save([(self.state, self.map_file, None, self.mesh)])
+        [mesh_file] = self.saved_meshes()
+        self.checkpoint.save([(dict(self.state, isovalue=0.6), self.map_file, None, self.mesh)])
+        self.assertEqual(self.saved_meshes(), [mesh_file])
+        self.assertEqual(self.checkpoint.load()[0]['isovalue'], 0.6)
+
+        # A replaced mesh is saved, and the previous one removed
+        self.mesh.colors = np.array([1.0, 1.0, 1.0, 1.0] * 3)
+        self.checkpoint.save([(self.state, self.map_file, None, self.mesh)])
+        [new_mesh_file] = self.saved_meshes()
+        self.assertNotEqual(new_mesh_file, mesh_file)
+
+    def test_restored_mesh_not_saved_again(self):
+        self.checkpoint.save([(self.state, self.map_file, None, self.mesh)])
+        [state] = self.checkpoint.load()
+        self.checkpoint.close()
+        checkpoint = SessionCheckpoint('org-1-user-1', 2, self.map_cache, self.state_dir)
+        [state] = checkpoint.load([10])
+        mesh = checkpoint.load_mesh(state['mesh_file'])
+        checkpoint.save([(state, state['mapfile'], None, mesh)])
+        self.checkpoint = checkpoint
+        self.assertEqual(self.saved_meshes(), [state['mesh_file']])
+
+    def test_deleted_files_skipped(self):
+        os.remove(self.map_file)
+        self.checkpoint.save([(self.state, self.map_file, None, self.mesh)])
+        self.assertEqual(self.checkpoint.load(), [])
+
+    def test_no_checkpoint(self):
+        self.assertEqual(self.checkpoint.load(), [])
+
+    def test_concurrent_sessions(self):
+        # Another session of the same user doesn't overwrite or adopt this one's checkpoint
+        self.checkpoint.save([(self.state, self.map_file, None, self.mesh)])
+        checkpoint = SessionCheckpoint('org-1-user-1', 2, self.map_cache, self.state_dir)
+        self.assertEqual(checkpoint.load([10]), [])
+        checkpoint.save([])
+        self.assertEqual(len(self.checkpoint.load()), 1)
+
+    def test_adopt_ended_session(self):
+        self.checkpoint.save([(self.state, self.map_file, None, self.mesh)])
+        self.checkpoint.close()
+        # Only adopted by a session with the group's complexes in its workspace
+        other_room = SessionCheckpoint('org-1-user-1', 2, self.map_cache, self.state_dir)
+        self.assertEqual(other_room.load([11]), [])
+        checkpoint = SessionCheckpoint('org-1-user-1', 3, self.map_cache, self.state_dir)
+        [state] = checkpoint.load([10])
+        self.assertEqual(state['isovalue'], 0.5)
+        self.assertEqual(checkpoint.session_dir, self.checkpoint.session_dir)
+        # The adopted checkpoint is locked again
+        self.assertEqual(other_room.load([10]), [])
+
+    def test_close_without_groups(self):
+        self.checkpoint.save([])
+        self.checkpoint.close()
+        self.assertFalse(os.path.exists(self.checkpoint.session_dir))
+
+    def test_unused_files_removed(self):
+        self.checkpoint.save([(self.state, self.map_file, None, self.mesh)])
+        [state] = self.checkpoint.load()
+        # Kept while another checkpoint uses the same file
+        checkpoint = SessionCheckpoint('org-2-user-2', 1, self.map_cache, self.state_dir)
+        checkpoint.save([(self.state, self.map_file, None, self.mesh)])
+        self.checkpoint.save([])
+        self.assertTrue(os.path.exists(state['mapfile']))
+        checkpoint.save([])
+        self.assertFalse(os.path.exists(state['mapfile']))
+
+    def test_expired_checkpoint_removed(self):
+        self.checkpoint.save([(self.state, self.map_file, None, self.mesh)])
+        [state] = self.checkpoint.load()
+        self.checkpoint.close()
+        saved_time = time.time() - 3600
+        os.utime(self.checkpoint.state_path, (saved_time, saved_time))
+
+        checkpoint = SessionCheckpoint('org-2-user-2', 1, self.map_cache, self.state_dir, max_age=60)
+        self.assertEqual(checkpoint.load(), [])
+        self.assertFalse(os.path.exists(self.checkpoint.session_dir))
+        self.assertFalse(os.path.exists(state['mapfile']))
@@ -0,0 +1,40 @@
+import asyncio
+import unittest
+
+from nanome.api import ui
+from unittest.mock import MagicMock
+
+from plugin.ui_updates import UIUpdateQueue
+
+
+class UIUpdateQueueTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.plugin = MagicMock()
+        self.queue = UIUpdateQueue(self.plugin, window=0.01)
+
+    async def test_updates_merged_within_window(self):
+        label = ui.Label()
+        slider = ui.Slider()
+        for i in range(10):
+            label.text_value = str(i)
+            self.queue.update_content(label, slider)
+        self.plugin.client.update_content.assert_not_called()
+        await asyncio.sleep(0.05)
+        self.plugin.client.update_content.assert_called_once_with(label, slider)
+        self.assertEqual(self.queue.counters, {'requested': 20, 'suppressed': 18, 'sent': 1})
+
+    async def test_flush_order(self):
+        menu = ui.Menu()
+        node = ui.LayoutNode()
+        button = ui.Button()
+        self.queue.update_content(button)
+        self.queue.update_node(node)
+        self.queue.update_menu(menu)
+        self.queue.flush()
+        calls = [call[0] for call in self.plugin.client.method_calls]
+        self.assertEqual(calls, ['update_menu', 'update_node', 'update_content'])
+        self.assertEqual(self.queue.counters['sent'], 3)
+        # Nothing is sent again at the end of the window
+        await asyncio.sleep(0.05)
+        self.assertEqual(len(self.plugin.client.method_calls), 3)
@@ -1,7 +1,8 @@
+import gzip
 import os
 import unittest
 
-from plugin.utils import EMDBMetadataParser
+from plugin.utils import EMDBMetadataParser, MRCHeader, parse_emdb_ids
 
 
 fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
@@ -27,7 +28,72 @@ class EMDBMetadataParserTestCase(unittest.TestCase):
         expected_value = 1661
         self.assertEqual(self.parser.map_filesize, expected_value)
 
+    def test_map_dimensions(self):
+        self.assertEqual(self.parser.map_dimensions, (83, 100, 50))
+
     def test_pdb_list(self):
         expected_value = ['5k7n']
         pdb_list = self.parser.pdb_list
         self.assertEqual(pdb_list, expected_value)
+
+
+class ParseEMDBIdsTestCase(unittest.TestCase):
+
+    def test_single_id(self):
+        self.assertEqual(parse_emdb_ids('8216'), ['8216'])
+        self.assertEqual(parse_emdb_ids(' EMD-8216 '), ['8216'])
+
+    def test_list_and_range(self):
+        emdb_ids = parse_emdb_ids('8216, 8217 8220-8222,8217')
+        self.assertEqual(emdb_ids, ['8216', '8217', '8220', '8221', '8222'])
+
+    def test_range_keeps_padding(self):
+        self.assertEqual(parse_emdb_ids('0009-0011'), ['0009', '0010', '0011'])
+        self.assertEqual(parse_emdb_ids('9'), ['0009'])
+
+    def test_range_with_spaces(self):
+        self.assertEqual(parse_emdb_ids('8216 - 8218'), ['8216', '8217', '8218'])
+        self.assertEqual(parse_emdb_ids('EMD-8216 - EMD-8217'), ['8216', '8217'])
+
+    def test_max_batch_size(self):
+        with self.assertRaises(ValueError):
+            parse_emdb_ids('1-200000')
+        with self.assertRaises(ValueError):
+            parse_emdb_ids('8216-8218, 8220', max_ids=3)
+        self.assertEqual(len(parse_emdb_ids('8216-8235')), 20)
+
+    def test_invalid(self):
+        self.assertEqual(parse_emdb_ids(''), [])
+        with self.assertRaises(ValueError):
+            parse_emdb_ids('abc')
+        with self.assertRaises(ValueError):
+            parse_emdb_ids('8220-8216')
+
+
+class MRCHeaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        with gzip.open(os.path.join(fixtures_dir, 'emd_8216.map.gz'), 'rb') as f:
+            self.header_bytes = f.read(1024)
+
+    def test_grid(self):
+        header = MRCHeader(self.header_bytes)
+        self.assertEqual(header.dimensions, (83, 100, 50))
+        self.assertEqual(header.mode, 2)
+        self.assertAlmostEqual(header.voxel_size[0], 0.368, places=3)
+
+    def test_data_size(self):
+        header = MRCHeader(self.header_bytes)
+        self.assertEqual(header.data_size, 1661344)
+        self.assertEqual(header.size_mb, 1.66)
+
+    def test_invalid_header(self):
+        with self.assertRaises(ValueError):
+            MRCHeader(b'\0' * 1024)
+        with self.assertRaises(ValueError):
+            MRCHeader(self.header_bytes[:100])
+
+    def test_read(self):
+        header = MRCHeader.read(os.path.join(fixtures_dir, 'emd_8216.map.gz'))
+        self.assertEqual(header.dimensions, (83, 100, 50))
+        self.assertIsNone(MRCHeader.read(os.path.join(fixtures_dir, '7c4u.pdb')))
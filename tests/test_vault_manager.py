@@ -0,0 +1,167 @@
+import aiohttp
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from plugin.vault_manager import VaultManager
+from tests.vault_server import StandInVaultServer
+
+
+fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+class VaultManagerTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.api_key = 'abc1234'
+        self.server = StandInVaultServer(self.api_key, locked={'shared/secret': 'hunter2'})
+        server_url = await self.server.start()
+        self.vault_manager = VaultManager(self.api_key, server_url)
+
+    async def asyncTearDown(self):
+        await self.vault_manager.close()
+        await self.server.close()
+
+    async def test_list_path(self):
+        self.server.add_file('shared/emd_8216.map.gz', b'data')
+        items = await self.vault_manager.list_path('shared/')
+        self.assertEqual([f['name'] for f in items['files']], ['emd_8216.map.gz'])
+        self.assertEqual(items['folders'], [])
+
+    async def test_session_reused(self):
+        await self.vault_manager.list_path('./')
+        session = self.vault_manager.session
+        await self.vault_manager.create_path('shared/new')
+        await self.vault_manager.list_path('shared/')
+        self.assertIs(self.vault_manager.session, session)
+
+    async def test_folder_commands(self):
+        await self.vault_manager.create_path('shared/maps')
+        await self.vault_manager.rename_path('shared/maps', 'renamed')
+        items = await self.vault_manager.list_path('shared/')
+        self.assertEqual([f['name'] for f in items['folders']], ['renamed'])
+        await self.vault_manager.delete_path('shared/renamed')
+        items = await self.vault_manager.list_path('shared/')
+        self.assertEqual(items['folders'], [])
+
+    async def test_is_key_valid(self):
+        self.assertTrue(await self.vault_manager.is_key_valid('shared/secret', 'hunter2'))
+        self.assertFalse(await self.vault_manager.is_key_valid('shared/secret', 'wrong'))
+
+    async def test_add_and_get_file(self):
+        map_file = os.path.join(fixtures_dir, 'emd_8216.map.gz')
+        with open(map_file, 'rb') as f:
+            data = f.read()
+        await self.vault_manager.add_file('shared/', 'emd_8216.map.gz', data)
+        filesize = await self.vault_manager.get_filesize('shared/emd_8216.map.gz')
+        self.assertEqual(filesize, len(data) / 1000)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            out_path = os.path.join(temp_dir, 'emd_8216.map.gz')
+            success = await self.vault_manager.get_file('shared/emd_8216.map.gz', None, out_path)
+            self.assertTrue(success)
+            with open(out_path, 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+    async def test_add_file_from_path(self):
+        map_file = os.path.join(fixtures_dir, 'emd_8216.map.gz')
+        progress = []
+        await self.vault_manager.add_file(
+            'shared/', 'emd_8216.map.gz', map_file,
+            progress_callback=lambda uploaded, total: progress.append((uploaded, total)))
+        with open(map_file, 'rb') as f:
+            self.assertEqual(self.server.entries['shared/emd_8216.map.gz'], f.read())
+        filesize = os.path.getsize(map_file)
+        self.assertEqual(progress[-1], (filesize, filesize))
+
+    async def test_add_file_from_async_iterable(self):
+        async def chunks():
+            for i in range(3):
+                yield b'chunk%d' % i
+        await self.vault_manager.add_file('shared/', 'model.pdb', chunks())
+        self.assertEqual(self.server.entries['shared/model.pdb'], b'chunk0chunk1chunk2')
+
+    @patch('plugin.vault_manager.UPLOAD_RETRY_DELAY', 0)
+    async def test_add_file_retried(self):
+        self.server.failing_uploads = 2
+        await self.vault_manager.add_file('shared/', 'model.pdb', b'data')
+        self.assertEqual(self.server.entries['shared/model.pdb'], b'data')
+        self.assertEqual(self.server.requests.count(('POST', 'shared/')), 3)
+
+    @patch('plugin.vault_manager.UPLOAD_RETRY_DELAY', 0)
+    async def test_add_file_retries_exhausted(self):
+        self.server.failing_uploads = 10
+        with self.assertRaises(aiohttp.ClientResponseError):
+            await self.vault_manager.add_file('shared/', 'model.pdb', b'data')
+        self.assertNotIn('shared/model.pdb', self.server.entries)
+
+    async def test_listing_cache(self):
+        await self.vault_manager.list_path('shared/')
+        listing = await self.vault_manager.list_path('shared')
+        self.assertEqual(self.server.requests.count(('GET', 'shared/')), 1)
+        # Cached listings are copies
+        listing['folders'].append({'name': 'fake'})
+        listing = await self.vault_manager.list_path('shared/')
+        self.assertEqual(listing['folders'], [])
+        # Different key is cached separately
+        await self.vault_manager.list_path('shared/', 'hunter2')
+        self.assertEqual(self.server.requests.count(('GET', 'shared/')), 2)
+
+    async def test_listing_cache_ttl(self):
+        self.vault_manager.listing_ttl = 0
+        await self.vault_manager.list_path('shared/')
+        await self.vault_manager.list_path('shared/')
+        self.assertEqual(self.server.requests.count(('GET', 'shared/')), 2)
+
+    async def test_listing_cache_invalidated(self):
+        await self.vault_manager.list_path('shared/')
+        await self.vault_manager.create_path('shared/maps')
+        listing = await self.vault_manager.list_path('shared/')
+        self.assertEqual([f['name'] for f in listing['folders']], ['maps'])
+        await self.vault_manager.add_file('shared/', 'model.pdb', b'data')
+        listing = await self.vault_manager.list_path('shared/')
+        self.assertEqual([f['name'] for f in listing['files']], ['model.pdb'])
+
+    async def test_prefetch_listings(self):
+        await self.vault_manager.create_path('shared/maps')
+        self.vault_manager.prefetch_listings(['shared/', 'shared/maps/'])
+        # Listing requested while prefetch is in flight shares the request
+        await self.vault_manager.list_path('shared/maps/')
+        await asyncio.gather(*self.vault_manager._pending_listings.values())
+        await self.vault_manager.list_path('shared/')
+        self.assertEqual(self.server.requests.count(('GET', 'shared/maps/')), 1)
+        self.assertEqual(self.server.requests.count(('GET', 'shared/')), 1)
+
+    async def test_probe_map(self):
+        with open(os.path.join(fixtures_dir, 'emd_8216.map.gz'), 'rb') as f:
+            self.server.add_file('shared/emd_8216.map.gz', f.read())
+        header = await self.vault_manager.probe_map('shared/emd_8216.map.gz')
+        self.assertEqual(header.dimensions, (83, 100, 50))
+        self.assertEqual(header.mode, 2)
+        self.assertEqual(header.file_size, 1661344)
+        self.assertEqual(header.data_size, 1661344)
+        self.assertEqual(len(self.server.range_requests), 2)
+
+    async def test_probe_map_cached_per_etag(self):
+        with open(os.path.join(fixtures_dir, 'emd_8216.map.gz'), 'rb') as f:
+            data = f.read()
+        self.server.add_file('shared/emd_8216.map.gz', data)
+        first = await self.vault_manager.probe_map('shared/emd_8216.map.gz')
+        second = await self.vault_manager.probe_map('shared/emd_8216.map.gz')
+        self.assertIs(first, second)
+        self.assertEqual(len(self.server.range_requests), 2)
+        # A changed file has a new ETag, so it is probed again
+        self.server.add_file('shared/emd_8216.map.gz', data + b'\0')
+        await self.vault_manager.probe_map('shared/emd_8216.map.gz')
+        self.assertEqual(len(self.server.range_requests), 4)
+
+    async def test_probe_map_without_range_support(self):
+        with open(os.path.join(fixtures_dir, 'emd_8216.map.gz'), 'rb') as f:
+            self.server.add_file('shared/emd_8216.map.gz', f.read())
+        self.server.supports_ranges = False
+        self.assertIsNone(await self.vault_manager.probe_map('shared/emd_8216.map.gz'))
+
+    async def test_probe_non_map_file(self):
+        self.server.add_file('shared/emd_8216.map', b'not a map' * 200)
+        self.assertIsNone(await self.vault_manager.probe_map('shared/emd_8216.map'))
@@ -1,11 +1,17 @@
 import asyncio
-import json
 import os
+import tempfile
 import unittest
 from unittest.mock import AsyncMock, MagicMock, patch
 from plugin.vault_menu import VaultMenu
 from plugin import CryoEM
+from plugin.map_cache import MapCache
+from plugin.map_store import MapStore
+from plugin.memory import InsufficientMemory
+from plugin.mesh_io import MeshArtifact
+from plugin.models import MapMesh
 from plugin.vault_manager import VaultManager
+from tests.vault_server import StandInVaultServer
 
 
 fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
@@ -13,56 +19,261 @@ fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
 
 class VaultMenuTestCase(unittest.IsolatedAsyncioTestCase):
 
-    def setUp(self):
+    async def asyncSetUp(self):
         api_key = 'abc1234'
-        server_url = 'https://vault.example.com'
+        self.server = StandInVaultServer(api_key)
+        server_url = await self.server.start()
         self.vault_manager = VaultManager(api_key, server_url)
         self.plugin_instance = CryoEM()
         self.plugin_instance.client = MagicMock()
+        self.plugin_instance.client.send_notification = AsyncMock()
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.plugin_instance.map_cache = MapCache(self.cache_dir.name)
+        self.plugin_instance.map_store = MapStore(os.path.join(self.cache_dir.name, 'store'))
         org = 'test_org'
         account_id = 'user-xxxx'
         self.vault_menu = VaultMenu(self.plugin_instance, self.vault_manager, org, account_id)
 
-        self.root_list_items_mock = json.loads(
-            '{"success": true, "locked_path": null, "locked": [], "folders": [{"name": "shared", "size": "", "size_text": "", "created": "", "created_text": ""}], "files": []}')
-        self.shared_list_items_mock = json.loads(
-            '{"success": true, "locked_path": null, "locked": [], "folders": [], "files": [{"name": "emd_8216.map.gz", "size": 1227499, "size_text": "1.2MB", "created": "2023-06-30 15:59", "created_text": "10 days ago"}]}')
+        self.map_file = os.path.join(fixtures_dir, 'emd_8216.map.gz')
+        with open(self.map_file, 'rb') as f:
+            self.server.add_file('shared/emd_8216.map.gz', f.read())
 
-    def test_show_menu(self):
-        self.vault_manager.list_path = MagicMock(return_value=self.root_list_items_mock)
+    async def asyncTearDown(self):
+        if self.vault_menu.map_info_task:
+            self.vault_menu.map_info_task.cancel()
+        await self.vault_manager.close()
+        await self.server.close()
+        self.cache_dir.cleanup()
+
+    async def test_show_menu(self):
         self.vault_menu.menu.enabled = False
-        self.vault_menu.show_menu()
+        await self.vault_menu.show_menu()
         self.assertTrue(self.vault_menu.menu.enabled)
+        # Root shows shared, org and account folders
+        folder_names = [item.name for item in self.vault_menu.lst_files.items]
+        self.assertEqual(sorted(folder_names), sorted(['shared', 'test_org', 'user-xxxx']))
+
+    async def test_open_folder(self):
+        await self.vault_menu.show_menu()
+        await self.vault_menu.open_folder('shared')
+        self.assertEqual(self.vault_menu.path, 'shared')
+        self.assertEqual([item.name for item in self.vault_menu.lst_files.items], ['emd_8216.map.gz'])
+
+    async def test_open_prefetched_folder(self):
+        await self.vault_menu.show_menu()
+        await asyncio.gather(*self.vault_manager._pending_listings.values())
+        self.assertIn(('GET', 'shared/'), self.server.requests)
+        requests_made = len(self.server.requests)
+        await self.vault_menu.open_folder('shared')
+        await self.vault_menu.open_folder('..')
+        self.assertEqual([item.name for item in self.vault_menu.lst_files.items][0], 'shared')
+        # Both listings came from the cache
+        self.assertEqual(len(self.server.requests[requests_made:]), 0)
+
+    async def test_update_unreachable_vault(self):
+        await self.server.close()
+        await self.vault_menu.update()
+        self.plugin_instance.client.send_notification.assert_awaited_once()
+
+    async def test_on_action_confirm_new_folder(self):
+        await self.vault_menu.open_folder('shared')
+        self.vault_menu.pending_action = 'New Folder'
+        self.vault_menu.ln_actions_dialog.find_node('Input').get_content().input_text = 'maps'
+        await self.vault_menu.on_action_confirm(MagicMock())
+        self.assertIn('shared/maps', self.server.entries)
+        self.assertIn('maps', [item.name for item in self.vault_menu.lst_files.items])
+
+    async def test_load_files_concurrently(self):
+        """Loading a map and model together should add one map complex and one mesh."""
+        with open(os.path.join(fixtures_dir, '7c4u.pdb'), 'rb') as f:
+            self.server.add_file('shared/7c4u.pdb', f.read())
+        client = self.plugin_instance.client
+        next_index = iter(range(1, 100))
+        new_mesh_uploads = []
+
+        async def add_to_workspace(comps):
+            await asyncio.sleep(0.01)
+            for comp in comps:
+                comp.index = next(next_index)
+            return comps
+
+        async def shapes_upload_multiple(meshes):
+            if meshes[0].index == -1:
+                new_mesh_uploads.append(meshes)
+            # Slow upload, so the model is added while the new mesh is still uploading.
+            await asyncio.sleep(0.5)
+            for mesh in meshes:
+                if mesh.index == -1:
+                    mesh._index = next(next_index)
+            return meshes
+
+        async def request_complexes(indices):
+            return [self.plugin_instance.groups[0].model_complex]
+        client.add_to_workspace = add_to_workspace
+        client.shapes_upload_multiple = shapes_upload_multiple
+        client.request_complexes = request_complexes
+        client.update_structures_deep = AsyncMock()
+        await self.plugin_instance.menu.render()
+        self.plugin_instance.menu.render = AsyncMock()
+
+        # The loading bar stays up until every download in the batch is done
+        download = self.vault_menu.download_file_from_vault
+        bar_enabled = []
+
+        async def download_file_from_vault(*args, **kwargs):
+            success = await download(*args, **kwargs)
+            bar_enabled.append(self.vault_menu.ln_lb_vault_load.enabled)
+            return success
+        self.vault_menu.download_file_from_vault = download_file_from_vault
+
+        await self.vault_menu.open_folder('shared')
+        self.vault_menu.select_all(MagicMock())
+        self.assertEqual(len(self.vault_menu.selected_items), 2)
+        await self.vault_menu.load_files()
+        # Let fire and forget uploads finish
+        await asyncio.sleep(1)
+        self.assertEqual(bar_enabled, [True, True])
+        self.assertFalse(self.vault_menu.ln_lb_vault_load.enabled)
+
+        [mapgroup] = self.plugin_instance.groups
+        self.assertTrue(mapgroup.has_map())
+        self.assertIsNotNone(mapgroup.model_complex)
+        self.assertEqual(len(new_mesh_uploads), 1)
 
     async def test_load_file(self):
         filename = 'emd_8216.map.gz'
-        mock_file = os.path.join(fixtures_dir, filename)
-
         add_mapfile_fut = asyncio.Future()
         add_mapfile_fut.set_result(MagicMock())
         self.plugin_instance.add_mapfile_to_group = MagicMock(return_value=add_mapfile_fut)
 
-        head_response_mock = MagicMock()
-        head_response_mock.headers = {'Content-Length': os.path.getsize(mock_file)}
+        self.vault_menu.path = 'shared'
+        await self.vault_menu.load_file(filename)
+        self.plugin_instance.add_mapfile_to_group.assert_called_once()
+        local_file = self.plugin_instance.add_mapfile_to_group.call_args.args[0]
+        self.assertTrue(local_file.endswith(filename))
+        self.assertIn(('GET', 'shared/emd_8216.map.gz'), self.server.requests)
+
+    async def test_map_info_shown(self):
+        await self.vault_menu.open_folder('shared')
+        await self.vault_menu.map_info_task
+        [item] = self.vault_menu.lst_files.items
+        ln_info = item.find_node('InfoNode')
+        self.assertTrue(ln_info.enabled)
+        self.assertTrue(ln_info.get_content().text_value.startswith('83x100x50'))
 
-        get_response_mock = MagicMock()
-        with open(mock_file, 'rb') as f:
-            read_fut = asyncio.Future()
-            read_mock = MagicMock()
+    async def test_load_file_rejects_large_map_before_download(self):
+        self.plugin_instance.add_mapfile_to_group = AsyncMock()
+        self.vault_menu.path = 'shared'
+        self.plugin_instance.memory_budget.capacity = 10 ** 6
+        await self.vault_menu.load_file('emd_8216.map.gz')
+        self.plugin_instance.add_mapfile_to_group.assert_not_called()
+        self.plugin_instance.client.send_notification.assert_awaited_once()
+        # Only the header and gzip trailer were fetched
+        self.assertEqual(self.server.requests.count(('GET', 'shared/emd_8216.map.gz')), 2)
+        self.assertEqual(len(self.server.range_requests), 2)
 
-            first_read = asyncio.Future()
-            first_read.set_result(f.read())
-            second_read = asyncio.Future()
-            second_read.set_result(None)
+    async def test_load_file_over_memory_budget(self):
+        self.plugin_instance.add_mapfile_to_group = AsyncMock(side_effect=InsufficientMemory("Not enough memory"))
+        self.vault_menu.path = 'shared'
+        await self.vault_menu.load_file('emd_8216.map.gz')
+        self.plugin_instance.add_mapfile_to_group.assert_awaited_once()
+        # The download is removed
+        self.assertEqual(os.listdir(self.plugin_instance.temp_dir.name), [])
 
-            read_mock.side_effect = [first_read, second_read]
-            read_fut.set_result(read_mock)
-            get_response_mock.content.read = read_mock
+    async def test_upload_workspace(self):
+        data = b'workspace' * 1000
+        self.plugin_instance.client.request_export = AsyncMock(return_value=[data])
+        await self.vault_menu.open_folder('shared')
+        self.vault_menu.inp_workspace_name.input_text = 'session'
+        await self.vault_menu.upload_workspace()
+        upload_path = self.vault_menu.upload_path
+        self.assertTrue(os.path.exists(upload_path))
+        await self.vault_menu.confirm_upload(MagicMock())
+        self.assertEqual(self.server.entries['shared/session.nanome'], data)
+        # Spooled export is removed after upload
+        self.assertFalse(os.path.exists(upload_path))
 
-        mock_head = patch('aiohttp.ClientSession.head', new_callable=AsyncMock, return_value=head_response_mock)
-        mock_get = patch('aiohttp.ClientSession.get', new_callable=AsyncMock, return_value=get_response_mock)
-        with mock_head as mock_head, mock_get as mock_get:
-            await self.vault_menu.load_file(filename)
-        self.plugin_instance.add_mapfile_to_group.assert_called_once()
-        mock_head.assert_called_once()
-        mock_get.assert_called_once()
+    @patch('plugin.vault_menu.VaultMenu.VAULT_FILES_PER_PAGE', 50)
+    async def test_paged_file_list(self):
+        self.server.entries['shared/models'] = None
+        for i in range(120):
+            self.server.add_file(f'shared/models/model_{i:03d}.pdb', b'data')
+        self.server.add_file('shared/models/notes.txt', b'data')
+        await self.vault_menu.open_folder('shared/models')
+        # Only the first page is materialized
+        self.assertEqual(len(self.vault_menu.entries), 120)
+        self.assertEqual(len(self.vault_menu.item_nodes), 50)
+        self.assertTrue(self.vault_menu.ln_pager.enabled)
+        self.assertTrue(self.vault_menu.btn_prev_page.unusable)
+        first_page = list(self.vault_menu.lst_files.items)
+        self.assertEqual(first_page[0].name, 'model_000.pdb')
+
+        self.vault_menu.next_page()
+        self.vault_menu.next_page()
+        names = [item.name for item in self.vault_menu.lst_files.items]
+        self.assertEqual(names, [f'model_{i:03d}.pdb' for i in range(100, 120)])
+        self.assertEqual(self.vault_menu.lbl_page.text_value, '3 / 3')
+        self.assertTrue(self.vault_menu.btn_next_page.unusable)
+        self.vault_menu.next_page()
+        self.assertEqual(self.vault_menu.page, 2)
+
+        # Returning to a page reuses its list items
+        self.vault_menu.prev_page()
+        self.vault_menu.prev_page()
+        self.assertEqual(self.vault_menu.lst_files.items, first_page)
+        self.assertTrue(all(a is b for a, b in zip(self.vault_menu.lst_files.items, first_page)))
+
+    async def test_small_folder_hides_pager(self):
+        await self.vault_menu.open_folder('shared')
+        self.assertFalse(self.vault_menu.ln_pager.enabled)
+
+    def mock_workspace(self):
+        client = self.plugin_instance.client
+        next_index = iter(range(1, 100))
+
+        async def add_to_workspace(comps):
+            for comp in comps:
+                comp.index = next(next_index)
+            return comps
+        client.add_to_workspace = add_to_workspace
+        client.shapes_upload_multiple = AsyncMock(side_effect=lambda meshes: meshes)
+        client.update_structures_deep = AsyncMock()
+        self.plugin_instance.menu.render = AsyncMock()
+
+    async def test_loaded_map_kept_for_session(self):
+        self.mock_workspace()
+        self.vault_menu.path = 'shared'
+        mapgroup = self.plugin_instance.groups[0]
+        await self.vault_menu.load_file('emd_8216.map.gz', mapgroup)
+        # The downloaded map is still there to reload, e.g. to box it around the model
+        self.assertTrue(os.path.exists(mapgroup.mapfile))
+        self.assertIsNotNone(mapgroup.map_mesh.cctbx_map_manager())
+
+    @patch('plugin.vault_menu.VaultMenu.SAVE_MESH_ARTIFACTS', True)
+    async def test_mesh_artifact_saved_and_reused(self):
+        self.mock_workspace()
+        await self.vault_menu.open_folder('shared')
+        mapgroup = self.plugin_instance.groups[0]
+        await self.vault_menu.load_file('emd_8216.map.gz', mapgroup)
+        self.assertIn('shared/emd_8216.map.gz.mesh', self.server.entries)
+        generated_mesh = mapgroup.map_mesh.mesh
+
+        # Loading the map again uses the artifact instead of meshing
+        await self.vault_menu.update()
+        mapgroup = self.plugin_instance.add_mapgroup()
+        with patch.object(MapMesh, 'generate_mesh_from_map_manager') as generate_mesh:
+            await self.vault_menu.load_file('emd_8216.map.gz', mapgroup)
+        generate_mesh.assert_not_called()
+        self.assertEqual(mapgroup.isovalue, self.plugin_instance.groups[0].isovalue)
+        self.assertEqual(len(mapgroup.map_mesh.mesh.vertices), len(generated_mesh.vertices))
+        self.assertEqual(list(mapgroup.map_mesh.mesh.triangles), list(generated_mesh.triangles))
+
+    async def test_stale_mesh_artifact_ignored(self):
+        self.mock_workspace()
+        artifact = MeshArtifact([0.0] * 9, [0.0] * 9, [0, 1, 2], {
+            'isovalue': 1.0, 'source_sha256': 'other map', 'decimation_factor': 5, 'aggressiveness': 7})
+        self.server.add_file('shared/emd_8216.map.gz.mesh', artifact.to_bytes())
+        await self.vault_menu.open_folder('shared')
+        mapgroup = self.plugin_instance.groups[0]
+        await self.vault_menu.load_file('emd_8216.map.gz', mapgroup)
+        self.assertGreater(len(mapgroup.map_mesh.mesh.vertices), 9)
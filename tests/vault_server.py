@@ -0,0 +1,104 @@
+"""Minimal in-memory stand-in for the Vault file server, used by the Vault tests."""
+import hashlib
+import re
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+
+class StandInVaultServer:
+
+    def __init__(self, api_key=None, locked=None):
+        self.api_key = api_key
+        # path -> bytes for files, path -> None for folders
+        self.entries = {'shared': None}
+        # locked folder path -> key
+        self.locked = locked or {}
+        self.requests = []
+        # Set False to behave like a server without Range request support
+        self.supports_ranges = True
+        # (path, Range header) of partial responses
+        self.range_requests = []
+        # Number of upcoming uploads to fail with a 503
+        self.failing_uploads = 0
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_route('*', '/files/{path:.*}', self.handle_files)
+        app.router.add_get('/info', self.handle_info)
+        self.server = TestServer(app)
+
+    async def start(self):
+        await self.server.start_server()
+        return str(self.server.make_url(''))
+
+    async def close(self):
+        await self.server.close()
+
+    def add_file(self, path, data: bytes):
+        self.entries[path] = data
+
+    async def handle_info(self, request):
+        return web.json_response({'extensions': ['pdb', 'map.gz']})
+
+    async def handle_files(self, request):
+        self.requests.append((request.method, request.match_info['path']))
+        if self.api_key and request.headers.get('vault-api-key') != self.api_key:
+            return web.json_response({'success': False}, status=403)
+        path = request.match_info['path'].strip('/')
+        path = '' if path == '.' else path
+        if request.method in ('GET', 'HEAD'):
+            if self.entries.get(path) is not None:
+                return self.file_response(path, request.headers.get('Range'))
+            return web.json_response(self.list_path(path, request.headers.get('vault-key')))
+        if request.method == 'POST':
+            return web.json_response(await self.run_command(path, await request.post()))
+        return web.Response(status=405)
+
+    def file_response(self, path, range_header=None):
+        data = self.entries[path]
+        headers = {'ETag': f'"{hashlib.md5(data).hexdigest()}"', 'Accept-Ranges': 'bytes'}
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)', range_header or '')
+        if not self.supports_ranges or not match:
+            return web.Response(body=data, headers=headers)
+        start, end = match.groups()
+        if not start:
+            start, end = len(data) - int(end), len(data) - 1
+        start, end = int(start), min(int(end or len(data) - 1), len(data) - 1)
+        self.range_requests.append((path, range_header))
+        headers['Content-Range'] = f'bytes {start}-{end}/{len(data)}'
+        return web.Response(body=data[start:end + 1], status=206, headers=headers)
+
+    def list_path(self, path, key=None):
+        prefix = f'{path}/' if path else ''
+        folders, files = [], []
+        for entry, data in self.entries.items():
+            if not entry.startswith(prefix) or '/' in entry[len(prefix):]:
+                continue
+            name = entry[len(prefix):]
+            item = {'name': name, 'size': len(data or b''), 'size_text': '', 'created': '', 'created_text': ''}
+            (folders if data is None else files).append(item)
+        locked = [p.split('/')[-1] for p in self.locked if p.rsplit('/', 1)[0] == path]
+        locked_path = path if path in self.locked and self.locked[path] == key else None
+        return {'success': True, 'locked_path': locked_path, 'locked': locked, 'folders': folders, 'files': files}
+
+    async def run_command(self, path, form):
+        command = form['command']
+        if command == 'create':
+            if path in self.entries:
+                return {'success': False}
+            self.entries[path] = None
+        elif command == 'upload':
+            if self.failing_uploads:
+                self.failing_uploads -= 1
+                raise web.HTTPServiceUnavailable()
+            upload = form['files']
+            self.entries[f"{path}/{upload.filename}".strip('/')] = upload.file.read()
+        elif command == 'rename':
+            parent = path.rsplit('/', 1)[0] if '/' in path else ''
+            new_path = f"{parent}/{form['name']}".strip('/')
+            for entry in [e for e in self.entries if e == path or e.startswith(f'{path}/')]:
+                self.entries[new_path + entry[len(path):]] = self.entries.pop(entry)
+        elif command == 'delete':
+            for entry in [e for e in self.entries if e == path or e.startswith(f'{path}/')]:
+                del self.entries[entry]
+        elif command == 'verify':
+            return {'success': self.locked.get(path) == form.get('key')}
+        return {'success': True}